@@ -0,0 +1,101 @@
+"""Measure the per-request cost of hashing waiter paths
+
+Builds a synthetic movie tree and times buildEntries plus the bare hashing
+work with and without the hashed_filename memoization.
+
+Usage:
+    python -m benchmarks.bench_hashing --files 5000 --repeat 20
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+from pathlib import Path
+
+os.environ.setdefault("MW_IGNORE_MEDIA_DIR_CHECKS", "true")
+os.environ.setdefault("MW_LOG_DIR", tempfile.gettempdir())
+
+import settings  # noqa: E402
+import utils  # noqa: E402
+import waiter  # noqa: E402
+
+FILES_PER_DIRECTORY = 50
+
+
+def build_tree(root, count):
+    for i in range(count):
+        directory = root / f"Disc {i // FILES_PER_DIRECTORY:03}"
+        directory.mkdir(exist_ok=True)
+
+        video = directory / f"Movie.Part.{i:05}.{settings.MEDIAVIEWER_SUFFIX}.mp4"
+        with open(video, "wb") as f:
+            f.truncate(settings.MINIMUM_FILE_SIZE)
+        (directory / f"{video.stem}.en.vtt").write_text("WEBVTT\n")
+
+
+def timeit(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp) / "Synthetic Movie"
+        root.mkdir()
+        build_tree(root, args.files)
+
+        token = {
+            "ismovie": True,
+            "path": str(root),
+            "filename": root.name,
+            "guid": "benchmark",
+            "displayname": root.name,
+            "videoprogresses": [],
+        }
+        waiter_paths = [
+            str(Path(token["filename"]) / filename)
+            for _, directory in waiter.media_index.walk(root)
+            for filename in directory.files
+        ]
+
+        uncached = utils.hashed_filename.__wrapped__
+        cached = utils.hashed_filename
+
+        def hash_all(func):
+            return lambda: [func(path) for path in waiter_paths]
+
+        # Warm the directory index and the memoization table
+        waiter.buildEntries(token)
+
+        results = []
+        for label, func in (("uncached", uncached), ("memoized", cached)):
+            waiter.hashed_filename = func
+            results.append(
+                (
+                    label,
+                    timeit(hash_all(func), args.repeat),
+                    timeit(lambda: waiter.buildEntries(token), args.repeat),
+                )
+            )
+        waiter.hashed_filename = cached
+
+    print(f"{len(waiter_paths)} hashed paths, median of {args.repeat} runs")
+    print(f"{'mode':<10} {'hashing (ms)':>14} {'buildEntries (ms)':>18}")
+    for label, hashing, entries in results:
+        print(f"{label:<10} {hashing:>14.2f} {entries:>18.2f}")
+
+
+if __name__ == "__main__":
+    main()
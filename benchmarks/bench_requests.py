@@ -0,0 +1,218 @@
+"""Measure directory listing, hash resolution, page routes and range serving
+
+Builds a synthetic media tree and starts a stub MediaViewer, then times
+buildEntries, _getFileEntryFromHash, every GET page route and ranged
+downloads sent by send_file_partial through Flask's test client. Prints
+throughput and p50/p95/p99 latencies, and with --baseline exits non-zero
+when a p95 regressed by more than --tolerance.
+
+Usage:
+    python -m benchmarks.bench_requests --files 2000 --depth 2 --repeat 200
+    python -m benchmarks.bench_requests --output baseline.json
+    python -m benchmarks.bench_requests --baseline baseline.json --tolerance 0.2
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import random
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+from benchmarks.harness import (
+    MOVIE_GUID,
+    TV_GUID,
+    StubMediaViewer,
+    build_media_tree,
+    compare_to_baseline,
+    configure_environment,
+    make_tokens,
+    print_results,
+    summarize,
+)
+
+
+def run(name, func, repeat):
+    """Call func repeat times, returning its summary
+
+    func returns the number of body bytes it handled, if any.
+    """
+    timings = []
+    nbytes = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        call_start = time.perf_counter()
+        nbytes += func() or 0
+        timings.append(time.perf_counter() - call_start)
+    return summarize(name, timings, time.perf_counter() - start, nbytes)
+
+
+def get(client, url, headers=None, status=(200,), download=False):
+    """Request url, returning the size of the body for downloads"""
+    response = client.get(url, headers=headers)
+    # Iterating the body is what sends a file
+    nbytes = sum(len(chunk) for chunk in response.response)
+    response.close()
+    if response.status_code not in status:
+        raise Exception(f"{url} returned {response.status_code}")
+    return nbytes if download else 0
+
+
+def benchmark(args, waiter, tokens):
+    rng = random.Random(args.seed)
+    client = waiter.app.test_client()
+    movie = tokens[MOVIE_GUID]
+    prefix = waiter.APP_NAME
+
+    entries = waiter.buildEntries(dict(movie))
+    hashes = [entry["hashedWaiterPath"] for entry in entries]
+    if not hashes:
+        raise Exception("The synthetic tree has no streamable files")
+    tv_hash = waiter.buildEntries(dict(tokens[TV_GUID]))[0]["hashedWaiterPath"]
+
+    def list_movie():
+        waiter.buildEntries(dict(movie))
+
+    def resolve_hash():
+        waiter._getFileEntryFromHash(dict(movie), rng.choice(hashes))
+
+    def random_range():
+        start = rng.randrange(0, args.file_size - args.range_size)
+        return {"Range": f"bytes={start}-{start + args.range_size - 1}"}
+
+    cases = [
+        ("buildEntries", list_movie),
+        ("_getFileEntryFromHash", resolve_hash),
+        ("GET dir", lambda: get(client, f"{prefix}/dir/{MOVIE_GUID}/")),
+        ("GET dir cli", lambda: get(client, f"{prefix}/dir/{MOVIE_GUID}/cli/")),
+        ("GET file", lambda: get(client, f"{prefix}/file/{TV_GUID}/")),
+        ("GET file cli", lambda: get(client, f"{prefix}/file/{TV_GUID}/cli/")),
+        ("GET autoplay", lambda: get(client, f"{prefix}/file/{TV_GUID}/autoplay")),
+        (
+            "GET stream",
+            lambda: get(client, f"{prefix}/stream/{MOVIE_GUID}/{rng.choice(hashes)}"),
+        ),
+        (
+            "GET watch-party",
+            lambda: get(client, f"{prefix}/watch-party/{TV_GUID}/{tv_hash}"),
+        ),
+        (
+            "GET offset",
+            lambda: get(client, f"{prefix}/offset/{TV_GUID}/{tv_hash}/"),
+        ),
+        ("GET status", lambda: get(client, f"{prefix}/status")),
+        (
+            "GET status/connections",
+            lambda: get(client, f"{prefix}/status/connections"),
+        ),
+        (
+            "GET metrics",
+            lambda: get(
+                client,
+                f"{prefix}/metrics",
+                headers={"Authorization": f"Bearer {waiter.METRICS_TOKEN}"},
+                status=(200, 404),
+            ),
+        ),
+        (
+            "GET file range",
+            lambda: get(
+                client,
+                f"{prefix}/file/{MOVIE_GUID}/{rng.choice(hashes)}",
+                headers=random_range(),
+                status=(206,),
+                download=True,
+            ),
+        ),
+    ]
+
+    results = []
+    for name, func in cases:
+        # Warm the caches every request after the first would find warm
+        func()
+        results.append(run(name, func, args.repeat))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=2000, help="movie files")
+    parser.add_argument("--depth", type=int, default=2, help="directory nesting")
+    parser.add_argument(
+        "--small-fraction",
+        type=float,
+        default=0.1,
+        help="fraction of files below MINIMUM_FILE_SIZE",
+    )
+    parser.add_argument("--episodes", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--range-size", type=int, default=1024 * 1024)
+    parser.add_argument(
+        "--upstream-latency",
+        type=float,
+        default=0.0,
+        help="seconds the stub MediaViewer waits before answering",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed p95 increase over the baseline",
+    )
+    args = parser.parse_args()
+
+    with (
+        tempfile.TemporaryDirectory() as tmp,
+        StubMediaViewer({}, latency=args.upstream_latency) as stub,
+    ):
+        tmp = Path(tmp)
+        configure_environment(tmp, stub.base_url, tmp)
+
+        from settings import MINIMUM_FILE_SIZE
+
+        args.file_size = MINIMUM_FILE_SIZE + args.range_size
+        movie, show = build_media_tree(
+            tmp,
+            files=args.files,
+            depth=args.depth,
+            small_fraction=args.small_fraction,
+            episodes=args.episodes,
+            file_size=args.file_size,
+        )
+        tokens = stub.tokens = make_tokens(movie, show)
+
+        import waiter
+
+        # The offset route prints every request
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = benchmark(args, waiter, tokens)
+        waiter.offset_buffer.stop()
+
+    print(
+        f"{args.files} movie files {args.depth} deep, {args.episodes} episodes, "
+        f"{args.repeat} runs each"
+    )
+    print_results(results)
+
+    if args.output:
+        Path(args.output).write_text(
+            json.dumps({"arguments": vars(args), "results": results}, indent=2)
+        )
+
+    if args.baseline:
+        regressions = compare_to_baseline(results, args.baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
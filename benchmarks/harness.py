@@ -0,0 +1,300 @@
+"""Synthetic media trees, a stub MediaViewer and timing reports for benchmarks
+
+Settings are read when waiter is imported, so call configure_environment
+before importing waiter, settings or utils.
+"""
+
+import json
+import math
+import os
+import re
+import secrets
+import struct
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs
+
+MEDIAVIEWER_SUFFIX = "mv-encoded"
+MOVIE_GUID = "benchmark-movie"
+TV_GUID = "benchmark-tv"
+MOVIE_NAME = "Synthetic Movie"
+TV_NAME = "Synthetic Show"
+
+
+def _box(kind, body):
+    return struct.pack(">I4s", 8 + len(body), kind) + body
+
+
+def write_mp4(path, size, duration=1800):
+    """Write a sparse mp4 of size bytes with a moov box ahead of its mdat
+
+    Only the box headers are real, which is all waiter reads.
+    """
+    timescale = 1000
+    mvhd = struct.pack(">B3xIIII", 0, 0, 0, timescale, duration * timescale)
+    mvhd += bytes(80)
+    header = _box(b"ftyp", b"isom\x00\x00\x02\x00isomiso2mp41")
+    header += _box(b"moov", _box(b"mvhd", mvhd))
+    mdat_size = max(size - len(header), 8)
+    header += struct.pack(">I4s", mdat_size, b"mdat")
+
+    with open(path, "wb") as f:
+        f.write(header)
+        f.truncate(max(size, len(header)))
+
+
+def build_media_tree(
+    base_path,
+    files=500,
+    depth=2,
+    small_fraction=0.1,
+    episodes=20,
+    file_size=None,
+    duration=1800,
+):
+    """Build a movie and a TV show under base_path
+
+    The movie has files videos spread over directories nested depth deep,
+    each with an English subtitle. small_fraction of them are smaller than
+    MINIMUM_FILE_SIZE so waiter leaves them out of listings. The show has
+    episodes videos in one directory. Every video is duration seconds
+    long. Returns (movie path, show path).
+    """
+    from settings import MINIMUM_FILE_SIZE
+
+    file_size = file_size or MINIMUM_FILE_SIZE + 1024 * 1024
+    small_every = round(1 / small_fraction) if small_fraction else 0
+    branches = max(2, math.ceil(files ** (1 / depth))) if depth else 1
+
+    movie = Path(base_path) / "Movies" / MOVIE_NAME
+    for i in range(files):
+        directory = movie
+        for level in range(depth):
+            directory /= f"Disc {i // branches ** (depth - level - 1) % branches:03}"
+        directory.mkdir(parents=True, exist_ok=True)
+
+        video = directory / f"Part.{i:05}.{MEDIAVIEWER_SUFFIX}.mp4"
+        small = small_every and i % small_every == small_every - 1
+        write_mp4(video, MINIMUM_FILE_SIZE // 2 if small else file_size, duration)
+        (directory / f"{video.stem}.en.vtt").write_text("WEBVTT\n")
+
+    show = Path(base_path) / "TV Shows" / TV_NAME
+    show.mkdir(parents=True, exist_ok=True)
+    for i in range(episodes):
+        video = show / f"{TV_NAME}.S01E{i + 1:02}.{MEDIAVIEWER_SUFFIX}.mp4"
+        write_mp4(video, file_size, duration)
+        (show / f"{video.stem}.en.vtt").write_text("WEBVTT\n")
+
+    return movie, show
+
+
+def make_tokens(movie, show):
+    """MediaViewer tokens for the movie and the first episode of the show"""
+    common = {
+        "isvalid": True,
+        "username": "benchmark",
+        "videoprogresses": [],
+        "binge_mode": True,
+        "theme": "dark",
+        "donation_site": None,
+        "tv_id": None,
+        "tv_name": None,
+        "next_id": None,
+        "previous_id": None,
+    }
+    episodes = sorted(path.name for path in show.glob("*.mp4"))
+    return {
+        MOVIE_GUID: dict(
+            common,
+            guid=MOVIE_GUID,
+            ismovie=True,
+            path=str(movie),
+            filename=movie.name,
+            displayname=movie.name,
+        ),
+        TV_GUID: dict(
+            common,
+            guid=TV_GUID,
+            ismovie=False,
+            path=str(show),
+            filename=episodes[0],
+            displayname=episodes[0],
+            tv_id=1,
+            tv_name=show.name,
+            next_id=2,
+        ),
+    }
+
+
+class StubMediaViewer:
+    """The MediaViewer endpoints waiter calls, answered from memory
+
+    Every response is delayed by latency seconds to stand in for the
+    network and MediaViewer's own work.
+    """
+
+    def __init__(self, tokens, latency=0.0, host="127.0.0.1", port=0):
+        self.tokens = tokens
+        self.latency = latency
+        self.requests = 0
+        self._offsets = {}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/mediaviewer"
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, name="stub-mediaviewer", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def respond(self, method, path, body):
+        """Return (status, JSON payload) for a request"""
+        with self._lock:
+            self.requests += 1
+
+        if match := re.fullmatch(r"/mediaviewer/api/downloadtoken/([^/]+)/", path):
+            return 200, self.tokens.get(match[1])
+        if re.fullmatch(r"/mediaviewer/ajaxgenres/[^/]+/", path):
+            return 200, {
+                "tv_genres": [[1, "Drama"], [2, "Comedy"]],
+                "movie_genres": [[3, "Action"], [4, "Documentary"]],
+            }
+        if re.fullmatch(r"/mediaviewer/ajaxcollections/[^/]+/", path):
+            return 200, {"collections": [[1, "Favorites"]]}
+        if match := re.fullmatch(r"/mediaviewer/ajaxvideoprogress/(.+)/", path):
+            key = match[1]
+            with self._lock:
+                if method == "POST":
+                    self._offsets[key] = parse_qs(body).get("offset", ["0"])[0]
+                elif method == "DELETE":
+                    self._offsets.pop(key, None)
+                offset = self._offsets.get(key, 0)
+            return 200, {"offset": offset, "date_edited": None}
+        if path == "/mediaviewer/ajaxsuperviewed/":
+            return 200, {}
+        return 404, {"error": f"No stub for {path}"}
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _reply(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length).decode("utf-8") if length else ""
+                if stub.latency:
+                    time.sleep(stub.latency)
+                status, payload = stub.respond(self.command, self.path, body)
+
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_DELETE = _reply
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def configure_environment(base_path, mediaviewer_url, log_dir):
+    """Point waiter's settings at a synthetic tree and a stub MediaViewer
+
+    Settings already in the environment win, so send paths and caches can
+    be switched with the usual MW_* variables.
+    """
+    os.environ["MW_BASE_PATH"] = str(base_path)
+    os.environ["MW_MEDIAVIEWER_BASE_URL"] = mediaviewer_url
+    os.environ["MEDIAVIEWER_SUFFIX"] = MEDIAVIEWER_SUFFIX
+    os.environ.setdefault("MW_IGNORE_MEDIA_DIR_CHECKS", "true")
+    os.environ.setdefault("MW_LOG_DIR", str(log_dir))
+    os.environ.setdefault("MW_USE_NGINX", "false")
+    os.environ.setdefault("MW_METRICS_PATH", str(Path(log_dir) / "metrics"))
+    os.environ.setdefault("MW_METRICS_TOKEN", "benchmark")
+    os.environ.setdefault("JITSI_JWT_APP_ID", "benchmark")
+    os.environ.setdefault("JITSI_JWT_APP_SECRET", secrets.token_hex(32))
+    os.environ.setdefault("JITSI_JWT_SUB", "benchmark")
+    os.environ.setdefault("WAITER_USERNAME", "benchmark")
+    os.environ.setdefault("WAITER_PASSWORD", "benchmark")
+
+
+def percentile(sorted_values, fraction):
+    """Nearest rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(fraction * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def summarize(name, timings, elapsed, nbytes=0):
+    """Throughput and latency percentiles, in ms, of timings in seconds"""
+    timings = sorted(timings)
+    return {
+        "name": name,
+        "requests": len(timings),
+        "per_second": len(timings) / elapsed if elapsed else 0.0,
+        "mb_per_second": nbytes / elapsed / 1024 / 1024 if elapsed else 0.0,
+        "p50": percentile(timings, 0.50) * 1000,
+        "p95": percentile(timings, 0.95) * 1000,
+        "p99": percentile(timings, 0.99) * 1000,
+    }
+
+
+def print_results(results):
+    print(
+        f"{'benchmark':<28} {'count':>7} {'per sec':>10} {'MB/s':>9} "
+        f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"
+    )
+    for result in results:
+        mb = f"{result['mb_per_second']:.1f}" if result["mb_per_second"] else "-"
+        print(
+            f"{result['name']:<28} {result['requests']:>7} "
+            f"{result['per_second']:>10.1f} {mb:>9} {result['p50']:>9.2f} "
+            f"{result['p95']:>9.2f} {result['p99']:>9.2f}"
+        )
+
+
+def compare_to_baseline(results, baseline_path, tolerance):
+    """Return messages for benchmarks whose p95 regressed past tolerance"""
+    baseline = {
+        result["name"]: result
+        for result in json.loads(Path(baseline_path).read_text())["results"]
+    }
+    regressions = []
+    for result in results:
+        before = baseline.get(result["name"])
+        if before is None or not before["p95"]:
+            continue
+        change = result["p95"] / before["p95"] - 1
+        if change > tolerance:
+            regressions.append(
+                f"{result['name']}: p95 {before['p95']:.2f}ms -> "
+                f"{result['p95']:.2f}ms (+{change:.0%})"
+            )
+    return regressions
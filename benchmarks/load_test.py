@@ -0,0 +1,455 @@
+"""Find how many concurrent viewers gunicorn workers sustain
+
+Starts a stub MediaViewer and MediaWaiter under gunicorn over a synthetic
+TV show, then runs steps of simulated viewers against it for each worker
+count. A viewer plays an episode like waiter_v2.js does: it loads the
+autoplay page, fetches its saved offset, fetches video ranges at the
+playback bitrate while keeping a buffer, seeks now and then, posts its
+offset every 15 seconds and, past VIDEO_RESET_PERCENT of the episode,
+clears its offset and marks it viewed before starting over.
+
+A step is sustained when errors and rebuffering stay under their limits
+and the p95 latency stays under --slo. For each worker count the largest
+sustained step and the knee of the p95 latency curve are reported.
+
+Usage:
+    python -m benchmarks.load_test --workers 1,2,4 --viewers 5,10,20,40
+    python -m benchmarks.load_test --worker-class gthread --bitrate 8
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from pathlib import Path
+
+import requests
+
+from benchmarks.harness import (
+    TV_GUID,
+    StubMediaViewer,
+    build_media_tree,
+    configure_environment,
+    make_tokens,
+    percentile,
+)
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+OFFSET_INTERVAL = 15  # in secs, as in waiter_v2.js
+VIDEO_RESET_PERCENT = 0.95  # as in waiter_v2.js
+HASH_PATH_RE = re.compile(r"dirPath = '([^']+)'")
+
+
+class Recorder:
+    """Latencies, errors and stalls of the viewers in one step"""
+
+    def __init__(self):
+        self.recording = False
+        self.latencies = {}
+        self.errors = 0
+        self.bytes = 0
+        self.stalls = 0
+        self.stall_time = 0.0
+        self.play_time = 0.0
+        self._lock = threading.Lock()
+
+    def request(self, kind, latency, nbytes=0, error=False):
+        if not self.recording:
+            return
+        with self._lock:
+            self.latencies.setdefault(kind, []).append(latency)
+            self.bytes += nbytes
+            self.errors += error
+
+    def playback(self, played, stalled):
+        if not self.recording:
+            return
+        with self._lock:
+            self.play_time += played
+            if stalled:
+                self.stalls += 1
+                self.stall_time += stalled
+
+
+class Viewer(threading.Thread):
+    """One player watching an episode"""
+
+    def __init__(self, base_url, guid, args, recorder, stop, seed):
+        super().__init__(name=f"viewer-{guid}", daemon=True)
+        self.base_url = base_url
+        self.guid = guid
+        self.args = args
+        self.recorder = recorder
+        self.stop = stop
+        self.rng = random.Random(seed)
+        self.session = requests.Session()
+        self.bytes_per_second = args.bitrate * 1_000_000 / 8
+        self.chunk_seconds = args.chunk_size / self.bytes_per_second
+
+    def call(self, kind, method, url, download=False, **kwargs):
+        """Make a request, returning its response unless it failed
+
+        Downloads are read and dropped as they arrive like a player's buffer
+        would take them, other bodies are kept.
+        """
+        start = time.perf_counter()
+        nbytes = 0
+        error = False
+        response = None
+        try:
+            response = self.session.request(
+                method, url, timeout=self.args.timeout, stream=download, **kwargs
+            )
+            if download:
+                for chunk in response.iter_content(64 * 1024):
+                    nbytes += len(chunk)
+            error = response.status_code >= 400
+        except requests.RequestException:
+            error = True
+        self.recorder.request(kind, time.perf_counter() - start, nbytes, error)
+        return response if not error else None
+
+    def run(self):
+        while not self.stop.is_set():
+            self.watch()
+
+    def watch(self):
+        app_url = f"{self.base_url}/waiter"
+        page = self.call("page", "GET", f"{app_url}/file/{self.guid}/autoplay")
+        match = page and HASH_PATH_RE.search(page.text)
+        if not match:
+            self.stop.wait(1)
+            return
+
+        hash_path = match[1]
+        video_url = f"{app_url}/file/{self.guid}/{hash_path}"
+        offset_url = f"{app_url}/offset/{self.guid}/{hash_path}/"
+        duration = self.args.duration
+
+        saved = self.call("offset_get", "GET", offset_url)
+        position = float(saved.json()["offset"]) if saved else 0.0
+        if not position:
+            # Viewers are spread over the episode rather than all starting it
+            position = self.rng.uniform(0, duration * VIDEO_RESET_PERCENT)
+
+        buffered = position
+        kind = "seek"
+        next_offset_post = time.monotonic() + OFFSET_INTERVAL
+        last = time.monotonic()
+        while not self.stop.is_set():
+            if position >= duration * VIDEO_RESET_PERCENT:
+                self.call("offset_delete", "DELETE", offset_url)
+                self.call("viewed", "POST", f"{app_url}/viewed/{self.guid}/")
+                return
+
+            if self.rng.random() < self.args.seek_rate / 60 * self.args.tick:
+                position = self.rng.uniform(0, duration * VIDEO_RESET_PERCENT)
+                buffered = position
+                kind = "seek"
+
+            if buffered - position < self.args.buffer and buffered < duration:
+                start = int(buffered * self.bytes_per_second)
+                stop = start + self.args.chunk_size - 1
+                ahead = buffered - position
+                fetch_start = time.monotonic()
+                if self.call(
+                    kind,
+                    "GET",
+                    video_url,
+                    headers={"Range": f"bytes={start}-{stop}"},
+                    download=True,
+                ):
+                    buffered += self.chunk_seconds
+
+                # Playback carries on from the buffer while fetching and
+                # stalls once it runs out. Waiting to start or after a seek
+                # shows up in the seek latency rather than as a stall
+                elapsed = time.monotonic() - fetch_start
+                if kind == "range":
+                    stalled = max(0.0, elapsed - ahead)
+                    position += elapsed - stalled
+                    self.recorder.playback(elapsed - stalled, stalled)
+                kind = "range"
+                last = time.monotonic()
+            else:
+                self.stop.wait(self.args.tick)
+                now = time.monotonic()
+                position += now - last
+                self.recorder.playback(now - last, 0.0)
+                last = now
+
+            if time.monotonic() >= next_offset_post:
+                self.call("offset_post", "POST", offset_url, data={"offset": position})
+                next_offset_post = time.monotonic() + OFFSET_INTERVAL
+
+
+def run_step(base_url, guids, args, seed):
+    recorder = Recorder()
+    stop = threading.Event()
+    viewers = [
+        Viewer(base_url, guid, args, recorder, stop, seed + i)
+        for i, guid in enumerate(guids)
+    ]
+    for viewer in viewers:
+        viewer.start()
+        time.sleep(args.ramp / len(viewers))
+
+    recorder.recording = True
+    start = time.monotonic()
+    time.sleep(args.step_duration)
+    recorder.recording = False
+    elapsed = time.monotonic() - start
+
+    stop.set()
+    for viewer in viewers:
+        viewer.join(args.timeout + 1)
+    return summarize_step(len(guids), recorder, elapsed, args)
+
+
+def summarize_step(viewers, recorder, elapsed, args):
+    timings = sorted(t for values in recorder.latencies.values() for t in values)
+    requests_made = len(timings)
+    error_rate = recorder.errors / requests_made if requests_made else 1.0
+    rebuffer = (
+        recorder.stall_time / (recorder.play_time + recorder.stall_time)
+        if recorder.play_time + recorder.stall_time
+        else 1.0
+    )
+    p95 = percentile(timings, 0.95) * 1000
+    return {
+        "viewers": viewers,
+        "requests": requests_made,
+        "per_second": requests_made / elapsed,
+        "mb_per_second": recorder.bytes / elapsed / 1024 / 1024,
+        "p50": percentile(timings, 0.50) * 1000,
+        "p95": p95,
+        "p99": percentile(timings, 0.99) * 1000,
+        "by_kind": {
+            kind: {
+                "requests": len(values),
+                "p95": percentile(sorted(values), 0.95) * 1000,
+            }
+            for kind, values in sorted(recorder.latencies.items())
+        },
+        "error_rate": error_rate,
+        "stalls": recorder.stalls,
+        "rebuffer_ratio": rebuffer,
+        "sustained": (
+            error_rate <= args.max_error_rate
+            and rebuffer <= args.max_rebuffer
+            and p95 <= args.slo
+        ),
+    }
+
+
+def find_knee(points):
+    """x of the knee of an increasing (x, y) curve, or None if it is straight
+
+    Both axes are scaled to 0..1 and the knee is the point furthest below
+    the line joining the first and last points, as in Kneedle.
+    """
+    if len(points) < 3:
+        return None
+    points = sorted(points)
+    (x0, y0), (x1, y1) = points[0], points[-1]
+    if x1 == x0 or y1 <= y0:
+        return None
+
+    best, knee = 0.0, None
+    for x, y in points[1:-1]:
+        distance = (x - x0) / (x1 - x0) - (y - y0) / (y1 - y0)
+        if distance > best:
+            best, knee = distance, x
+    return knee
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_waiter(workers, port, args):
+    command = [
+        sys.executable,
+        "-m",
+        "gunicorn",
+        "-c",
+        str(REPO_DIR / "gunicorn.conf.py"),
+        "--workers",
+        str(workers),
+        "--bind",
+        f"127.0.0.1:{port}",
+        "waiter:gunicorn_app",
+    ]
+    env = dict(os.environ, MW_GUNICORN_WORKER_CLASS=args.worker_class)
+    process = subprocess.Popen(
+        command,
+        cwd=REPO_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise Exception(f"gunicorn exited with {process.returncode}")
+        try:
+            requests.get(f"http://127.0.0.1:{port}/waiter/status", timeout=1)
+            return process
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise Exception("gunicorn did not start")
+
+
+def print_step(step):
+    kinds = " ".join(
+        f"{kind}={values['p95']:.0f}" for kind, values in step["by_kind"].items()
+    )
+    print(
+        f"{step['viewers']:>8} {step['per_second']:>9.1f} "
+        f"{step['mb_per_second']:>8.1f} {step['p50']:>8.1f} {step['p95']:>8.1f} "
+        f"{step['p99']:>8.1f} {step['error_rate']:>7.1%} "
+        f"{step['rebuffer_ratio']:>9.1%} {'yes' if step['sustained'] else 'no':>9}"
+        f"  {kinds}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--workers", default="1,2,4", help="comma separated gunicorn worker counts"
+    )
+    parser.add_argument(
+        "--viewers", default="2,5,10,20,40", help="comma separated viewer counts"
+    )
+    parser.add_argument("--worker-class", default="sync")
+    parser.add_argument("--step-duration", type=float, default=60, help="secs")
+    parser.add_argument("--ramp", type=float, default=5, help="secs")
+    parser.add_argument("--episodes", type=int, default=20)
+    parser.add_argument("--duration", type=int, default=600, help="episode secs")
+    parser.add_argument("--bitrate", type=float, default=5, help="Mbit/s")
+    parser.add_argument("--chunk-size", type=int, default=2 * 1024 * 1024)
+    parser.add_argument("--buffer", type=float, default=30, help="secs ahead")
+    parser.add_argument("--seek-rate", type=float, default=0.5, help="per minute")
+    parser.add_argument("--tick", type=float, default=0.25, help="secs")
+    parser.add_argument("--timeout", type=float, default=30, help="secs")
+    parser.add_argument(
+        "--upstream-latency",
+        type=float,
+        default=0.02,
+        help="seconds the stub MediaViewer waits before answering",
+    )
+    parser.add_argument("--slo", type=float, default=1000, help="p95 ms")
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    parser.add_argument("--max-rebuffer", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    worker_counts = [int(count) for count in args.workers.split(",")]
+    viewer_counts = sorted(int(count) for count in args.viewers.split(","))
+
+    results = []
+    with (
+        tempfile.TemporaryDirectory() as tmp,
+        StubMediaViewer({}, latency=args.upstream_latency) as stub,
+    ):
+        tmp = Path(tmp)
+        configure_environment(tmp, stub.base_url, tmp)
+        secret_file = tmp / "secret.txt"
+        secret_file.write_text(os.urandom(32).hex())
+        os.environ["MW_SECRET_FILE"] = str(secret_file)
+
+        # Episodes are sparse files long enough to play at the bitrate
+        file_size = int(args.duration * args.bitrate * 1_000_000 / 8)
+        movie, show = build_media_tree(
+            tmp,
+            files=0,
+            episodes=args.episodes,
+            file_size=file_size,
+            duration=args.duration,
+        )
+        template = make_tokens(movie, show)[TV_GUID]
+        episodes = sorted(path.name for path in show.glob("*.mp4"))
+        guids = [f"viewer-{i}" for i in range(max(viewer_counts))]
+        stub.tokens = {
+            guid: dict(
+                template,
+                guid=guid,
+                filename=episodes[i % len(episodes)],
+                displayname=episodes[i % len(episodes)],
+            )
+            for i, guid in enumerate(guids)
+        }
+
+        for workers in worker_counts:
+            port = free_port()
+            process = start_waiter(workers, port, args)
+            print(
+                f"\n{workers} {args.worker_class} workers, "
+                f"{args.bitrate} Mbit/s, {args.step_duration:.0f}s steps"
+            )
+            print(
+                f"{'viewers':>8} {'req/s':>9} {'MB/s':>8} {'p50 ms':>8} "
+                f"{'p95 ms':>8} {'p99 ms':>8} {'errors':>7} {'rebuffer':>9} "
+                f"{'sustained':>9}  p95 ms by request"
+            )
+            steps = []
+            try:
+                for viewers in viewer_counts:
+                    step = run_step(
+                        f"http://127.0.0.1:{port}",
+                        guids[:viewers],
+                        args,
+                        args.seed + viewers,
+                    )
+                    print_step(step)
+                    steps.append(step)
+            finally:
+                process.terminate()
+                process.wait()
+
+            sustained = 0
+            for step in steps:
+                if not step["sustained"]:
+                    break
+                sustained = step["viewers"]
+            knee = find_knee([(step["viewers"], step["p95"]) for step in steps])
+            results.append(
+                {
+                    "workers": workers,
+                    "sustained_viewers": sustained,
+                    "sustained_per_worker": sustained / workers,
+                    "knee_viewers": knee,
+                    "steps": steps,
+                }
+            )
+
+    print(f"\n{'workers':>8} {'sustained':>10} {'per worker':>11} {'knee':>6}")
+    for result in results:
+        knee = result["knee_viewers"]
+        print(
+            f"{result['workers']:>8} {result['sustained_viewers']:>10} "
+            f"{result['sustained_per_worker']:>11.1f} "
+            f"{knee if knee is not None else '-':>6}"
+        )
+
+    if args.output:
+        Path(args.output).write_text(
+            json.dumps({"arguments": vars(args), "results": results}, indent=2)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+from log import logger
+from metrics import metrics, CACHE_REQUESTS
+from settings import CACHE_BACKEND, CACHE_PATH
+
+MISSING = object()
+
+
+class TTLCache:
+    """Thread-safe in-process cache with per-entry expiry and LRU eviction
+
+    Lookups are counted in the metrics when the cache has a name.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60, name=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                value = MISSING
+            else:
+                if expires <= time.monotonic():
+                    del self._data[key]
+                    value = MISSING
+                else:
+                    self._data.move_to_end(key)
+
+        if self.name:
+            _countLookup(self.name, value is not MISSING)
+        return default if value is MISSING else value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteCache:
+    """TTL cache stored in a local SQLite database
+
+    Every gunicorn worker on the host opens the same database file so an
+    entry fetched by one worker is visible to all of them. Values must be
+    JSON serializable. Expired and excess rows are pruned at most once every
+    prune_interval seconds so writes stay cheap.
+    """
+
+    def __init__(self, path, namespace, maxsize=1024, ttl=60, prune_interval=30):
+        self.path = str(path)
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.prune_interval = prune_interval
+        self._prune_after = 0
+        self._local = threading.local()
+
+    def _connection(self):
+        # sqlite3 connections must not cross threads or survive a fork
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "namespace TEXT NOT NULL, "
+                "key TEXT NOT NULL, "
+                "value TEXT NOT NULL, "
+                "expires REAL NOT NULL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key, default=None):
+        try:
+            row = (
+                self._connection()
+                .execute(
+                    "SELECT value, expires FROM cache WHERE namespace = ? AND key = ?",
+                    (self.namespace, key),
+                )
+                .fetchone()
+            )
+        except sqlite3.Error as e:
+            logger().error(e)
+            return default
+
+        hit = row is not None and row[1] > time.time()
+        _countLookup(self.namespace, hit)
+        if not hit:
+            return default
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        try:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, expires) "
+                "VALUES (?, ?, ?, ?)",
+                (self.namespace, key, json.dumps(value), now + ttl),
+            )
+            if now >= self._prune_after:
+                self._prune_after = now + self.prune_interval
+                conn.execute(
+                    "DELETE FROM cache WHERE namespace = ? AND ("
+                    "expires <= ? OR key IN ("
+                    "SELECT key FROM cache WHERE namespace = ? "
+                    "ORDER BY expires DESC LIMIT -1 OFFSET ?))",
+                    (self.namespace, now, self.namespace, self.maxsize),
+                )
+        except sqlite3.Error as e:
+            logger().error(e)
+
+    def delete(self, key):
+        try:
+            self._connection().execute(
+                "DELETE FROM cache WHERE namespace = ? AND key = ?",
+                (self.namespace, key),
+            )
+        except sqlite3.Error as e:
+            logger().error(e)
+
+    def clear(self):
+        try:
+            self._connection().execute(
+                "DELETE FROM cache WHERE namespace = ?", (self.namespace,)
+            )
+        except sqlite3.Error as e:
+            logger().error(e)
+
+    def __len__(self):
+        try:
+            return (
+                self._connection()
+                .execute(
+                    "SELECT COUNT(*) FROM cache WHERE namespace = ? AND expires > ?",
+                    (self.namespace, time.time()),
+                )
+                .fetchone()[0]
+            )
+        except sqlite3.Error as e:
+            logger().error(e)
+            return 0
+
+
+def _countLookup(name, hit):
+    metrics.inc(CACHE_REQUESTS, cache=name, result="hit" if hit else "miss")
+
+
+def get_cache(namespace, maxsize=1024, ttl=60):
+    if CACHE_BACKEND == "sqlite":
+        return SQLiteCache(CACHE_PATH, namespace, maxsize=maxsize, ttl=ttl)
+    elif CACHE_BACKEND == "local":
+        return TTLCache(maxsize=maxsize, ttl=ttl, name=namespace)
+    else:
+        raise ValueError(f"Unknown cache backend: {CACHE_BACKEND}")
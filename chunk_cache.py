@@ -0,0 +1,222 @@
+import fcntl
+import hashlib
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from log import logger
+from metrics import metrics, CACHE_REQUESTS
+
+LOCK_NAME = ".lock"
+
+
+class ChunkCache:
+    """Fixed size chunks of media files copied to a local disk tier
+
+    Chunks are keyed by the source file's path, size and mtime plus the
+    chunk index, and stored as one file each under path. Every gunicorn
+    worker on the host reads and writes the same directory, and hot chunks
+    end up served from the kernel page cache instead of network storage.
+
+    Reading a chunk queues the next `readahead` chunks to be copied in the
+    background. At most every evict_interval seconds after a write, a
+    background pass measures the cache on disk and, once it is larger than
+    max_size, removes the chunks read least recently until it is back under
+    90% of max_size. The flock on the cache's lock file keeps gunicorn
+    workers from evicting at the same time.
+    """
+
+    def __init__(
+        self,
+        path,
+        max_size,
+        chunk_size=4 * 1024 * 1024,
+        readahead=2,
+        evict_interval=30,
+    ):
+        self.path = Path(path)
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.readahead = readahead
+        self.evict_interval = evict_interval
+        self._evict_after = time.monotonic() + evict_interval
+        self._evicting = False
+        self._prefetching = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix="chunk-readahead"
+        )
+        self._evict_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="chunk-evict"
+        )
+
+    def _chunkPath(self, source, stat, index):
+        key = f"{source}\0{stat.size}\0{stat.mtime}"
+        directory = hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+        return self.path / directory / f"{index:08d}"
+
+    def iter_range(self, source, stat, start, stop):
+        """Yield the bytes of source from start up to, not including, stop"""
+        index = start // self.chunk_size
+        while start < stop:
+            data = self.get_chunk(source, stat, index)
+            offset = start - index * self.chunk_size
+            piece = data[offset : offset + stop - start]
+            if not piece:
+                break
+
+            yield piece
+            start += len(piece)
+            index += 1
+            # The file ended early, so later chunks would not line up
+            if len(data) < self.chunk_size:
+                break
+
+    def get_chunk(self, source, stat, index):
+        self._prefetch(source, stat, index)
+
+        cached = self._read(self._chunkPath(source, stat, index))
+        metrics.inc(
+            CACHE_REQUESTS, cache="chunks", result="miss" if cached is None else "hit"
+        )
+        if cached is not None:
+            return cached
+        return self._load(source, stat, index)
+
+    def _read(self, path):
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # The mtime records when a chunk was last read
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def _load(self, source, stat, index):
+        start = index * self.chunk_size
+        expected = max(min(self.chunk_size, stat.size - start), 0)
+        with open(source, "rb") as f:
+            f.seek(start)
+            data = f.read(expected)
+
+        # A short read means the file changed since it was indexed
+        if len(data) == expected and expected:
+            self._write(self._chunkPath(source, stat, index), data)
+        return data
+
+    def _write(self, path, data):
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}")
+        try:
+            try:
+                f = open(tmp, "wb")
+            except FileNotFoundError:
+                # New, or just pruned by an eviction pass
+                path.parent.mkdir(parents=True, exist_ok=True)
+                f = open(tmp, "wb")
+            with f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            # The cache is an optimization so a full disk must not fail requests
+            logger().error(e)
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            return
+
+        self._scheduleEvict()
+
+    def _scheduleEvict(self):
+        with self._lock:
+            if self._evicting or time.monotonic() < self._evict_after:
+                return
+            self._evicting = True
+        self._evict_executor.submit(self._evictInBackground)
+
+    def _evictInBackground(self):
+        try:
+            self.evict()
+        except Exception as e:
+            logger().error(e)
+        finally:
+            with self._lock:
+                self._evicting = False
+                self._evict_after = time.monotonic() + self.evict_interval
+
+    def _prefetch(self, source, stat, index):
+        last = (stat.size - 1) // self.chunk_size
+        for ahead in range(index + 1, min(index + self.readahead, last) + 1):
+            key = (str(source), stat.size, stat.mtime, ahead)
+            with self._lock:
+                if key in self._prefetching:
+                    continue
+                self._prefetching.add(key)
+            self._executor.submit(self._prefetchOne, source, stat, ahead, key)
+
+    def _prefetchOne(self, source, stat, index, key):
+        try:
+            if not self._chunkPath(source, stat, index).exists():
+                self._load(source, stat, index)
+        except Exception as e:
+            logger().error(e)
+        finally:
+            with self._lock:
+                self._prefetching.discard(key)
+
+    def evict(self):
+        """Remove the least recently read chunks until under 90% of max_size
+
+        Returns without evicting while another process is evicting.
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.path / LOCK_NAME, os.O_RDWR | os.O_CREAT)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+
+            chunks = []
+            directories = []
+            total = 0
+            for directory in _scandir(self.path):
+                directories.append(directory.path)
+                for entry in _scandir(directory.path):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    chunks.append((stat.st_mtime, entry.path, stat.st_size))
+                    total += stat.st_size
+
+            if total > self.max_size:
+                target = self.max_size * 0.9
+                for _, path, size in sorted(chunks):
+                    if total <= target:
+                        break
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+                    total -= size
+
+            for directory in directories:
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    # Still holds chunks, or a write in progress
+                    pass
+        finally:
+            os.close(fd)
+
+
+def _scandir(path):
+    try:
+        with os.scandir(path) as it:
+            return [entry for entry in it if not entry.name.startswith(".")]
+    except (FileNotFoundError, NotADirectoryError):
+        return []
@@ -0,0 +1,82 @@
+import secrets
+
+from flask import get_template_attribute
+from cache import TTLCache
+from settings import FRAGMENT_CACHE_SIZE, FRAGMENT_CACHE_TTL
+
+FRAGMENTS_TEMPLATE = "fragments.html"
+# Stands in for the GUID in links of cached fragments
+GUID_PLACEHOLDER = f"guid-{secrets.token_hex(8)}"
+
+fragment_cache = TTLCache(
+    maxsize=FRAGMENT_CACHE_SIZE, ttl=FRAGMENT_CACHE_TTL, name="fragments"
+)
+
+
+def _renderCached(key, macro_name, *args):
+    """Render a macro from fragments.html once per distinct key"""
+    html = fragment_cache.get(key)
+    if html is None:
+        html = get_template_attribute(FRAGMENTS_TEMPLATE, macro_name)(*args)
+        fragment_cache.set(key, html)
+    return html
+
+
+def render_navigation(
+    mediaviewer_base_url, ismovie, collections, movie_genres, tv_genres
+):
+    """Navigation bar links. Shared by every user with the same genres"""
+    key = (
+        "navigation",
+        mediaviewer_base_url,
+        bool(ismovie),
+        tuple(map(tuple, collections)),
+        tuple(map(tuple, movie_genres)),
+        tuple(map(tuple, tv_genres)),
+    )
+    return _renderCached(
+        key,
+        "navigation",
+        mediaviewer_base_url,
+        ismovie,
+        collections,
+        movie_genres,
+        tv_genres,
+    )
+
+
+def render_file_rows(files, guid):
+    """Rows of the file list table
+
+    Rows are cached with GUID_PLACEHOLDER in place of the GUID in their
+    links, so everyone viewing the same files shares them. Every other value
+    shown in a row is part of the key so a new file or a change in viewing
+    progress renders a new fragment.
+    """
+    files = [
+        dict(
+            file,
+            streamingPath=_withoutGUID(file["streamingPath"], guid),
+            thumbnailPath=_withoutGUID(file.get("thumbnailPath"), guid),
+        )
+        for file in files
+    ]
+    key = ("file_rows",) + tuple(
+        (
+            file["filename"],
+            file["streamingPath"],
+            file["hashedWaiterPath"],
+            file["streamable"],
+            file["hasProgress"],
+            file["size"],
+            file.get("duration"),
+            file["thumbnailPath"],
+        )
+        for file in files
+    )
+    # Markup escapes the GUID it puts in
+    return _renderCached(key, "file_rows", files).replace(GUID_PLACEHOLDER, guid)
+
+
+def _withoutGUID(path, guid):
+    return path.replace(f"/{guid}/", f"/{GUID_PLACEHOLDER}/") if path else path
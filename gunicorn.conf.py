@@ -1,4 +1,38 @@
 import multiprocessing
+import os
 
 bind = "0.0.0.0:5000"
-workers = multiprocessing.cpu_count() * 2 + 1
+workers = int(os.getenv("MW_GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+
+# "sync" serves one request per worker. "gthread" serves up to `threads`
+# requests per worker concurrently and parks idle keep-alive connections in
+# a selector, so long downloads and slow MediaViewer calls no longer pin a
+# whole worker.
+worker_class = os.getenv("MW_GUNICORN_WORKER_CLASS", "sync")
+threads = int(os.getenv("MW_GUNICORN_THREADS", 32 if worker_class == "gthread" else 1))
+worker_connections = int(os.getenv("MW_GUNICORN_WORKER_CONNECTIONS", 1000))
+keepalive = int(os.getenv("MW_GUNICORN_KEEPALIVE", 5))  # in secs
+
+
+def post_worker_init(worker):
+    # Watcher threads do not survive a fork so every worker starts its own
+    from waiter import start_media_watcher
+
+    start_media_watcher()
+
+    # SIGUSR2 writes a profile of the worker to MW_PROFILE_PATH. Send it to
+    # a worker's pid, not the master's, where it upgrades gunicorn
+    from profiler import profiler
+
+    profiler.install_signal_handler()
+
+
+def worker_exit(server, worker):
+    # Send any buffered video offsets before the worker goes away
+    from waiter import offset_buffer
+    from metrics import metrics
+
+    offset_buffer.stop()
+    # Leave this worker's final values for /metrics to archive
+    if metrics.enabled:
+        metrics.write()
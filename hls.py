@@ -0,0 +1,223 @@
+import fcntl
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+
+from pathlib import Path
+from log import logger
+
+PLAYLIST_NAME = "index.m3u8"
+PLAYLIST_MIMETYPE = "application/vnd.apple.mpegurl"
+SEGMENT_MIMETYPE = "video/mp2t"
+SEGMENT_NAME = re.compile(r"^seg\d{5}\.ts$")
+
+LOCK_NAME = ".lock"
+COMPLETE_NAME = ".complete"
+
+
+class SegmentCache:
+    """HLS renditions of media files, remuxed by ffmpeg and kept on disk
+
+    Every source file, identified by its path, size and mtime, gets a
+    directory holding its playlist and segments. Streams are copied rather
+    than re-encoded so a rendition takes about as long as reading the file.
+    The playlist is an EVENT playlist while ffmpeg is running so playback can
+    start as soon as the first segment is written.
+
+    A rendition is generated by whichever process holds the flock on its
+    directory, so all gunicorn workers on the host share one copy. Once the
+    cache is larger than max_size the renditions played least recently are
+    removed.
+    """
+
+    def __init__(self, path, max_size, ffmpeg="ffmpeg", segment_duration=6):
+        self.path = Path(path)
+        self.max_size = max_size
+        self.ffmpeg = ffmpeg
+        self.segment_duration = segment_duration
+        self._running = set()
+        self._lock = threading.Lock()
+
+    def directory(self, source, stat):
+        key = f"{source}\0{stat.size}\0{stat.mtime}"
+        return self.path / hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+
+    def get_playlist(self, source, stat, timeout=10):
+        """Return the playlist for source, starting ffmpeg if there is none
+
+        Waits up to timeout seconds for the first segment to be written.
+        """
+        directory = self.directory(source, stat)
+        if not (directory / COMPLETE_NAME).exists():
+            self._start(source, directory)
+        self.touch(directory)
+
+        playlist = directory / PLAYLIST_NAME
+        deadline = time.monotonic() + timeout
+        while not playlist.exists():
+            if not directory.exists():
+                raise Exception(f"Unable to remux {source}")
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Timed out waiting for {playlist}")
+            time.sleep(0.1)
+        return playlist
+
+    def get_segment(self, source, stat, name):
+        if not SEGMENT_NAME.match(name):
+            raise ValueError(f"Invalid segment name: {name}")
+
+        directory = self.directory(source, stat)
+        segment = directory / name
+        if not segment.exists():
+            raise FileNotFoundError(f"{segment} does not exist")
+        self.touch(directory)
+        return segment
+
+    def touch(self, directory):
+        # The directory mtime records when a rendition was last played
+        try:
+            os.utime(directory)
+        except FileNotFoundError:
+            pass
+
+    def _command(self, source, directory):
+        return [
+            self.ffmpeg,
+            "-nostdin",
+            "-loglevel",
+            "error",
+            "-i",
+            str(source),
+            "-map",
+            "0:v:0",
+            "-map",
+            "0:a?",
+            "-c",
+            "copy",
+            "-f",
+            "hls",
+            "-hls_time",
+            str(self.segment_duration),
+            "-hls_playlist_type",
+            "event",
+            "-hls_flags",
+            "temp_file+independent_segments",
+            "-hls_segment_filename",
+            str(directory / "seg%05d.ts"),
+            str(directory / PLAYLIST_NAME),
+        ]
+
+    def _start(self, source, directory):
+        with self._lock:
+            if directory in self._running:
+                return
+
+            directory.mkdir(parents=True, exist_ok=True)
+            fd = os.open(directory / LOCK_NAME, os.O_RDWR | os.O_CREAT)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another worker is already remuxing it
+                os.close(fd)
+                return
+
+            if (directory / COMPLETE_NAME).exists():
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+                return
+
+            # Anything left here is from a run that was interrupted
+            for child in directory.iterdir():
+                if child.name != LOCK_NAME:
+                    child.unlink()
+
+            try:
+                process = subprocess.Popen(
+                    self._command(source, directory),
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.PIPE,
+                )
+            except OSError:
+                os.close(fd)
+                shutil.rmtree(directory, ignore_errors=True)
+                raise
+
+            self._running.add(directory)
+            threading.Thread(
+                target=self._wait,
+                args=(process, directory, fd),
+                name="hls-remux",
+                daemon=True,
+            ).start()
+
+    def _wait(self, process, directory, fd):
+        try:
+            _, stderr = process.communicate()
+            if process.returncode == 0:
+                (directory / COMPLETE_NAME).touch()
+            else:
+                logger().error(
+                    f"ffmpeg exited with {process.returncode} for {directory}: "
+                    f"{stderr.decode('utf-8', errors='replace')[-1000:]}"
+                )
+                shutil.rmtree(directory, ignore_errors=True)
+        finally:
+            with self._lock:
+                self._running.discard(directory)
+            os.close(fd)
+
+        self.evict()
+
+    def _isBusy(self, directory):
+        try:
+            fd = os.open(directory / LOCK_NAME, os.O_RDWR)
+        except FileNotFoundError:
+            return False
+
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(fd)
+        return False
+
+    def size(self, directory):
+        total = 0
+        for child in directory.iterdir():
+            try:
+                total += child.stat().st_size
+            except FileNotFoundError:
+                pass
+        return total
+
+    def evict(self):
+        """Remove the least recently played renditions until under max_size"""
+        renditions = []
+        total = 0
+        try:
+            for directory in self.path.iterdir():
+                try:
+                    mtime = directory.stat().st_mtime
+                    size = self.size(directory)
+                except (FileNotFoundError, NotADirectoryError):
+                    continue
+                renditions.append((mtime, directory, size))
+                total += size
+        except FileNotFoundError:
+            return
+
+        for _, directory, size in sorted(renditions):
+            if total <= self.max_size:
+                break
+            if self._isBusy(directory):
+                continue
+
+            logger().info(f"Evicting {directory} from the HLS cache")
+            shutil.rmtree(directory, ignore_errors=True)
+            total -= size
@@ -0,0 +1,148 @@
+import os
+import threading
+import time
+
+from bisect import bisect_left
+from collections import namedtuple
+from pathlib import Path
+
+FileStat = namedtuple("FileStat", "size,mtime")
+
+
+class DirectoryEntry(
+    namedtuple("DirectoryEntry", "mtime,scanned,files,subdirs,subtitles")
+):
+    """Listing of a single directory. subtitles is sorted by name"""
+
+    __slots__ = ()
+
+    def subtitles_for(self, stem):
+        """Return the subtitle names in this directory that start with stem"""
+        start = bisect_left(self.subtitles, stem)
+        stop = start
+        while stop < len(self.subtitles) and self.subtitles[stop].startswith(stem):
+            stop += 1
+        return self.subtitles[start:stop]
+
+
+SUBTITLE_FILE_TYPES = (".vtt",)
+
+
+class MediaIndex:
+    """Long-lived index of directory listings under BASE_PATH
+
+    Each directory is listed once and then revalidated with a single stat of
+    the directory itself. A changed directory mtime means a file was added,
+    removed or renamed so the listing is rebuilt. Listings are also rebuilt
+    after max_age seconds to pick up files that are still being copied in,
+    since growing a file does not touch its directory's mtime.
+
+    Directories under a watched root are kept current by a watcher (see
+    watcher.py) so cached listings for them are returned without a stat.
+    """
+
+    def __init__(self, max_age=300):
+        self.max_age = max_age
+        self._directories = {}
+        self._watched_roots = ()
+        self._lock = threading.Lock()
+
+    def watch(self, roots):
+        self._watched_roots = tuple(str(Path(root)) for root in roots)
+
+    def unwatch(self):
+        self._watched_roots = ()
+
+    def _isWatched(self, path):
+        path = str(path)
+        return any(
+            path == root or path.startswith(root + os.sep)
+            for root in self._watched_roots
+        )
+
+    def get_directory(self, path):
+        path = Path(path)
+        entry = self._directories.get(path)
+        if entry is not None and self._watched_roots and self._isWatched(path):
+            return entry
+        return self.revalidate(path)
+
+    def revalidate(self, path):
+        """Rescan path if its mtime changed or its listing is too old"""
+        path = Path(path)
+        mtime = os.stat(path).st_mtime_ns
+
+        entry = self._directories.get(path)
+        if (
+            entry is None
+            or entry.mtime != mtime
+            or entry.scanned + self.max_age <= time.monotonic()
+        ):
+            entry = self._scan(path, mtime)
+            with self._lock:
+                self._directories[path] = entry
+        return entry
+
+    def refresh(self, path):
+        """Unconditionally rescan path, dropping it if it no longer exists"""
+        path = Path(path)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            entry = self._scan(path, mtime)
+        except OSError:
+            self.invalidate(path)
+            return None
+
+        with self._lock:
+            self._directories[path] = entry
+        return entry
+
+    def _scan(self, path, mtime):
+        files = {}
+        subdirs = []
+        subtitles = []
+        with os.scandir(path) as it:
+            for dir_entry in it:
+                if dir_entry.is_dir():
+                    subdirs.append(dir_entry.name)
+                elif dir_entry.is_file():
+                    stat = dir_entry.stat()
+                    files[dir_entry.name] = FileStat(stat.st_size, stat.st_mtime_ns)
+                    if dir_entry.name.endswith(SUBTITLE_FILE_TYPES):
+                        subtitles.append(dir_entry.name)
+
+        return DirectoryEntry(
+            mtime=mtime,
+            scanned=time.monotonic(),
+            files=files,
+            subdirs=tuple(sorted(subdirs)),
+            subtitles=tuple(sorted(subtitles)),
+        )
+
+    def walk(self, path):
+        """Yield (directory path, DirectoryEntry) for path and every subdirectory
+
+        Unreadable directories are skipped in the same way os.walk skips them.
+        """
+        stack = [Path(path)]
+        while stack:
+            current = stack.pop()
+            try:
+                entry = self.get_directory(current)
+            except OSError:
+                continue
+
+            yield current, entry
+            stack.extend(current / subdir for subdir in reversed(entry.subdirs))
+
+    def invalidate(self, path):
+        with self._lock:
+            self._directories.pop(Path(path), None)
+
+    def directories(self):
+        with self._lock:
+            return list(self._directories)
+
+    def clear(self):
+        with self._lock:
+            self._directories.clear()
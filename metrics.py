@@ -0,0 +1,282 @@
+import fcntl
+import json
+import os
+import threading
+import time
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from pathlib import Path
+from log import logger
+from settings import METRICS, METRICS_FLUSH_INTERVAL, METRICS_PATH
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ARCHIVE_NAME = "archive.json"
+LOCK_NAME = ".lock"
+
+REQUEST_DURATION = "mediawaiter_request_duration_seconds"
+REQUESTS = "mediawaiter_requests_total"
+UPSTREAM_DURATION = "mediawaiter_upstream_request_duration_seconds"
+UPSTREAM_ERRORS = "mediawaiter_upstream_errors_total"
+RETRIES = "mediawaiter_retries_total"
+BYTES_SERVED = "mediawaiter_bytes_served_total"
+CACHE_REQUESTS = "mediawaiter_cache_requests_total"
+
+
+class Metrics:
+    """Counters and histograms shared by every gunicorn worker on the host
+
+    Each worker keeps its values in memory and writes them to <pid>.json
+    under path every flush_interval seconds and whenever it renders the
+    metrics. Rendering sums the files of all workers. Files left behind by
+    workers that have exited are folded into archive.json so counters do not
+    go backwards when gunicorn replaces a worker.
+    """
+
+    def __init__(self, path, flush_interval=5, enabled=True):
+        self.path = Path(path)
+        self.flush_interval = flush_interval
+        self.enabled = enabled
+        self._types = {}
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+        self._pid = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def counter(self, name, help):
+        self._types[name] = ("counter", help, None)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        self._types[name] = ("histogram", help, tuple(buckets))
+
+    def collector(self, func):
+        """Register func returning [(counter name, labels, value), ...]
+
+        Used for counters kept elsewhere, like functools.lru_cache's stats.
+        """
+        self._collectors.append(func)
+        return func
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._checkPid()
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+
+        buckets = self._types[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._checkPid()
+            # A count per bucket, the last one being +Inf, then the sum
+            values = self._histograms.get(key)
+            if values is None:
+                values = self._histograms[key] = [0] * (len(buckets) + 1) + [0]
+            values[bisect_left(buckets, value)] += 1
+            values[-1] += value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def _checkPid(self):
+        # Values and threads are per process. Anything inherited from the
+        # gunicorn master belongs to it, not to this worker
+        pid = os.getpid()
+        if self._pid != pid:
+            if self._pid is not None:
+                self._counters.clear()
+                self._histograms.clear()
+            self._pid = pid
+            self._thread = threading.Thread(
+                target=self._run, name="metrics", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.write()
+            except Exception as e:
+                logger().error(e)
+
+    def snapshot(self):
+        with self._lock:
+            counters = [
+                [name, dict(labels), value]
+                for (name, labels), value in self._counters.items()
+            ]
+            histograms = [
+                [name, dict(labels), list(values)]
+                for (name, labels), values in self._histograms.items()
+            ]
+        for collect in self._collectors:
+            counters.extend([name, labels, value] for name, labels, value in collect())
+        return {"counters": counters, "histograms": histograms}
+
+    def write(self):
+        """Write this worker's values for the other workers to read"""
+        self.path.mkdir(parents=True, exist_ok=True)
+        pid = os.getpid()
+        tmp = self.path / f".{pid}.tmp"
+        tmp.write_text(json.dumps(self.snapshot()))
+        os.replace(tmp, self.path / f"{pid}.json")
+
+    def collect(self):
+        """Sum the values written by every worker"""
+        self.write()
+        totals = {"counters": {}, "histograms": {}}
+        with self._flock():
+            archive = self.path / ARCHIVE_NAME
+            archived = _read(archive)
+            if archived:
+                _merge(totals, archived)
+
+            exited = {"counters": {}, "histograms": {}}
+            for path in self.path.glob("*.json"):
+                if path.name == ARCHIVE_NAME:
+                    continue
+                snapshot = _read(path)
+                if snapshot is None:
+                    continue
+                _merge(totals, snapshot)
+                if not _isAlive(int(path.stem)):
+                    _merge(exited, snapshot)
+                    path.unlink()
+
+            if exited["counters"] or exited["histograms"]:
+                if archived:
+                    _merge(exited, archived)
+                tmp = self.path / f".{ARCHIVE_NAME}.tmp"
+                tmp.write_text(json.dumps(_unflatten(exited)))
+                os.replace(tmp, archive)
+        return totals
+
+    @contextmanager
+    def _flock(self):
+        fd = os.open(self.path / LOCK_NAME, os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def render(self):
+        """All workers' values in the Prometheus text exposition format"""
+        totals = self.collect()
+        lines = []
+        for name, (kind, help, buckets) in sorted(self._types.items()):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                for (metric, labels), value in sorted(totals["counters"].items()):
+                    if metric == name:
+                        lines.append(f"{name}{_labels(labels)} {_number(value)}")
+                continue
+
+            for (metric, labels), values in sorted(totals["histograms"].items()):
+                if metric != name or len(values) != len(buckets) + 2:
+                    continue
+                cumulative = 0
+                for le, count in zip(buckets + ("+Inf",), values):
+                    cumulative += count
+                    bucket_labels = labels + (("le", str(le)),)
+                    lines.append(f"{name}_bucket{_labels(bucket_labels)} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {_number(values[-1])}")
+                lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+def _read(path):
+    try:
+        return json.loads(path.read_text())
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        logger().error(f"Ignoring {path}: {e}")
+        return None
+
+
+def _merge(totals, snapshot):
+    """Add a snapshot, or other totals, to totals"""
+    counters, histograms = snapshot["counters"], snapshot["histograms"]
+    if isinstance(counters, list):
+        counters = {
+            (name, tuple(sorted(labels.items()))): value
+            for name, labels, value in counters
+        }
+        histograms = {
+            (name, tuple(sorted(labels.items()))): values
+            for name, labels, values in histograms
+        }
+
+    for key, value in counters.items():
+        totals["counters"][key] = totals["counters"].get(key, 0) + value
+    for key, values in histograms.items():
+        current = totals["histograms"].get(key)
+        if current is None or len(current) != len(values):
+            totals["histograms"][key] = list(values)
+        else:
+            totals["histograms"][key] = [a + b for a, b in zip(current, values)]
+
+
+def _unflatten(totals):
+    return {
+        "counters": [
+            [name, dict(labels), value]
+            for (name, labels), value in totals["counters"].items()
+        ],
+        "histograms": [
+            [name, dict(labels), values]
+            for (name, labels), values in totals["histograms"].items()
+        ],
+    }
+
+
+def _isAlive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+metrics = Metrics(METRICS_PATH, flush_interval=METRICS_FLUSH_INTERVAL, enabled=METRICS)
+metrics.histogram(REQUEST_DURATION, "Time spent handling requests by endpoint")
+metrics.counter(REQUESTS, "Requests handled by endpoint and status")
+metrics.histogram(UPSTREAM_DURATION, "Time spent on MediaViewer calls by endpoint")
+metrics.counter(UPSTREAM_ERRORS, "MediaViewer calls that failed by endpoint")
+metrics.counter(RETRIES, "Calls retried by delayedRetry by function")
+metrics.counter(BYTES_SERVED, "Bytes of media sent by send path")
+metrics.counter(CACHE_REQUESTS, "Cache lookups by cache and result")
@@ -0,0 +1,93 @@
+import struct
+
+from prefetch import warm_range
+
+BOX_HEADER = struct.Struct(">I4s")
+
+
+def _boxes(f, start, end):
+    """Yield (type, offset, header size, size) for each box in f[start:end]"""
+    offset = start
+    while offset + BOX_HEADER.size <= end:
+        f.seek(offset)
+        header = f.read(16)
+        if len(header) < BOX_HEADER.size:
+            return
+        box_size, kind = BOX_HEADER.unpack_from(header)
+        header_size = BOX_HEADER.size
+        if box_size == 1:
+            (box_size,) = struct.unpack_from(">Q", header, 8)
+            header_size = 16
+        elif box_size == 0:
+            box_size = end - offset
+        if box_size < header_size:
+            raise ValueError(f"Invalid {kind!r} box at {offset}")
+
+        yield kind, offset, header_size, box_size
+        offset += box_size
+
+
+def _timescaleAndDuration(data):
+    version = data[0]
+    if version == 1:
+        return struct.unpack_from(">IQ", data, 20)
+    return struct.unpack_from(">II", data, 12)
+
+
+def probe(path, size):
+    """Describe the mp4 at path from its box headers and mvhd box
+
+    Only box headers and the mvhd box are read so probing a cold file costs a
+    few small reads. Returns a dict that can be serialized as JSON. Raises
+    ValueError for files that are not mp4s.
+    """
+    moov = mdat = mvhd = None
+    with open(path, "rb") as f:
+        for kind, offset, header_size, box_size in _boxes(f, 0, size):
+            if kind == b"moov" and moov is None:
+                moov = (offset, header_size, box_size)
+            elif kind == b"mdat" and mdat is None:
+                mdat = offset
+            if moov is not None and mdat is not None:
+                break
+
+        if moov is None:
+            raise ValueError(f"{path} has no moov box")
+
+        offset, header_size, box_size = moov
+        if offset + box_size > size:
+            raise ValueError(f"{path} has a truncated moov box")
+        for kind, child, child_header_size, child_size in _boxes(
+            f, offset + header_size, offset + box_size
+        ):
+            if kind == b"mvhd":
+                f.seek(child + child_header_size)
+                mvhd = f.read(child_size - child_header_size)
+                break
+
+    if mvhd is None:
+        raise ValueError(f"{path} has no mvhd box")
+
+    try:
+        timescale, duration = _timescaleAndDuration(mvhd)
+    except (struct.error, IndexError) as e:
+        raise ValueError(f"{path} has a corrupt mvhd box: {e}")
+    seconds = duration / timescale if timescale else 0
+
+    return {
+        "faststart": mdat is None or moov[0] < mdat,
+        "moov_offset": moov[0],
+        "moov_size": moov[2],
+        "duration": round(seconds, 3),
+        "bitrate": int(size * 8 / seconds) if seconds else 0,
+    }
+
+
+def warm_moov(path, info):
+    """Ask the kernel to start reading the moov box of path into memory
+
+    Players fetch the start of a file first and only then request the moov
+    box, so reading it ahead saves a round trip to storage when it is at the
+    end of the file.
+    """
+    warm_range(path, info["moov_offset"], info["moov_size"])
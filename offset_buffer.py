@@ -0,0 +1,138 @@
+import atexit
+import threading
+import time
+
+from log import logger
+
+
+class OffsetBuffer:
+    """Write-behind buffer for video offsets
+
+    Only the latest offset per (guid, filename) is kept. Pending offsets are
+    sent to MediaViewer every flush_interval seconds from a background thread
+    and once more when the worker exits. Failed writes are logged and
+    dropped.
+
+    Every gunicorn worker has its own buffer, so discarding an offset also
+    records when it was discarded in tombstones, a cache shared by the
+    workers. Offsets set before their tombstone are neither returned nor
+    written, and ones discarded while being written are deleted again with
+    deleter.
+    """
+
+    def __init__(
+        self, writer, flush_interval=10, on_flush=None, deleter=None, tombstones=None
+    ):
+        self.writer = writer
+        self.flush_interval = flush_interval
+        self.on_flush = on_flush
+        self.deleter = deleter
+        self.tombstones = tombstones
+        # (guid, filename) -> (offset, time it was set)
+        self._pending = {}
+        self._inflight = {}
+        self._discarded = set()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._registered = False
+
+    def set(self, guid, filename, offset):
+        with self._lock:
+            self._pending[(guid, filename)] = (offset, time.time())
+            self._start()
+
+    def get(self, guid, filename, default=None):
+        key = (guid, filename)
+        with self._lock:
+            entry = self._pending.get(key) or self._inflight.get(key)
+        if entry is None or self._wasDiscarded(key, entry[1]):
+            return default
+        return entry[0]
+
+    def discard(self, guid, filename):
+        key = (guid, filename)
+        with self._lock:
+            self._pending.pop(key, None)
+            if self._inflight.pop(key, None) is not None:
+                # Tells the running flush not to write it back
+                self._discarded.add(key)
+        if self.tombstones is not None:
+            self.tombstones.set(_tombstoneKey(key), time.time())
+
+    def _wasDiscarded(self, key, since):
+        with self._lock:
+            if key in self._discarded:
+                return True
+        if self.tombstones is None:
+            return False
+        discarded_at = self.tombstones.get(_tombstoneKey(key))
+        return discarded_at is not None and discarded_at >= since
+
+    def flush(self):
+        # Serialize flushes so an older batch can never land after a newer one.
+        # Requests never wait on it, only on the dict lock.
+        with self._flush_lock:
+            with self._lock:
+                self._inflight, self._pending = self._pending, {}
+                batch = list(self._inflight.items())
+
+            for key, (offset, since) in batch:
+                guid, filename = key
+                if self._wasDiscarded(key, since):
+                    continue
+
+                try:
+                    self.writer(filename, guid, offset)
+                except Exception as e:
+                    # The player posts its position again on its next tick
+                    logger().error(e)
+                    continue
+
+                if self._wasDiscarded(key, since):
+                    self._delete(guid, filename)
+                if self.on_flush:
+                    self.on_flush(guid, filename)
+
+            with self._lock:
+                self._inflight = {}
+                self._discarded = set()
+
+    def _delete(self, guid, filename):
+        # The write may have landed after the discarding request's delete
+        if self.deleter is None:
+            return
+        try:
+            self.deleter(filename, guid)
+        except Exception as e:
+            logger().error(e)
+
+    def _start(self):
+        # Threads do not survive a fork so start lazily in each worker
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(
+                target=self._run, name="offset-buffer", daemon=True
+            )
+            self._thread.start()
+
+        if not self._registered:
+            atexit.register(self.flush)
+            self._registered = True
+
+    def _run(self):
+        while not self._wakeup.wait(self.flush_interval):
+            self.flush()
+
+    def stop(self):
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        # Offsets set afterwards start a new flush thread
+        self._wakeup.clear()
+
+
+def _tombstoneKey(key):
+    guid, filename = key
+    return f"{guid}/{filename}"
@@ -0,0 +1,57 @@
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from cache import TTLCache
+from log import logger
+
+
+class Prefetcher:
+    """Run jobs that warm caches in the background, once per key
+
+    A job is not queued while another one for the same key is queued or
+    running. Jobs return True once they have warmed what they were meant
+    to, after which their key is skipped for ttl seconds. Jobs returning
+    anything else are run again the next time they are submitted.
+    """
+
+    def __init__(self, workers=1, maxsize=1024, ttl=3600):
+        self._done = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="prefetch"
+        )
+
+    def submit(self, key, func, *args):
+        if self._done.get(key):
+            return None
+
+        with self._lock:
+            if key in self._pending:
+                return None
+            self._pending.add(key)
+        return self._executor.submit(self._run, key, func, *args)
+
+    def _run(self, key, func, *args):
+        try:
+            if func(*args) is True:
+                self._done.set(key, True)
+        except Exception as e:
+            # Prefetching is an optimization so failures only get logged
+            logger().error(e, exc_info=True)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+
+def warm_range(path, offset, length):
+    """Ask the kernel to start reading part of path into the page cache"""
+    if not hasattr(os, "posix_fadvise"):
+        return
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
@@ -0,0 +1,126 @@
+import math
+import os
+import signal
+import sys
+import threading
+import time
+
+from collections import Counter
+from log import logger
+from settings import (
+    PROFILE_INTERVAL,
+    PROFILE_MAX_DURATION,
+    PROFILE_PATH,
+    PROFILE_SIGNAL_DURATION,
+)
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+class Profiler:
+    """Sampling profiler for the threads of a live worker
+
+    Every interval seconds the Python stack of each thread is recorded from
+    sys._current_frames. Stacks are returned in the collapsed format read by
+    flamegraph.pl, speedscope and inferno: one line per stack with its
+    frames joined by semicolons, root first, and the number of samples.
+
+    Only one profile runs per worker at a time. Time spent in C code, like
+    reads and ffmpeg waits, is counted against the Python frame calling it.
+    """
+
+    def __init__(self, interval=0.01, max_duration=25):
+        self.interval = interval
+        self.max_duration = max_duration
+        self._lock = threading.Lock()
+
+    def sample(self, duration, exclude=()):
+        """Sample every thread but the caller and exclude for duration seconds
+
+        Returns a Counter of collapsed stacks. Raises ProfilerBusy if another
+        profile is running.
+        """
+        if not math.isfinite(duration) or duration <= 0:
+            raise ValueError(f"Invalid profile duration: {duration}")
+        duration = min(duration, self.max_duration)
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusy("A profile is already running")
+
+        try:
+            skip = set(exclude) | {threading.get_ident()}
+            names = {}
+            stacks = Counter()
+            deadline = time.monotonic() + duration
+            while True:
+                for ident, frame in sys._current_frames().items():
+                    if ident in skip:
+                        continue
+                    if ident not in names:
+                        names = _threadNames()
+                    stacks[_collapse(names.get(ident, str(ident)), frame)] += 1
+                del frame
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                time.sleep(min(self.interval, remaining))
+        finally:
+            self._lock.release()
+        return stacks
+
+    def profile_to_file(self, duration):
+        """Sample for duration seconds and write the stacks under PROFILE_PATH"""
+        try:
+            stacks = self.sample(duration)
+        except ProfilerBusy as e:
+            logger().warning(e)
+            return None
+
+        PROFILE_PATH.mkdir(parents=True, exist_ok=True)
+        path = PROFILE_PATH / f"{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.txt"
+        path.write_text(render(stacks))
+        logger().info(f"Wrote profile to {path}")
+        return path
+
+    def install_signal_handler(
+        self, signum=signal.SIGUSR2, duration=PROFILE_SIGNAL_DURATION
+    ):
+        """Profile the worker for duration seconds when it receives signum
+
+        The handler only starts a thread so the interrupted request carries
+        on and shows up in the profile.
+        """
+
+        def handler(signum, frame):
+            threading.Thread(
+                target=self.profile_to_file,
+                args=(duration,),
+                name="profiler",
+                daemon=True,
+            ).start()
+
+        signal.signal(signum, handler)
+
+
+def _threadNames():
+    return {thread.ident: thread.name for thread in threading.enumerate()}
+
+
+def _collapse(thread_name, frame):
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+        frame = frame.f_back
+    frames.append(thread_name)
+    # Semicolons separate frames in the collapsed format
+    return ";".join(name.replace(";", ":") for name in reversed(frames))
+
+
+def render(stacks):
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items()))
+
+
+profiler = Profiler(interval=PROFILE_INTERVAL, max_duration=PROFILE_MAX_DURATION)
@@ -0,0 +1,289 @@
+import mimetypes
+import mmap
+import os
+import secrets
+
+from flask import Response, request
+from werkzeug.http import http_date
+from werkzeug.wsgi import ClosingIterator
+from media_index import FileStat
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+
+def _resolveRanges(byte_range, size):
+    """Turn a parsed Range header into a list of (start, stop) byte offsets
+
+    Unsatisfiable ranges are dropped. The stop offset is exclusive.
+    """
+    resolved = []
+    for start, stop in byte_range.ranges:
+        if stop is None:
+            stop = size
+            if start < 0:
+                start = max(size + start, 0)
+        stop = min(stop, size)
+        if start < stop:
+            resolved.append((start, stop))
+    return resolved
+
+
+def _iterFile(f, start, stop, chunk_size):
+    try:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            data = f.read(min(chunk_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+class _BoundedFile:
+    """A file that reads as if it ended at stop
+
+    fileno, tell and seek are passed through so servers can still sendfile
+    it, while servers that read it stop at the end of the range.
+    """
+
+    def __init__(self, f, stop):
+        self._f = f
+        self._remaining = max(stop - f.tell(), 0)
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._f.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self._f.fileno()
+
+    def tell(self):
+        return self._f.tell()
+
+    def seek(self, *args):
+        return self._f.seek(*args)
+
+    def close(self):
+        self._f.close()
+
+    @property
+    def closed(self):
+        return self._f.closed
+
+
+def _iterMmap(path, start, stop, chunk_size):
+    """Yield chunks of path copied out of the file mapped into memory
+
+    PEP 3333 bodies must be bytes, so every chunk is copied once from the
+    page cache, in place of the read() syscall per chunk _iterFile makes.
+    """
+    if start >= stop:
+        return
+
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if hasattr(mapped, "madvise"):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+
+        stop = min(stop, len(mapped))
+        while start < stop:
+            yield mapped[start : min(start + chunk_size, stop)]
+            start += chunk_size
+    finally:
+        mapped.close()
+
+
+def _reader(path, stat, chunk_size, chunk_cache, use_mmap):
+    """Return a function yielding the bytes of path between two offsets"""
+    if chunk_cache is not None:
+        return lambda start, stop: chunk_cache.iter_range(path, stat, start, stop)
+
+    if use_mmap:
+        return lambda start, stop: _iterMmap(path, start, stop, chunk_size)
+
+    return lambda start, stop: _iterFile(open(path, "rb"), start, stop, chunk_size)
+
+
+def _iterMultipart(parts, read):
+    for header, start, stop in parts:
+        yield header
+        yield from read(start, stop)
+        yield b"\r\n"
+
+
+def _ifRangeMatches(etag, mtime):
+    """A Range is only honored when If-Range still matches the file"""
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None:
+        return int(if_range.date.timestamp()) == mtime // 1_000_000_000
+    return True
+
+
+def call_on_close(response, func):
+    """Run func once the server has closed response
+
+    Werkzeug hands direct passthrough bodies, like the ones send_range and
+    send_file make, to the server as they are, so Response.call_on_close
+    callbacks never run for them. Their bodies' own close() is chained
+    instead, which keeps wsgi.file_wrapper bodies usable for sendfile.
+    """
+    if not response.direct_passthrough:
+        response.call_on_close(func)
+        return
+
+    body = response.response
+    close = getattr(body, "close", None)
+    if close is not None:
+
+        def closeAndCall():
+            try:
+                close()
+            finally:
+                func()
+
+        try:
+            body.close = closeAndCall
+            return
+        except AttributeError:
+            # Generators and other builtins
+            pass
+    response.response = ClosingIterator(body, func)
+
+
+def make_etag(size, mtime):
+    return f"{mtime:x}-{size:x}"
+
+
+def send_range(
+    path,
+    stat=None,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    use_sendfile=True,
+    mimetype=None,
+    chunk_cache=None,
+    use_mmap=False,
+):
+    """Serve path honoring Range, If-Range and If-None-Match
+
+    stat is an object with size and mtime (in ns) attributes. When it is not
+    given the file is stat'ed directly. mimetype is guessed from the file
+    name unless it is given. Single ranges and whole files are
+    handed to the server's wsgi.file_wrapper when one is available so
+    servers like gunicorn can use os.sendfile. When a chunk_cache is given
+    the body is read through it instead, and with use_mmap it is sliced out
+    of the file mapped into memory.
+    """
+    if stat is None:
+        os_stat = os.stat(path)
+        stat = FileStat(os_stat.st_size, os_stat.st_mtime_ns)
+    size, mtime = stat.size, stat.mtime
+
+    if mimetype is None:
+        mimetype = mimetypes.guess_type(str(path))[0] or "application/octet-stream"
+    read = _reader(path, stat, chunk_size, chunk_cache, use_mmap)
+    # Only plain files can be handed to the server's sendfile
+    use_sendfile = use_sendfile and chunk_cache is None and not use_mmap
+
+    etag = make_etag(size, mtime)
+    headers = {
+        "ETag": f'"{etag}"',
+        "Last-Modified": http_date(mtime // 1_000_000_000),
+    }
+
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+    # If-None-Match takes precedence, so only dates are compared without it
+    if_modified_since = request.if_modified_since
+    if (
+        not request.if_none_match
+        and if_modified_since is not None
+        and int(if_modified_since.timestamp()) >= mtime // 1_000_000_000
+    ):
+        return Response(status=304, headers=headers)
+
+    byte_range = request.range
+    if byte_range is not None and not _ifRangeMatches(etag, mtime):
+        byte_range = None
+
+    if byte_range is None or byte_range.units != "bytes":
+        return _sendFile(
+            path, 0, size, 200, mimetype, headers, chunk_size, use_sendfile, read
+        )
+
+    ranges = _resolveRanges(byte_range, size)
+    if not ranges:
+        headers["Content-Range"] = f"bytes */{size}"
+        return Response(status=416, headers=headers)
+
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+        return _sendFile(
+            path, start, stop, 206, mimetype, headers, chunk_size, use_sendfile, read
+        )
+
+    boundary = secrets.token_hex(16)
+    parts = []
+    length = 0
+    for start, stop in ranges:
+        header = (
+            f"--{boundary}\r\n"
+            f"Content-Type: {mimetype}\r\n"
+            f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n"
+        ).encode("ascii")
+        parts.append((header, start, stop))
+        length += len(header) + (stop - start) + 2
+    closing = f"--{boundary}--\r\n".encode("ascii")
+    length += len(closing)
+
+    def body():
+        yield from _iterMultipart(parts, read)
+        yield closing
+
+    headers["Content-Length"] = str(length)
+    return Response(
+        body(),
+        status=206,
+        headers=headers,
+        mimetype=f"multipart/byteranges; boundary={boundary}",
+        direct_passthrough=True,
+    )
+
+
+def _sendFile(
+    path, start, stop, status, mimetype, headers, chunk_size, use_sendfile, read
+):
+    headers["Content-Length"] = str(stop - start)
+
+    file_wrapper = request.environ.get("wsgi.file_wrapper")
+    if use_sendfile and file_wrapper is not None:
+        # The server sends Content-Length bytes from the current file position
+        # and, as PEP 3333 requires of file wrappers, closes the file when it
+        # closes the wrapper. Servers that read the file instead of using
+        # sendfile stop at the end of the range.
+        f = open(path, "rb")
+        f.seek(start)
+        return Response(
+            file_wrapper(_BoundedFile(f, stop), chunk_size),
+            status=status,
+            headers=headers,
+            mimetype=mimetype,
+            direct_passthrough=True,
+        )
+
+    return Response(
+        read(start, stop),
+        status=status,
+        headers=headers,
+        mimetype=mimetype,
+        direct_passthrough=True,
+    )
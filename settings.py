@@ -1,4 +1,5 @@
 import os
+import tempfile
 from pathlib import Path
 from distutils.util import strtobool
 
@@ -7,6 +8,62 @@ HOST = os.getenv("MW_HOST", "127.0.0.1")
 PORT = int(os.getenv("MW_PORT", 5000))
 USE_NGINX = strtobool(os.getenv("MW_USE_NGINX", "true").lower())
 
+# Used when files are sent by Flask rather than NGINX. Ranges are copied out
+# of the file mapped into memory instead of read() chunk by chunk. Bodies are
+# still bytes, so every chunk is copied once.
+USE_MMAP = strtobool(os.getenv("MW_USE_MMAP", "false").lower())
+
+# Used when files are sent by Flask rather than NGINX. Sendfile is only used
+# when the server provides wsgi.file_wrapper (e.g. gunicorn).
+USE_SENDFILE = strtobool(os.getenv("MW_USE_SENDFILE", "true").lower())
+RANGE_CHUNK_SIZE = int(os.getenv("MW_RANGE_CHUNK_SIZE", 1024 * 1024))  # in bytes
+
+# Copy the parts of media files that are read to a local disk tier in
+# chunks so popular files are not re-read from network storage. Sendfile is
+# not used for files sent through the chunk cache.
+CHUNK_CACHE = strtobool(os.getenv("MW_CHUNK_CACHE", "false").lower())
+CHUNK_CACHE_SIZE = int(os.getenv("MW_CHUNK_CACHE_SIZE", 10 * 1024**3))  # in bytes
+CHUNK_CACHE_CHUNK_SIZE = int(
+    os.getenv("MW_CHUNK_CACHE_CHUNK_SIZE", 4 * 1024 * 1024)
+)  # in bytes
+CHUNK_CACHE_READAHEAD = int(os.getenv("MW_CHUNK_CACHE_READAHEAD", 2))  # in chunks
+CHUNK_CACHE_EVICT_INTERVAL = int(
+    os.getenv("MW_CHUNK_CACHE_EVICT_INTERVAL", 30)
+)  # in secs
+CHUNK_CACHE_PATH = (
+    Path(os.getenv("MW_CHUNK_CACHE_PATH"))
+    if os.getenv("MW_CHUNK_CACHE_PATH")
+    else Path(tempfile.gettempdir()) / "mediawaiter-chunks"
+)
+
+# Offer HLS streams remuxed from the mp4s by ffmpeg (no re-encoding).
+# Remuxed segments are kept on disk and evicted least recently used first
+# once they take up more than HLS_CACHE_SIZE.
+USE_HLS = strtobool(os.getenv("MW_USE_HLS", "false").lower())
+FFMPEG_PATH = os.getenv("MW_FFMPEG_PATH", "ffmpeg")
+HLS_SEGMENT_DURATION = int(os.getenv("MW_HLS_SEGMENT_DURATION", 6))  # in secs
+HLS_CACHE_SIZE = int(os.getenv("MW_HLS_CACHE_SIZE", 20 * 1024**3))  # in bytes
+HLS_CACHE_PATH = (
+    Path(os.getenv("MW_HLS_CACHE_PATH"))
+    if os.getenv("MW_HLS_CACHE_PATH")
+    else Path(tempfile.gettempdir()) / "mediawaiter-hls"
+)
+
+# Make poster thumbnails and seek preview sprite sheets of streamable files
+# with ffmpeg in the background. Thumbnails are kept on disk and evicted
+# least recently used first once they take up more than THUMBNAIL_CACHE_SIZE.
+USE_THUMBNAILS = strtobool(os.getenv("MW_USE_THUMBNAILS", "false").lower())
+THUMBNAIL_WORKERS = int(os.getenv("MW_THUMBNAIL_WORKERS", 2))  # ffmpeg processes
+THUMBNAIL_INTERVAL = int(os.getenv("MW_THUMBNAIL_INTERVAL", 10))  # in secs
+THUMBNAIL_CACHE_SIZE = int(os.getenv("MW_THUMBNAIL_CACHE_SIZE", 1024**3))  # in bytes
+THUMBNAIL_QUEUE_SIZE = int(os.getenv("MW_THUMBNAIL_QUEUE_SIZE", 64))  # in files
+THUMBNAIL_FAILURE_TTL = int(os.getenv("MW_THUMBNAIL_FAILURE_TTL", 3600))  # in secs
+THUMBNAIL_CACHE_PATH = (
+    Path(os.getenv("MW_THUMBNAIL_CACHE_PATH"))
+    if os.getenv("MW_THUMBNAIL_CACHE_PATH")
+    else Path(tempfile.gettempdir()) / "mediawaiter-thumbnails"
+)
+
 MINIMUM_FILE_SIZE = int(os.getenv("MW_MINIMUM_FILE_SIZE", 20_000_000))
 
 REPO_DIR = Path(os.path.dirname(os.path.abspath(__file__)))
@@ -88,6 +145,125 @@ GOOGLE_CAST_APP_ID = os.getenv("MW_GOOGLE_CAST_APP_ID", "insert cast SDK ID here
 MEDIAWAITER_PROTOCOL = os.getenv("MW_MEDIAWAITER_PROTOCOL", "https://")
 
 REQUESTS_TIMEOUT = 3  # in secs
+TOKEN_REQUESTS_TIMEOUT = float(
+    os.getenv("MW_TOKEN_REQUESTS_TIMEOUT", REQUESTS_TIMEOUT)
+)  # in secs
+OFFSET_REQUESTS_TIMEOUT = float(
+    os.getenv("MW_OFFSET_REQUESTS_TIMEOUT", REQUESTS_TIMEOUT)
+)  # in secs
+METADATA_REQUESTS_TIMEOUT = float(
+    os.getenv("MW_METADATA_REQUESTS_TIMEOUT", REQUESTS_TIMEOUT)
+)  # in secs
+VIEWED_REQUESTS_TIMEOUT = float(
+    os.getenv("MW_VIEWED_REQUESTS_TIMEOUT", REQUESTS_TIMEOUT)
+)  # in secs
+
+# Connection pool shared by all MediaViewer calls made from a worker
+REQUESTS_POOL_SIZE = int(os.getenv("MW_REQUESTS_POOL_SIZE", 10))
+REQUESTS_KEEP_ALIVE = strtobool(os.getenv("MW_REQUESTS_KEEP_ALIVE", "true").lower())
+
+# Offset updates from the player are buffered and sent to MediaViewer in
+# batches every OFFSET_FLUSH_INTERVAL seconds. Set to 0 to write through.
+OFFSET_FLUSH_INTERVAL = int(os.getenv("MW_OFFSET_FLUSH_INTERVAL", 10))  # in secs
+
+# Request, MediaViewer, cache and send path metrics served from /metrics
+# to requests bearing METRICS_TOKEN. Every worker writes its values to
+# METRICS_PATH every METRICS_FLUSH_INTERVAL seconds and /metrics adds them
+# up. The route is disabled when METRICS_TOKEN is empty.
+METRICS = strtobool(os.getenv("MW_METRICS", "true").lower())
+METRICS_TOKEN = os.getenv("MW_METRICS_TOKEN", "")
+METRICS_FLUSH_INTERVAL = int(os.getenv("MW_METRICS_FLUSH_INTERVAL", 5))  # in secs
+METRICS_PATH = (
+    Path(os.getenv("MW_METRICS_PATH"))
+    if os.getenv("MW_METRICS_PATH")
+    else Path(tempfile.gettempdir()) / "mediawaiter-metrics"
+)
+
+# Record spans for the stages of sampled requests and append them as
+# Chrome trace events to a file per worker under TRACE_PATH. Requests
+# faster than TRACE_MIN_DURATION are not written.
+TRACING = strtobool(os.getenv("MW_TRACING", "false").lower())
+TRACE_SAMPLE_RATE = float(os.getenv("MW_TRACE_SAMPLE_RATE", 1.0))
+TRACE_MIN_DURATION = float(os.getenv("MW_TRACE_MIN_DURATION", 0))  # in secs
+TRACE_MAX_SIZE = int(
+    os.getenv("MW_TRACE_MAX_SIZE", 100 * 1024 * 1024)
+)  # in bytes per worker
+TRACE_PATH = (
+    Path(os.getenv("MW_TRACE_PATH"))
+    if os.getenv("MW_TRACE_PATH")
+    else Path(tempfile.gettempdir()) / "mediawaiter-traces"
+)
+
+# Sampling profiles of a live worker, returned as collapsed stacks from
+# /admin/profile to requests bearing PROFILE_TOKEN, or written to
+# PROFILE_PATH for PROFILE_SIGNAL_DURATION seconds when a worker receives
+# SIGUSR2. The route is disabled when PROFILE_TOKEN is empty.
+PROFILE_TOKEN = os.getenv("MW_PROFILE_TOKEN", "")
+PROFILE_INTERVAL = float(os.getenv("MW_PROFILE_INTERVAL", 0.01))  # in secs
+PROFILE_MAX_DURATION = int(os.getenv("MW_PROFILE_MAX_DURATION", 25))  # in secs
+PROFILE_SIGNAL_DURATION = int(os.getenv("MW_PROFILE_SIGNAL_DURATION", 10))  # in secs
+PROFILE_PATH = (
+    Path(os.getenv("MW_PROFILE_PATH"))
+    if os.getenv("MW_PROFILE_PATH")
+    else Path(tempfile.gettempdir()) / "mediawaiter-profiles"
+)
+
+# Once a binge watcher is PREFETCH_NEXT_AT of the way through an episode
+# the media index, hash table, subtitles and first PREFETCH_NEXT_BYTES of
+# the next episode are warmed in the background. Set to 0 to disable.
+PREFETCH_NEXT_AT = float(os.getenv("MW_PREFETCH_NEXT_AT", 0.8))  # fraction watched
+PREFETCH_NEXT_BYTES = int(
+    os.getenv("MW_PREFETCH_NEXT_BYTES", 16 * 1024 * 1024)
+)  # in bytes
+
+# Threads per worker used to run independent MediaViewer calls concurrently
+UPSTREAM_WORKERS = int(os.getenv("MW_UPSTREAM_WORKERS", 4))
+
+# Download tokens are cached per GUID to avoid a MediaViewer round trip on
+# every request. Invalid GUIDs are cached for a shorter period.
+TOKEN_CACHE_TTL = int(os.getenv("MW_TOKEN_CACHE_TTL", 30))  # in secs
+TOKEN_CACHE_NEGATIVE_TTL = int(os.getenv("MW_TOKEN_CACHE_NEGATIVE_TTL", 5))  # in secs
+TOKEN_CACHE_SIZE = int(os.getenv("MW_TOKEN_CACHE_SIZE", 1024))
+METADATA_CACHE_TTL = int(os.getenv("MW_METADATA_CACHE_TTL", 300))  # in secs
+METADATA_CACHE_SIZE = int(os.getenv("MW_METADATA_CACHE_SIZE", 1024))
+
+# Directory listings are revalidated by directory mtime on every request and
+# fully rescanned after this many seconds
+MEDIA_INDEX_MAX_AGE = int(os.getenv("MW_MEDIA_INDEX_MAX_AGE", 300))  # in secs
+
+# Keep the media index current with a filesystem watcher so requests do not
+# have to stat directories. One of "none", "poll", "inotify" or "auto".
+# inotify does not see changes made by other hosts on network filesystems so
+# use "poll" there.
+MEDIA_WATCHER = os.getenv("MW_MEDIA_WATCHER", "none").lower()
+MEDIA_WATCH_INTERVAL = int(os.getenv("MW_MEDIA_WATCH_INTERVAL", 30))  # in secs
+
+# Number of hash-to-path lookup tables kept per worker
+HASH_TABLE_CACHE_SIZE = int(os.getenv("MW_HASH_TABLE_CACHE_SIZE", 256))
+
+# Number of hashed waiter paths memoized per worker
+HASH_CACHE_SIZE = int(os.getenv("MW_HASH_CACHE_SIZE", 16384))
+
+# mp4 layout and duration parsed from each file's box headers.
+# Entries are keyed by file size and mtime so they never go stale
+MP4_INFO_CACHE_SIZE = int(os.getenv("MW_MP4_INFO_CACHE_SIZE", 16384))
+MP4_INFO_CACHE_TTL = int(os.getenv("MW_MP4_INFO_CACHE_TTL", 7 * 24 * 3600))  # in secs
+
+# Rendered navigation and file list fragments kept per worker. Entries are
+# keyed by the data they were rendered from so they never go stale
+FRAGMENT_CACHE_SIZE = int(os.getenv("MW_FRAGMENT_CACHE_SIZE", 512))
+FRAGMENT_CACHE_TTL = int(os.getenv("MW_FRAGMENT_CACHE_TTL", 3600))  # in secs
+
+# Cache backend used for tokens and MediaViewer metadata. "local" keeps a
+# separate cache in every worker. "sqlite" shares a single database file
+# between all gunicorn workers on one host. It is not shared between hosts so
+# CACHE_PATH should be on local disk.
+CACHE_BACKEND = os.getenv("MW_CACHE_BACKEND", "local").lower()
+CACHE_PATH = (
+    Path(os.getenv("MW_CACHE_PATH"))
+    if os.getenv("MW_CACHE_PATH")
+    else Path(tempfile.gettempdir()) / "mediawaiter-cache.sqlite3"
+)
 
 DEFAULT_THEME = "dark"
 
@@ -266,6 +266,55 @@ function hasScrolled(){
 
 }
 
+function setupSeekPreviews(player, thumbnailsUrl){
+    if(!thumbnailsUrl){
+        return;
+    }
+
+    var tracks = player.textTracks();
+    var track = null;
+    for(var i = 0; i < tracks.length; i++){
+        if(tracks[i].kind == 'metadata' && tracks[i].label == 'thumbnails'){
+            track = tracks[i];
+        }
+    }
+    if(!track){
+        return;
+    }
+    track.mode = 'hidden'; // Load the cues without displaying them
+
+    var progress = player.controlBar.progressControl;
+    var preview = document.createElement('div');
+    preview.className = 'seek-preview';
+    progress.el().appendChild(preview);
+
+    progress.on('mousemove', function(e){
+        var rect = progress.el().getBoundingClientRect();
+        var percent = Math.min(Math.max((e.clientX - rect.left) / rect.width, 0), 1);
+        var time = percent * player.duration();
+        var cues = track.cues || [];
+        for(var i = 0; i < cues.length; i++){
+            if(cues[i].startTime <= time && time < cues[i].endTime){
+                // Cues look like sprite.jpg#xywh=x,y,width,height
+                var parts = cues[i].text.split('#xywh=');
+                var xywh = parts[1].split(',');
+                preview.style.backgroundImage = 'url(' + new URL(parts[0], thumbnailsUrl) + ')';
+                preview.style.backgroundPosition = '-' + xywh[0] + 'px -' + xywh[1] + 'px';
+                preview.style.width = xywh[2] + 'px';
+                preview.style.height = xywh[3] + 'px';
+                preview.style.left = (e.clientX - rect.left - xywh[2] / 2) + 'px';
+                preview.style.display = 'block';
+                return;
+            }
+        }
+        preview.style.display = 'none';
+    });
+
+    progress.on('mouseleave', function(){
+        preview.style.display = 'none';
+    });
+}
+
 function scrollSetup(){
     $(window).scroll(function (event) {
         didScroll = true;
@@ -27,3 +27,17 @@ def temp_directory(tmp_path, counter):
 def patch_logger(mocker):
     mocker.patch("utils.logger")
     mocker.patch("waiter.logger")
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    from waiter import token_cache, hash_tables, mp4_info_cache
+    from utils import metadata_cache
+    from fragments import fragment_cache
+
+    caches = (token_cache, hash_tables, mp4_info_cache, metadata_cache, fragment_cache)
+    for cache in caches:
+        cache.clear()
+    yield
+    for cache in caches:
+        cache.clear()
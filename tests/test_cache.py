@@ -0,0 +1,177 @@
+import sqlite3
+import pytest
+from cache import TTLCache, SQLiteCache, get_cache, MISSING
+
+
+class TestTTLCache:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        self.mock_monotonic = mocker.patch("cache.time.monotonic")
+        self.mock_monotonic.return_value = 100
+
+        self.cache = TTLCache(maxsize=2, ttl=10)
+
+    def test_missing(self):
+        assert self.cache.get("key", MISSING) is MISSING
+
+    def test_set_and_get(self):
+        self.cache.set("key", "value")
+        assert self.cache.get("key") == "value"
+
+    def test_expired(self):
+        self.cache.set("key", "value")
+        self.mock_monotonic.return_value = 110
+
+        assert self.cache.get("key") is None
+        assert len(self.cache) == 0
+
+    def test_per_entry_ttl(self):
+        self.cache.set("key", "value", ttl=20)
+        self.mock_monotonic.return_value = 115
+
+        assert self.cache.get("key") == "value"
+
+    def test_caches_falsy_values(self):
+        self.cache.set("key", {})
+        assert self.cache.get("key", MISSING) == {}
+
+    def test_lru_eviction(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.get("a")
+        self.cache.set("c", 3)
+
+        assert self.cache.get("a") == 1
+        assert self.cache.get("b") is None
+        assert self.cache.get("c") == 3
+
+    def test_delete(self):
+        self.cache.set("key", "value")
+        self.cache.delete("key")
+        self.cache.delete("not_there")
+
+        assert self.cache.get("key") is None
+
+    def test_named_cache_counts_lookups(self, mocker):
+        mock_inc = mocker.patch("cache.metrics.inc")
+        cache = TTLCache(maxsize=2, ttl=10, name="tokens")
+        cache.set("key", "value")
+
+        cache.get("key")
+        cache.get("other")
+
+        assert mock_inc.call_args_list == [
+            mocker.call(
+                "mediawaiter_cache_requests_total", cache="tokens", result="hit"
+            ),
+            mocker.call(
+                "mediawaiter_cache_requests_total", cache="tokens", result="miss"
+            ),
+        ]
+
+    def test_unnamed_cache_is_not_counted(self, mocker):
+        mock_inc = mocker.patch("cache.metrics.inc")
+
+        self.cache.get("key")
+
+        assert not mock_inc.called
+
+
+class TestSQLiteCache:
+    @pytest.fixture(autouse=True)
+    def setUp(self, temp_directory):
+        self.path = temp_directory / "cache.sqlite3"
+        self.cache = SQLiteCache(self.path, "test", maxsize=2, ttl=10)
+
+    def test_missing(self):
+        assert self.cache.get("key", MISSING) is MISSING
+
+    def test_set_and_get(self):
+        self.cache.set("key", {"isvalid": True})
+        assert self.cache.get("key") == {"isvalid": True}
+
+    def test_shared_between_instances(self):
+        other = SQLiteCache(self.path, "test")
+        self.cache.set("key", "value")
+
+        assert other.get("key") == "value"
+
+    def test_namespaces_are_separate(self):
+        other = SQLiteCache(self.path, "other")
+        self.cache.set("key", "value")
+        other.clear()
+
+        assert other.get("key") is None
+        assert self.cache.get("key") == "value"
+
+    def test_expired(self):
+        self.cache.set("key", "value", ttl=0)
+        assert self.cache.get("key") is None
+
+    def test_size_cap(self):
+        self.cache.prune_interval = 0
+        self.cache.set("a", 1, ttl=10)
+        self.cache.set("b", 2, ttl=20)
+        self.cache.set("c", 3, ttl=30)
+
+        assert len(self.cache) == 2
+        assert self.cache.get("a") is None
+
+    def test_prunes_on_interval(self, mocker):
+        mock_time = mocker.patch("cache.time")
+        mock_time.time.return_value = 100
+        self.cache.set("a", 1, ttl=100)
+        self.cache.set("b", 2, ttl=200)
+        self.cache.set("c", 3, ttl=300)
+
+        assert len(self.cache) == 3
+
+        mock_time.time.return_value = 130
+        self.cache.set("d", 4, ttl=300)
+
+        assert len(self.cache) == 2
+        assert self.cache.get("b") is None
+
+    def test_len_error(self, mocker):
+        mocker.patch.object(
+            self.cache, "_connection", side_effect=sqlite3.OperationalError("locked")
+        )
+        mock_logger = mocker.patch("cache.logger")
+
+        assert len(self.cache) == 0
+        assert mock_logger.return_value.error.called
+
+    def test_delete(self):
+        self.cache.set("key", "value")
+        self.cache.delete("key")
+
+        assert self.cache.get("key") is None
+
+    def test_counts_lookups(self, mocker):
+        mock_inc = mocker.patch("cache.metrics.inc")
+        self.cache.set("key", "value")
+
+        self.cache.get("key")
+        self.cache.get("other")
+
+        assert [call.kwargs["result"] for call in mock_inc.call_args_list] == [
+            "hit",
+            "miss",
+        ]
+        assert mock_inc.call_args.kwargs["cache"] == "test"
+
+
+class TestGetCache:
+    def test_local(self, mocker):
+        mocker.patch("cache.CACHE_BACKEND", "local")
+        assert isinstance(get_cache("test"), TTLCache)
+
+    def test_sqlite(self, mocker, temp_directory):
+        mocker.patch("cache.CACHE_BACKEND", "sqlite")
+        mocker.patch("cache.CACHE_PATH", temp_directory / "cache.sqlite3")
+        assert isinstance(get_cache("test"), SQLiteCache)
+
+    def test_unknown(self, mocker):
+        mocker.patch("cache.CACHE_BACKEND", "redis")
+        with pytest.raises(ValueError):
+            get_cache("test")
@@ -0,0 +1,197 @@
+import fcntl
+import os
+import time
+import pytest
+from flask import Flask
+from chunk_cache import LOCK_NAME, ChunkCache
+from media_index import FileStat
+from ranges import send_range
+
+DATA = bytes(range(256)) * 40
+
+app = Flask(__name__)
+
+
+def _wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+class TestChunkCache:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_directory):
+        mocker.patch("chunk_cache.logger")
+        self.dir = temp_directory
+        self.source = self.dir / "video.mp4"
+        self.source.write_bytes(DATA)
+        self.stat = FileStat(len(DATA), 1)
+        self.cache = ChunkCache(
+            self.dir / "chunks", max_size=100_000, chunk_size=1000, readahead=0
+        )
+
+    def _chunks(self):
+        return sorted(
+            path.name
+            for path in (self.dir / "chunks").rglob("*")
+            if path.is_file() and path.name != LOCK_NAME
+        )
+
+    def test_iter_range(self):
+        actual = b"".join(self.cache.iter_range(self.source, self.stat, 1500, 3200))
+
+        assert actual == DATA[1500:3200]
+        assert self._chunks() == ["00000001", "00000002", "00000003"]
+
+    def test_iter_range_to_end(self):
+        actual = b"".join(
+            self.cache.iter_range(self.source, self.stat, 9000, len(DATA))
+        )
+
+        assert actual == DATA[9000:]
+        assert self._chunks() == ["00000009", "00000010"]
+
+    def test_cached_chunks_are_not_reread(self):
+        b"".join(self.cache.iter_range(self.source, self.stat, 0, 1000))
+        self.source.write_bytes(b"\0" * len(DATA))
+
+        actual = b"".join(self.cache.iter_range(self.source, self.stat, 0, 1000))
+
+        assert actual == DATA[:1000]
+
+    def test_changed_file_is_reread(self):
+        b"".join(self.cache.iter_range(self.source, self.stat, 0, 1000))
+        self.source.write_bytes(b"\0" * len(DATA))
+
+        actual = b"".join(
+            self.cache.iter_range(self.source, FileStat(len(DATA), 2), 0, 1000)
+        )
+
+        assert actual == b"\0" * 1000
+
+    def test_short_read_is_not_cached(self):
+        self.source.write_bytes(DATA[:1500])
+
+        actual = b"".join(self.cache.iter_range(self.source, self.stat, 1000, 2000))
+
+        assert actual == DATA[1000:1500]
+        assert self._chunks() == []
+
+    def test_short_chunk_ends_range(self):
+        b"".join(self.cache.iter_range(self.source, self.stat, 2000, 3000))
+        self.source.write_bytes(DATA[:1500])
+
+        actual = b"".join(self.cache.iter_range(self.source, self.stat, 1200, 3000))
+
+        assert actual == DATA[1200:1500]
+
+    def test_readahead(self):
+        self.cache.readahead = 2
+
+        b"".join(self.cache.iter_range(self.source, self.stat, 0, 1000))
+
+        _wait_for(lambda: len(self._chunks()) == 3)
+        assert self._chunks() == ["00000000", "00000001", "00000002"]
+
+    def test_readahead_stops_at_end_of_file(self):
+        self.cache.readahead = 5
+
+        b"".join(self.cache.iter_range(self.source, self.stat, 10000, len(DATA)))
+
+        _wait_for(lambda: not self.cache._prefetching)
+        assert self._chunks() == ["00000010"]
+
+    def test_evict_least_recently_read(self):
+        self.cache.max_size = 3000
+        for index in range(4):
+            self.cache.get_chunk(self.source, self.stat, index)
+        os.utime(self.cache._chunkPath(self.source, self.stat, 0), (1, 1))
+        os.utime(self.cache._chunkPath(self.source, self.stat, 1), (2, 2))
+
+        self.cache.evict()
+
+        assert self._chunks() == ["00000002", "00000003"]
+
+    def test_evict_counts_chunks_written_by_other_workers(self):
+        other = ChunkCache(self.dir / "chunks", max_size=100_000, chunk_size=1000)
+        for index in range(3):
+            other.get_chunk(self.source, self.stat, index)
+        self.cache.max_size = 2000
+
+        self.cache.evict()
+
+        assert len(self._chunks()) == 1
+
+    def test_evict_prunes_empty_directories(self):
+        self.cache.get_chunk(self.source, self.stat, 0)
+        self.cache.max_size = 0
+
+        self.cache.evict()
+
+        assert [path.name for path in (self.dir / "chunks").iterdir()] == [LOCK_NAME]
+
+        actual = self.cache.get_chunk(self.source, self.stat, 0)
+        assert actual == DATA[:1000]
+        assert self._chunks() == ["00000000"]
+
+    def test_evict_skipped_while_another_worker_evicts(self):
+        self.cache.get_chunk(self.source, self.stat, 0)
+        self.cache.max_size = 0
+        fd = os.open(self.dir / "chunks" / LOCK_NAME, os.O_RDWR | os.O_CREAT)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            self.cache.evict()
+        finally:
+            os.close(fd)
+
+        assert self._chunks() == ["00000000"]
+
+    def test_writes_evict_in_the_background(self, mocker):
+        mock_evict = mocker.patch.object(self.cache, "evict")
+        self.cache._evict_after = 0
+
+        for index in range(3):
+            self.cache.get_chunk(self.source, self.stat, index)
+
+        _wait_for(lambda: not self.cache._evicting)
+        mock_evict.assert_called_once_with()
+
+
+class TestSendRangeWithChunkCache:
+    @pytest.fixture(autouse=True)
+    def setUp(self, temp_directory):
+        self.path = temp_directory / "video.mp4"
+        self.path.write_bytes(DATA)
+        self.stat = FileStat(len(DATA), 1)
+        self.cache = ChunkCache(
+            temp_directory / "chunks", max_size=100_000, chunk_size=1000, readahead=0
+        )
+
+    def _send(self, headers=None):
+        with app.test_request_context(
+            headers=headers or {}, environ_base={"wsgi.file_wrapper": None}
+        ):
+            response = send_range(self.path, stat=self.stat, chunk_cache=self.cache)
+            body = b"".join(response.response)
+        return response, body
+
+    def test_full_file(self):
+        response, body = self._send()
+
+        assert response.status_code == 200
+        assert body == DATA
+
+    def test_single_range(self):
+        response, body = self._send({"Range": "bytes=10-2009"})
+
+        assert response.status_code == 206
+        assert response.headers["Content-Length"] == "2000"
+        assert body == DATA[10:2010]
+
+    def test_multiple_ranges(self):
+        response, body = self._send({"Range": "bytes=0-9,5000-5009"})
+
+        assert response.status_code == 206
+        assert DATA[0:10] in body
+        assert DATA[5000:5010] in body
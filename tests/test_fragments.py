@@ -0,0 +1,122 @@
+import fragments
+import pytest
+from flask import render_template
+from fragments import fragment_cache, render_file_rows, render_navigation
+from waiter import app
+
+
+def _file(filename, hasProgress=False, guid="guid"):
+    return {
+        "filename": filename,
+        "streamingPath": f"/waiter/stream/{guid}/{filename}-hash/",
+        "hashedWaiterPath": f"{filename}-hash",
+        "streamable": True,
+        "hasProgress": hasProgress,
+        "size": "1.2 GB",
+    }
+
+
+class TestRenderFileRows:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        self.spy_get_template_attribute = mocker.spy(
+            fragments, "get_template_attribute"
+        )
+
+    def test_renders_rows(self):
+        with app.app_context():
+            html = render_file_rows(
+                [_file("Episode 1"), _file("Episode 2", True)], "guid"
+            )
+
+        assert html.count("<tr>") == 2
+        assert "Episode 1" in html
+        assert "Start&nbsp;Over" in html
+
+    def test_identical_files_are_rendered_once(self):
+        with app.app_context():
+            first = render_file_rows([_file("Episode 1")], "guid")
+            second = render_file_rows([_file("Episode 1")], "guid")
+
+        assert first == second
+        assert self.spy_get_template_attribute.call_count == 1
+        assert len(fragment_cache) == 1
+
+    def test_progress_change_renders_again(self):
+        with app.app_context():
+            first = render_file_rows([_file("Episode 1")], "guid")
+            second = render_file_rows([_file("Episode 1", hasProgress=True)], "guid")
+
+        assert first != second
+        assert self.spy_get_template_attribute.call_count == 2
+
+    def test_shared_between_guids(self):
+        def files(guid):
+            file = _file("Episode 1", guid=guid)
+            file["thumbnailPath"] = f"/waiter/thumb/{guid}/Episode 1-hash"
+            return [file]
+
+        with app.app_context():
+            first = render_file_rows(files("first"), "first")
+            second = render_file_rows(files("second"), "second")
+
+        assert self.spy_get_template_attribute.call_count == 1
+        assert "/waiter/stream/first/Episode 1-hash/" in first
+        assert "/waiter/thumb/first/Episode 1-hash" in first
+        assert "/waiter/stream/second/Episode 1-hash/" in second
+        assert "first" not in second
+        assert fragments.GUID_PLACEHOLDER not in first + second
+        (key,) = fragment_cache._data
+        assert "first" not in repr(key)
+
+
+class TestRenderNavigation:
+    def test_shared_between_calls(self, mocker):
+        spy = mocker.spy(fragments, "get_template_attribute")
+        args = (
+            "BASE_URL",
+            True,
+            [("Collection", "BASE_URL/collections/1/")],
+            [("Action", "BASE_URL/movies/genre/1/")],
+            [("Drama", "BASE_URL/tvshows/genre/2/")],
+        )
+
+        with app.app_context():
+            first = render_navigation(*args)
+            second = render_navigation(*args)
+
+        assert first == second
+        assert "Collection" in first
+        assert "Action" in first
+        assert "Drama" in first
+        assert spy.call_count == 1
+
+
+class TestDisplayTemplate:
+    def test_renders_fragments(self):
+        with app.test_request_context():
+            html = render_template(
+                "display.html",
+                title="Some Show",
+                files=[_file("Episode 1")],
+                username="user",
+                mediaviewer_base_url="BASE_URL",
+                ismovie=False,
+                tv_id=1,
+                tv_name="Some Show",
+                guid="guid",
+                offsetUrl="OFFSET_URL",
+                next_link=None,
+                previous_link=None,
+                tv_genres=[("Drama", "BASE_URL/tvshows/genre/2/")],
+                movie_genres=[],
+                collections=[],
+                binge_mode=False,
+                donation_site_name="",
+                donation_site_url="",
+                theme="dark",
+            )
+
+        assert "Signed in as" in html
+        assert "Drama" in html
+        assert "Episode 1-hash" in html
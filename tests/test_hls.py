@@ -0,0 +1,138 @@
+import fcntl
+import os
+import sys
+import time
+import pytest
+from hls import COMPLETE_NAME, LOCK_NAME, PLAYLIST_NAME, SegmentCache
+from media_index import FileStat
+
+FAKE_FFMPEG = """\
+import pathlib
+import sys
+
+args = sys.argv[1:]
+with open({calls!r}, "a") as f:
+    f.write(" ".join(args) + "\\n")
+if {fail!r}:
+    sys.stderr.write("boom")
+    sys.exit(1)
+
+segment = args[args.index("-hls_segment_filename") + 1]
+playlist = pathlib.Path(args[-1])
+for i in range(2):
+    pathlib.Path(segment % i).write_bytes(b"x" * 100)
+playlist.write_text("#EXTM3U\\n#EXTINF:6.0,\\nseg00000.ts\\n#EXTINF:6.0,\\nseg00001.ts\\n")
+"""
+
+
+def _wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+class TestSegmentCache:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_directory):
+        mocker.patch("hls.logger")
+        self.dir = temp_directory
+        self.calls = self.dir / "calls.txt"
+        self.source = self.dir / "movie.mp4"
+        self.source.write_bytes(b"x" * 1000)
+        self.stat = FileStat(1000, 1)
+
+    def _cache(self, fail=False, max_size=10_000):
+        ffmpeg = self.dir / "ffmpeg"
+        ffmpeg.write_text(
+            f"#!{sys.executable}\n"
+            + FAKE_FFMPEG.format(calls=str(self.calls), fail=fail)
+        )
+        ffmpeg.chmod(0o755)
+        return SegmentCache(self.dir / "hls", max_size, ffmpeg=str(ffmpeg))
+
+    def _calls(self):
+        return self.calls.read_text().splitlines() if self.calls.exists() else []
+
+    def test_get_playlist(self):
+        cache = self._cache()
+
+        playlist = cache.get_playlist(self.source, self.stat)
+
+        assert playlist.name == PLAYLIST_NAME
+        assert "seg00001.ts" in playlist.read_text()
+        _wait_for(lambda: (playlist.parent / COMPLETE_NAME).exists())
+        assert "-c copy" in self._calls()[0]
+
+    def test_completed_rendition_is_reused(self):
+        cache = self._cache()
+        playlist = cache.get_playlist(self.source, self.stat)
+        _wait_for(lambda: (playlist.parent / COMPLETE_NAME).exists())
+
+        assert cache.get_playlist(self.source, self.stat) == playlist
+        assert len(self._calls()) == 1
+
+    def test_changed_file_gets_new_rendition(self):
+        cache = self._cache()
+
+        first = cache.get_playlist(self.source, self.stat)
+        second = cache.get_playlist(self.source, FileStat(2000, 2))
+
+        assert first.parent != second.parent
+
+    def test_rendition_locked_by_another_process(self):
+        cache = self._cache()
+        directory = cache.directory(self.source, self.stat)
+        directory.mkdir(parents=True)
+        fd = os.open(directory / LOCK_NAME, os.O_RDWR | os.O_CREAT)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            with pytest.raises(TimeoutError):
+                cache.get_playlist(self.source, self.stat, timeout=0.2)
+        finally:
+            os.close(fd)
+
+        assert self._calls() == []
+
+    def test_failed_remux(self):
+        cache = self._cache(fail=True)
+
+        with pytest.raises(Exception):
+            cache.get_playlist(self.source, self.stat)
+
+        assert not cache.directory(self.source, self.stat).exists()
+
+    def test_get_segment(self):
+        cache = self._cache()
+        cache.get_playlist(self.source, self.stat)
+
+        segment = cache.get_segment(self.source, self.stat, "seg00000.ts")
+
+        assert segment.read_bytes() == b"x" * 100
+
+    def test_get_segment_invalid_name(self):
+        cache = self._cache()
+
+        with pytest.raises(ValueError):
+            cache.get_segment(self.source, self.stat, "../../movie.mp4")
+
+    def test_get_missing_segment(self):
+        cache = self._cache()
+        cache.get_playlist(self.source, self.stat)
+
+        with pytest.raises(FileNotFoundError):
+            cache.get_segment(self.source, self.stat, "seg00009.ts")
+
+    def test_evict_least_recently_played(self):
+        cache = self._cache()
+        old = cache.get_playlist(self.source, FileStat(1, 1)).parent
+        new = cache.get_playlist(self.source, FileStat(2, 2)).parent
+        _wait_for(lambda: (old / COMPLETE_NAME).exists())
+        _wait_for(lambda: (new / COMPLETE_NAME).exists())
+        os.utime(old, (1, 1))
+
+        cache.max_size = cache.size(new)
+        cache.evict()
+
+        assert not old.exists()
+        assert new.exists()
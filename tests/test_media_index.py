@@ -0,0 +1,94 @@
+import os
+import pytest
+from media_index import DirectoryEntry, MediaIndex
+
+
+class TestMediaIndex:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_directory):
+        self.dir = temp_directory
+        (self.dir / "movie.mp4").write_bytes(b"x" * 10)
+        (self.dir / "movie.vtt").write_text("WEBVTT")
+        (self.dir / "Extras").mkdir()
+        (self.dir / "Extras" / "extra.mp4").write_bytes(b"x" * 5)
+
+        self.index = MediaIndex(max_age=300)
+        self.scan_spy = mocker.spy(self.index, "_scan")
+
+    def test_get_directory(self):
+        entry = self.index.get_directory(self.dir)
+
+        assert entry.files["movie.mp4"].size == 10
+        assert entry.files["movie.vtt"].size == 6
+        assert entry.subdirs == ("Extras",)
+        assert entry.subtitles == ("movie.vtt",)
+
+    def test_unchanged_directory_is_not_rescanned(self):
+        first = self.index.get_directory(self.dir)
+        second = self.index.get_directory(self.dir)
+
+        assert first is second
+        assert self.scan_spy.call_count == 1
+
+    def test_changed_directory_is_rescanned(self):
+        self.index.get_directory(self.dir)
+
+        (self.dir / "new.mp4").write_bytes(b"x")
+        stat = os.stat(self.dir)
+        os.utime(self.dir, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+        entry = self.index.get_directory(self.dir)
+        assert "new.mp4" in entry.files
+        assert self.scan_spy.call_count == 2
+
+    def test_expired_directory_is_rescanned(self):
+        self.index.max_age = 0
+        self.index.get_directory(self.dir)
+        self.index.get_directory(self.dir)
+
+        assert self.scan_spy.call_count == 2
+
+    def test_invalidate(self):
+        self.index.get_directory(self.dir)
+        self.index.invalidate(self.dir)
+        self.index.get_directory(self.dir)
+
+        assert self.scan_spy.call_count == 2
+
+    def test_walk(self):
+        actual = [
+            (path, sorted(entry.files)) for path, entry in self.index.walk(self.dir)
+        ]
+
+        assert actual == [
+            (self.dir, ["movie.mp4", "movie.vtt"]),
+            (self.dir / "Extras", ["extra.mp4"]),
+        ]
+
+    def test_walk_missing_directory(self):
+        assert list(self.index.walk(self.dir / "missing")) == []
+
+
+class TestDirectoryEntry:
+    def test_subtitles_for(self):
+        entry = DirectoryEntry(
+            mtime=1,
+            scanned=1,
+            files={},
+            subdirs=(),
+            subtitles=(
+                "Show.S01E01.en.vtt",
+                "Show.S01E01.es.vtt",
+                "Show.S01E02.en.vtt",
+                "Show.S01E10.vtt",
+                "Trailer.vtt",
+            ),
+        )
+
+        assert entry.subtitles_for("Show.S01E01") == (
+            "Show.S01E01.en.vtt",
+            "Show.S01E01.es.vtt",
+        )
+        assert entry.subtitles_for("Show.S01E10") == ("Show.S01E10.vtt",)
+        assert entry.subtitles_for("Show.S01E03") == ()
+        assert entry.subtitles_for("Zzz") == ()
@@ -0,0 +1,114 @@
+import json
+import os
+import pytest
+from metrics import Metrics
+
+DEAD_PID = 99999999
+
+
+class TestMetrics:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_directory):
+        mocker.patch("metrics.logger")
+        self.path = temp_directory / "metrics"
+        self.metrics = Metrics(self.path, flush_interval=3600)
+        self.metrics.counter("requests_total", "Requests")
+        self.metrics.histogram("duration_seconds", "Durations", buckets=(0.1, 1))
+
+    def test_counter(self):
+        self.metrics.inc("requests_total", endpoint="video")
+        self.metrics.inc("requests_total", 2, endpoint="video")
+        self.metrics.inc("requests_total", endpoint="hls")
+
+        lines = self.metrics.render().splitlines()
+
+        assert "# TYPE requests_total counter" in lines
+        assert 'requests_total{endpoint="video"} 3' in lines
+        assert 'requests_total{endpoint="hls"} 1' in lines
+
+    def test_histogram(self):
+        self.metrics.observe("duration_seconds", 0.05, endpoint="video")
+        self.metrics.observe("duration_seconds", 0.5, endpoint="video")
+        self.metrics.observe("duration_seconds", 5, endpoint="video")
+
+        lines = self.metrics.render().splitlines()
+
+        assert "# TYPE duration_seconds histogram" in lines
+        assert 'duration_seconds_bucket{endpoint="video",le="0.1"} 1' in lines
+        assert 'duration_seconds_bucket{endpoint="video",le="1"} 2' in lines
+        assert 'duration_seconds_bucket{endpoint="video",le="+Inf"} 3' in lines
+        assert 'duration_seconds_sum{endpoint="video"} 5.55' in lines
+        assert 'duration_seconds_count{endpoint="video"} 3' in lines
+
+    def test_timer(self):
+        with self.metrics.timer("duration_seconds", endpoint="video"):
+            pass
+
+        assert 'duration_seconds_count{endpoint="video"} 1' in self.metrics.render()
+
+    def test_escapes_labels(self):
+        self.metrics.inc("requests_total", endpoint='a"b\\c')
+
+        assert 'requests_total{endpoint="a\\"b\\\\c"} 1' in self.metrics.render()
+
+    def test_collector(self):
+        self.metrics.collector(lambda: [("requests_total", {"endpoint": "x"}, 7)])
+
+        assert 'requests_total{endpoint="x"} 7' in self.metrics.render()
+
+    def test_disabled(self):
+        self.metrics.enabled = False
+        self.metrics.inc("requests_total", endpoint="video")
+
+        assert "requests_total{" not in self.metrics.render()
+
+    def _writeWorker(self, pid, value):
+        self.path.mkdir(parents=True, exist_ok=True)
+        (self.path / f"{pid}.json").write_text(
+            json.dumps(
+                {
+                    "counters": [["requests_total", {"endpoint": "video"}, value]],
+                    "histograms": [
+                        ["duration_seconds", {"endpoint": "video"}, [1, 0, 0, 0.05]]
+                    ],
+                }
+            )
+        )
+
+    def test_sums_workers(self):
+        self.metrics.inc("requests_total", endpoint="video")
+        self._writeWorker(os.getppid(), 4)
+
+        lines = self.metrics.render().splitlines()
+
+        assert 'requests_total{endpoint="video"} 5' in lines
+        assert 'duration_seconds_count{endpoint="video"} 1' in lines
+        assert (self.path / f"{os.getppid()}.json").exists()
+
+    def test_exited_workers_are_archived(self):
+        self._writeWorker(DEAD_PID, 4)
+
+        first = self.metrics.render()
+        assert not (self.path / f"{DEAD_PID}.json").exists()
+        self._writeWorker(DEAD_PID, 2)
+        second = self.metrics.render()
+
+        assert 'requests_total{endpoint="video"} 4' in first
+        assert 'requests_total{endpoint="video"} 6' in second
+        assert 'duration_seconds_count{endpoint="video"} 2' in second
+
+    def test_ignores_corrupt_files(self):
+        self.path.mkdir(parents=True)
+        (self.path / "12345.json").write_text("{")
+        self.metrics.inc("requests_total", endpoint="video")
+
+        assert 'requests_total{endpoint="video"} 1' in self.metrics.render()
+
+    def test_forked_worker_starts_empty(self, mocker):
+        self.metrics.inc("requests_total", endpoint="video")
+        mocker.patch("metrics.os.getpid", return_value=os.getpid() + 1)
+
+        self.metrics.inc("requests_total", endpoint="hls")
+
+        counters = self.metrics.snapshot()["counters"]
+        assert counters == [["requests_total", {"endpoint": "hls"}, 1]]
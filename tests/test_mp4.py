@@ -0,0 +1,110 @@
+import os
+import struct
+
+import pytest
+
+from mp4 import probe, warm_moov
+
+
+def box(kind, payload=b""):
+    return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+
+def full_box(kind, payload=b"", version=0):
+    return box(kind, struct.pack(">B3x", version) + payload)
+
+
+def table(kind, *entries):
+    payload = struct.pack(">I", len(entries))
+    for entry in entries:
+        payload += struct.pack(f">{len(entry)}I", *entry)
+    return full_box(kind, payload)
+
+
+def moov(chunk_base):
+    # 10 seconds of 24fps video in 24 chunks of 10 samples with a keyframe
+    # every 2 seconds
+    mvhd = full_box(b"mvhd", struct.pack(">IIII", 0, 0, 1000, 10000) + bytes(80))
+    mdhd = full_box(b"mdhd", struct.pack(">IIII", 0, 0, 24, 240) + bytes(4))
+    hdlr = full_box(b"hdlr", struct.pack(">I4s", 0, b"vide") + bytes(13))
+    stbl = box(
+        b"stbl",
+        table(b"stts", (240, 1))
+        + table(b"stss", (1,), (49,), (97,))
+        + table(b"stsc", (1, 10, 1))
+        + full_box(b"stsz", struct.pack(">II", 100, 240))
+        + table(b"stco", *((chunk_base + i * 1000,) for i in range(24))),
+    )
+    trak = box(b"trak", box(b"mdia", mdhd + hdlr + box(b"minf", stbl)))
+    return box(b"moov", mvhd + trak)
+
+
+FTYP = box(b"ftyp", b"isom" + bytes(4))
+
+
+class TestProbe:
+    @pytest.fixture(autouse=True)
+    def setUp(self, tmp_path):
+        self.path = tmp_path / "video.mp4"
+
+    def _write(self, data):
+        self.path.write_bytes(data)
+        return len(data)
+
+    def test_faststart(self):
+        moov_size = len(moov(0))
+        mdat_offset = len(FTYP) + moov_size
+        base = mdat_offset + 8
+        size = self._write(FTYP + moov(base) + box(b"mdat", bytes(24000)))
+
+        actual = probe(self.path, size)
+
+        assert actual == {
+            "faststart": True,
+            "moov_offset": len(FTYP),
+            "moov_size": moov_size,
+            "duration": 10.0,
+            "bitrate": size * 8 // 10,
+        }
+
+    def test_moov_at_end(self):
+        base = len(FTYP) + 8
+        mdat = box(b"mdat", bytes(24000))
+        size = self._write(FTYP + mdat + moov(base))
+
+        actual = probe(self.path, size)
+
+        assert actual["faststart"] is False
+        assert actual["moov_offset"] == len(FTYP) + len(mdat)
+        assert actual["duration"] == 10.0
+
+    def test_not_mp4(self):
+        size = self._write(b"WEBVTT\n\n00:00.000 --> 00:01.000\nHello\n")
+
+        with pytest.raises(ValueError):
+            probe(self.path, size)
+
+    def test_missing_mvhd(self):
+        size = self._write(FTYP + box(b"moov", box(b"trak")))
+
+        with pytest.raises(ValueError):
+            probe(self.path, size)
+
+    def test_truncated_moov(self):
+        data = FTYP + moov(0)
+        size = self._write(data[:-20])
+
+        with pytest.raises(ValueError):
+            probe(self.path, size)
+
+
+class TestWarmMoov:
+    def test_advises_moov(self, mocker, tmp_path):
+        path = tmp_path / "video.mp4"
+        path.write_bytes(bytes(100))
+        mock_fadvise = mocker.patch("prefetch.os.posix_fadvise", create=True)
+
+        warm_moov(path, {"moov_offset": 40, "moov_size": 60})
+
+        _, offset, length, advice = mock_fadvise.call_args.args
+        assert (offset, length, advice) == (40, 60, os.POSIX_FADV_WILLNEED)
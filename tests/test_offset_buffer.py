@@ -0,0 +1,175 @@
+import threading
+import pytest
+import mock
+from cache import TTLCache
+from offset_buffer import OffsetBuffer
+
+
+class TestOffsetBuffer:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        mocker.patch("offset_buffer.logger")
+        self.mock_start = mocker.patch.object(OffsetBuffer, "_start")
+        self.mock_writer = mock.MagicMock()
+        self.mock_on_flush = mock.MagicMock()
+        self.mock_deleter = mock.MagicMock()
+        self.tombstones = TTLCache(maxsize=10, ttl=60)
+
+        self.buffer = self._buffer()
+
+    def _buffer(self, writer=None):
+        return OffsetBuffer(
+            writer or self.mock_writer,
+            flush_interval=10,
+            on_flush=self.mock_on_flush,
+            deleter=self.mock_deleter,
+            tombstones=self.tombstones,
+        )
+
+    def test_get_missing(self):
+        assert self.buffer.get("guid", "file") is None
+
+    def test_keeps_latest_offset(self):
+        self.buffer.set("guid", "file", 10)
+        self.buffer.set("guid", "file", 20)
+
+        assert self.buffer.get("guid", "file") == 20
+        assert not self.mock_writer.called
+
+    def test_flush(self):
+        self.buffer.set("guid", "file", 10)
+        self.buffer.set("guid", "file", 20)
+        self.buffer.set("guid", "other", 30)
+        self.buffer.flush()
+
+        assert self.mock_writer.call_args_list == [
+            mock.call("file", "guid", 20),
+            mock.call("other", "guid", 30),
+        ]
+        self.mock_on_flush.assert_any_call("guid", "file")
+        assert self.buffer.get("guid", "file") is None
+
+    def test_get_during_flush(self):
+        self.mock_writer.side_effect = lambda filename, guid, offset: seen.append(
+            self.buffer.get(guid, filename)
+        )
+        seen = []
+
+        self.buffer.set("guid", "file", 10)
+        self.buffer.flush()
+
+        assert seen == [10]
+
+    def test_failed_write_is_dropped(self):
+        self.mock_writer.side_effect = Exception("MediaViewer is down")
+
+        self.buffer.set("guid", "file", 10)
+        self.buffer.flush()
+
+        assert not self.mock_on_flush.called
+        assert self.buffer.get("guid", "file") is None
+
+    def test_discard(self):
+        self.buffer.set("guid", "file", 10)
+        self.buffer.discard("guid", "file")
+        self.buffer.flush()
+
+        assert not self.mock_writer.called
+
+    def test_discard_does_not_wait_for_flush(self):
+        writing = threading.Event()
+        release = threading.Event()
+        self.mock_writer.side_effect = lambda *args: (
+            writing.set(),
+            release.wait(5),
+        )
+        self.buffer.set("guid", "file", 10)
+        self.buffer.set("guid", "other", 20)
+        thread = threading.Thread(target=self.buffer.flush)
+        thread.start()
+        try:
+            assert writing.wait(5)
+            self.buffer.discard("guid", "other")
+            assert not release.is_set()
+        finally:
+            release.set()
+            thread.join()
+
+        self.mock_writer.assert_called_once_with("file", "guid", 10)
+        assert not self.mock_deleter.called
+
+    def test_discard_while_writing_deletes_again(self):
+        self.mock_writer.side_effect = lambda filename, guid, offset: (
+            self.buffer.discard(guid, filename)
+        )
+
+        self.buffer.set("guid", "file", 10)
+        self.buffer.flush()
+
+        self.mock_deleter.assert_called_once_with("file", "guid")
+        assert self.buffer.get("guid", "file") is None
+
+    def test_discard_is_forgotten_after_flush(self):
+        self.mock_writer.side_effect = lambda filename, guid, offset: (
+            self.buffer.discard(guid, filename)
+        )
+        self.buffer.set("guid", "file", 10)
+        self.buffer.flush()
+        self.mock_writer.side_effect = None
+
+        self.buffer.set("guid", "file", 20)
+        self.buffer.flush()
+
+        self.mock_writer.assert_called_with("file", "guid", 20)
+        self.mock_deleter.assert_called_once_with("file", "guid")
+
+    def test_discard_in_another_worker(self, mocker):
+        mocker.patch("offset_buffer.time.time", side_effect=[1, 2])
+        other = self._buffer()
+
+        self.buffer.set("guid", "file", 10)
+        other.discard("guid", "file")
+
+        assert self.buffer.get("guid", "file") is None
+        self.buffer.flush()
+        assert not self.mock_writer.called
+
+    def test_set_after_discard_in_another_worker(self, mocker):
+        mocker.patch("offset_buffer.time.time", side_effect=[1, 2])
+        other = self._buffer()
+
+        other.discard("guid", "file")
+        self.buffer.set("guid", "file", 10)
+
+        assert self.buffer.get("guid", "file") == 10
+        self.buffer.flush()
+        self.mock_writer.assert_called_once_with("file", "guid", 10)
+
+    def test_discard_in_another_worker_while_writing(self):
+        other = self._buffer()
+        self.mock_writer.side_effect = lambda filename, guid, offset: (
+            other.discard(guid, filename)
+        )
+
+        self.buffer.set("guid", "file", 10)
+        self.buffer.flush()
+
+        self.mock_deleter.assert_called_once_with("file", "guid")
+
+    def test_stop_flushes(self):
+        self.buffer.set("guid", "file", 10)
+        self.buffer.stop()
+
+        self.mock_writer.assert_called_once_with("file", "guid", 10)
+
+
+class TestOffsetBufferThread:
+    def test_set_after_stop_is_flushed(self):
+        written = threading.Event()
+        buffer = OffsetBuffer(lambda *args: written.set(), flush_interval=0.01)
+        buffer.stop()
+
+        buffer.set("guid", "file", 10)
+
+        assert written.wait(5)
+        buffer.stop()
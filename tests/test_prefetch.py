@@ -0,0 +1,63 @@
+import os
+import threading
+
+from prefetch import Prefetcher, warm_range
+
+
+class TestPrefetcher:
+    def test_runs_job(self):
+        prefetcher = Prefetcher()
+        calls = []
+
+        prefetcher.submit("key", lambda *args: calls.append(args), 1, 2).result()
+
+        assert calls == [(1, 2)]
+
+    def test_done_key_is_skipped(self):
+        prefetcher = Prefetcher()
+
+        prefetcher.submit("key", lambda: True).result()
+
+        assert prefetcher.submit("key", lambda: True) is None
+
+    def test_unfinished_key_runs_again(self):
+        prefetcher = Prefetcher()
+        calls = []
+
+        prefetcher.submit("key", lambda: calls.append(1) and False).result()
+        prefetcher.submit("key", lambda: calls.append(1) and False).result()
+
+        assert len(calls) == 2
+
+    def test_pending_key_is_coalesced(self):
+        prefetcher = Prefetcher()
+        release = threading.Event()
+
+        future = prefetcher.submit("key", release.wait)
+        assert prefetcher.submit("key", release.wait) is None
+        release.set()
+        future.result()
+
+    def test_failure_is_logged(self, mocker):
+        mock_logger = mocker.patch("prefetch.logger")
+        prefetcher = Prefetcher()
+
+        def fail():
+            raise OSError("gone")
+
+        prefetcher.submit("key", fail).result()
+
+        assert mock_logger.return_value.error.called
+        assert prefetcher.submit("key", lambda: True) is not None
+
+
+class TestWarmRange:
+    def test_advises_range(self, mocker, tmp_path):
+        path = tmp_path / "video.mp4"
+        path.write_bytes(bytes(100))
+        mock_fadvise = mocker.patch("prefetch.os.posix_fadvise", create=True)
+
+        warm_range(path, 10, 50)
+
+        _, offset, length, advice = mock_fadvise.call_args.args
+        assert (offset, length, advice) == (10, 50, os.POSIX_FADV_WILLNEED)
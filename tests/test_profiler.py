@@ -0,0 +1,79 @@
+import os
+import signal
+import threading
+import time
+import pytest
+from collections import Counter
+from profiler import Profiler, ProfilerBusy, render
+
+
+def _spin(stop):
+    while not stop.is_set():
+        sum(range(100))
+
+
+class TestProfiler:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_directory):
+        mocker.patch("profiler.logger")
+        mocker.patch("profiler.PROFILE_PATH", temp_directory)
+        self.temp_directory = temp_directory
+        self.profiler = Profiler(interval=0.001, max_duration=1)
+
+    def test_samples_other_threads(self):
+        stop = threading.Event()
+        thread = threading.Thread(target=_spin, args=(stop,), name="spinner")
+        thread.start()
+        try:
+            stacks = self.profiler.sample(0.05)
+        finally:
+            stop.set()
+            thread.join()
+
+        spinning = [stack for stack in stacks if stack.startswith("spinner;")]
+        assert spinning
+        assert all("_spin (" in stack for stack in spinning)
+        assert not any("test_samples_other_threads" in stack for stack in stacks)
+
+    def test_caps_duration(self):
+        self.profiler.max_duration = 0.01
+
+        start = time.monotonic()
+        self.profiler.sample(60)
+
+        assert time.monotonic() - start < 1
+
+    @pytest.mark.parametrize("duration", [float("nan"), float("inf"), 0, -1])
+    def test_invalid_duration(self, duration):
+        with pytest.raises(ValueError):
+            self.profiler.sample(duration)
+
+        assert not self.profiler._lock.locked()
+
+    def test_busy(self):
+        self.profiler._lock.acquire()
+        try:
+            with pytest.raises(ProfilerBusy):
+                self.profiler.sample(0.01)
+        finally:
+            self.profiler._lock.release()
+
+    def test_render(self):
+        stacks = Counter({"main;b (x.py:3)": 2, "main;a (x.py:1)": 5})
+
+        assert render(stacks) == "main;a (x.py:1) 5\nmain;b (x.py:3) 2\n"
+
+    def test_signal_handler(self, mocker):
+        previous = signal.getsignal(signal.SIGUSR2)
+        pid = os.getpid()
+        mocker.patch("profiler.os.getpid", return_value=1234)
+        try:
+            self.profiler.install_signal_handler(duration=0.01)
+            os.kill(pid, signal.SIGUSR2)
+            (thread,) = [t for t in threading.enumerate() if t.name == "profiler"]
+            thread.join()
+        finally:
+            signal.signal(signal.SIGUSR2, previous)
+
+        (profile,) = self.temp_directory.glob("1234-*.txt")
+        assert "MainThread;" in profile.read_text()
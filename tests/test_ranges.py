@@ -0,0 +1,285 @@
+import pytest
+from flask import Flask
+from werkzeug.http import http_date
+from werkzeug.wsgi import FileWrapper
+from ranges import send_range, make_etag, call_on_close
+from media_index import FileStat
+
+DATA = bytes(range(256)) * 4
+
+app = Flask(__name__)
+
+
+class TestSendRange:
+    @pytest.fixture(autouse=True)
+    def setUp(self, temp_directory):
+        self.path = temp_directory / "video.mp4"
+        self.path.write_bytes(DATA)
+        self.stat = FileStat(len(DATA), 1_700_000_000_000_000_000)
+        self.etag = make_etag(self.stat.size, self.stat.mtime)
+
+    def _send(self, headers=None, **kwargs):
+        with app.test_request_context(headers=headers or {}, **kwargs):
+            response = send_range(self.path, stat=self.stat, chunk_size=100)
+            body = b"".join(response.response)
+            response.close()
+        return response, body
+
+    def test_full_file(self):
+        response, body = self._send()
+
+        assert response.status_code == 200
+        assert response.headers["Content-Length"] == str(len(DATA))
+        assert response.headers["Content-Type"] == "video/mp4"
+        assert response.headers["ETag"] == f'"{self.etag}"'
+        assert body == DATA
+
+    def test_explicit_mimetype(self):
+        with app.test_request_context():
+            response = send_range(self.path, stat=self.stat, mimetype="video/mp2t")
+            response.close()
+
+        assert response.headers["Content-Type"] == "video/mp2t"
+
+    def test_single_range(self):
+        response, body = self._send({"Range": "bytes=10-209"})
+
+        assert response.status_code == 206
+        assert response.headers["Content-Range"] == f"bytes 10-209/{len(DATA)}"
+        assert response.headers["Content-Length"] == "200"
+        assert body == DATA[10:210]
+
+    def test_open_ended_range(self):
+        response, body = self._send({"Range": "bytes=1000-"})
+
+        assert response.status_code == 206
+        assert body == DATA[1000:]
+
+    def test_suffix_range(self):
+        response, body = self._send({"Range": "bytes=-24"})
+
+        assert response.status_code == 206
+        assert body == DATA[-24:]
+
+    def test_range_past_end_is_clamped(self):
+        response, body = self._send({"Range": "bytes=1000-5000"})
+
+        assert response.status_code == 206
+        assert response.headers["Content-Range"] == f"bytes 1000-1023/{len(DATA)}"
+        assert body == DATA[1000:]
+
+    def test_unsatisfiable_range(self):
+        response, body = self._send({"Range": "bytes=5000-6000"})
+
+        assert response.status_code == 416
+        assert response.headers["Content-Range"] == f"bytes */{len(DATA)}"
+
+    def test_multiple_ranges(self):
+        response, body = self._send({"Range": "bytes=0-9,100-109"})
+
+        assert response.status_code == 206
+        content_type = response.headers["Content-Type"]
+        assert content_type.startswith("multipart/byteranges; boundary=")
+        boundary = content_type.split("boundary=")[1].encode()
+
+        assert response.headers["Content-Length"] == str(len(body))
+        assert body.startswith(b"--" + boundary)
+        assert body.endswith(b"--" + boundary + b"--\r\n")
+        assert b"Content-Range: bytes 0-9/1024\r\n\r\n" + DATA[0:10] in body
+        assert b"Content-Range: bytes 100-109/1024\r\n\r\n" + DATA[100:110] in body
+
+    def test_if_none_match(self):
+        response, body = self._send({"If-None-Match": f'"{self.etag}"'})
+
+        assert response.status_code == 304
+        assert body == b""
+
+    def test_if_modified_since(self):
+        response, body = self._send(
+            {"If-Modified-Since": http_date(self.stat.mtime // 1_000_000_000)}
+        )
+
+        assert response.status_code == 304
+        assert body == b""
+
+    def test_modified_since(self):
+        response, body = self._send(
+            {"If-Modified-Since": http_date(self.stat.mtime // 1_000_000_000 - 1)}
+        )
+
+        assert response.status_code == 200
+        assert body == DATA
+
+    def test_if_none_match_takes_precedence(self):
+        response, body = self._send(
+            {
+                "If-None-Match": '"stale"',
+                "If-Modified-Since": http_date(self.stat.mtime // 1_000_000_000),
+            }
+        )
+
+        assert response.status_code == 200
+
+    def test_if_range_matches(self):
+        response, body = self._send(
+            {"Range": "bytes=0-9", "If-Range": f'"{self.etag}"'}
+        )
+
+        assert response.status_code == 206
+        assert body == DATA[:10]
+
+    def test_if_range_does_not_match(self):
+        response, body = self._send({"Range": "bytes=0-9", "If-Range": '"stale"'})
+
+        assert response.status_code == 200
+        assert body == DATA
+
+    def test_if_range_date(self):
+        response, body = self._send(
+            {
+                "Range": "bytes=0-9",
+                "If-Range": http_date(self.stat.mtime // 1_000_000_000),
+            }
+        )
+
+        assert response.status_code == 206
+
+    def test_file_wrapper(self):
+        response, body = self._send(
+            {"Range": "bytes=10-19"},
+            environ_overrides={"wsgi.file_wrapper": FileWrapper},
+        )
+
+        assert isinstance(response.response, FileWrapper)
+        assert response.headers["Content-Length"] == "10"
+        assert body == DATA[10:20]
+
+    def test_stat_from_file(self):
+        with app.test_request_context():
+            response = send_range(self.path)
+            body = b"".join(response.response)
+            response.close()
+
+        assert body == DATA
+
+
+class TestSendRangeMmap:
+    @pytest.fixture(autouse=True)
+    def setUp(self, temp_directory):
+        self.path = temp_directory / "video.mp4"
+        self.path.write_bytes(DATA)
+        self.stat = FileStat(len(DATA), 1_700_000_000_000_000_000)
+
+    def _send(self, headers=None, **kwargs):
+        with app.test_request_context(headers=headers or {}, **kwargs):
+            response = send_range(
+                self.path, stat=self.stat, chunk_size=100, use_mmap=True
+            )
+        # Like a server, use each chunk before asking for the next one
+        chunks = [(type(chunk), bytes(chunk)) for chunk in response.response]
+        body = b"".join(data for _, data in chunks)
+        response.close()
+        return response, chunks, body
+
+    def test_full_file(self):
+        response, chunks, body = self._send(
+            environ_overrides={"wsgi.file_wrapper": FileWrapper}
+        )
+
+        assert response.status_code == 200
+        assert not isinstance(response.response, FileWrapper)
+        assert body == DATA
+        assert len(chunks) == 11
+
+    def test_bytes_chunks(self):
+        response, chunks, body = self._send({"Range": "bytes=10-309"})
+
+        assert response.status_code == 206
+        assert all(chunk_type is bytes for chunk_type, _ in chunks)
+        assert body == DATA[10:310]
+
+    def test_multiple_ranges(self):
+        response, _, body = self._send({"Range": "bytes=0-9,500-509"})
+
+        assert response.status_code == 206
+        assert DATA[0:10] in body
+        assert DATA[500:510] in body
+
+    def test_closed_early(self):
+        with app.test_request_context():
+            response = send_range(
+                self.path, stat=self.stat, chunk_size=100, use_mmap=True
+            )
+
+        body = iter(response.response)
+        chunk = next(body)
+        assert bytes(chunk) == DATA[:100]
+        response.close()
+
+    def test_empty_file(self):
+        self.path.write_bytes(b"")
+        self.stat = FileStat(0, 1)
+
+        response, _, body = self._send()
+
+        assert response.status_code == 200
+        assert body == b""
+
+
+class TestCallOnClose:
+    @pytest.fixture(autouse=True)
+    def setUp(self, temp_directory):
+        self.path = temp_directory / "video.mp4"
+        self.path.write_bytes(DATA)
+        self.stat = FileStat(len(DATA), 1_700_000_000_000_000_000)
+        self.calls = []
+
+    def _send(self, headers=None, **kwargs):
+        with app.test_request_context(headers=headers or {}, **kwargs):
+            response = send_range(self.path, stat=self.stat, chunk_size=100)
+        call_on_close(response, lambda: self.calls.append(True))
+        return response
+
+    def _serve(self, response):
+        # Like a server, close what the WSGI app returned
+        app_iter = response.get_app_iter({"REQUEST_METHOD": "GET"})
+        body = b"".join(app_iter)
+        app_iter.close()
+        return body
+
+    def test_generator(self):
+        response = self._send()
+
+        body = self._serve(response)
+
+        assert body == DATA
+        assert self.calls == [True]
+
+    def test_file_wrapper(self):
+        response = self._send(
+            {"Range": "bytes=10-19"},
+            environ_overrides={"wsgi.file_wrapper": FileWrapper},
+        )
+
+        assert isinstance(response.response, FileWrapper)
+        body = self._serve(response)
+
+        assert body == DATA[10:20]
+        assert self.calls == [True]
+        assert response.response.file.closed
+
+    def test_multipart(self):
+        response = self._send({"Range": "bytes=0-9,20-29"})
+
+        self._serve(response)
+
+        assert self.calls == [True]
+
+    def test_not_direct_passthrough(self):
+        with app.test_request_context():
+            response = app.make_response("ok")
+        call_on_close(response, lambda: self.calls.append(True))
+
+        self._serve(response)
+
+        assert self.calls == [True]
@@ -0,0 +1,233 @@
+import fcntl
+import os
+import sys
+import pytest
+from concurrent.futures import Future
+from media_index import FileStat
+from thumbnails import (
+    COMPLETE_NAME,
+    LOCK_NAME,
+    POSTER_COMPLETE_NAME,
+    POSTER_NAME,
+    SPRITE_NAME,
+    SPRITE_VTT_NAME,
+    ThumbnailCache,
+)
+
+FAKE_FFMPEG = """\
+import pathlib
+import sys
+
+args = sys.argv[1:]
+with open({calls!r}, "a") as f:
+    f.write(" ".join(args) + "\\n")
+if {fail!r}:
+    sys.stderr.write("boom")
+    sys.exit(1)
+
+pathlib.Path(args[-1]).write_bytes(b"x" * 100)
+"""
+
+
+class TestThumbnailCache:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_directory):
+        mocker.patch("thumbnails.logger")
+        self.dir = temp_directory
+        self.calls = self.dir / "calls.txt"
+        self.source = self.dir / "movie.mp4"
+        self.source.write_bytes(b"x" * 1000)
+        self.stat = FileStat(1000, 1)
+
+    def _cache(self, fail=False, max_size=10_000, **kwargs):
+        ffmpeg = self.dir / "ffmpeg"
+        ffmpeg.write_text(
+            f"#!{sys.executable}\n"
+            + FAKE_FFMPEG.format(calls=str(self.calls), fail=fail)
+        )
+        ffmpeg.chmod(0o755)
+        return ThumbnailCache(
+            self.dir / "thumbs", max_size, ffmpeg=str(ffmpeg), **kwargs
+        )
+
+    def _made(self, cache, hashed_filename, duration, name, stat=None):
+        """Make the thumbnails of the source, then get one"""
+        stat = stat or self.stat
+        future = cache.submit(self.source, stat, hashed_filename, duration)
+        if future is not None:
+            future.result()
+        return cache.get(self.source, stat, hashed_filename, duration, name)
+
+    def _calls(self):
+        return self.calls.read_text().splitlines() if self.calls.exists() else []
+
+    def test_get_poster(self):
+        cache = self._cache()
+
+        poster = self._made(cache, "hash", 600.0, POSTER_NAME)
+
+        assert poster.name == POSTER_NAME
+        assert poster.parent.name == "hash-1-3e8"
+        assert (poster.parent / POSTER_COMPLETE_NAME).exists()
+        assert (poster.parent / COMPLETE_NAME).exists()
+        assert (poster.parent / SPRITE_NAME).exists()
+        poster_call, sprite_call = self._calls()
+        assert "-ss 60.000" in poster_call
+        assert "-skip_frame nokey" in sprite_call
+        assert "fps=1/10" in sprite_call
+        assert "tile=10x6" in sprite_call
+
+    def test_sprite_vtt(self):
+        cache = self._cache()
+
+        vtt = self._made(cache, "hash", 25.0, SPRITE_VTT_NAME)
+
+        assert vtt.read_text().splitlines() == [
+            "WEBVTT",
+            "",
+            "00:00:00.000 --> 00:00:10.000",
+            "sprite.jpg#xywh=0,0,160,90",
+            "",
+            "00:00:10.000 --> 00:00:20.000",
+            "sprite.jpg#xywh=160,0,160,90",
+            "",
+            "00:00:20.000 --> 00:00:25.000",
+            "sprite.jpg#xywh=320,0,160,90",
+        ]
+
+    def test_long_video_is_limited_to_max_tiles(self):
+        cache = self._cache()
+
+        vtt = self._made(cache, "hash", 7200.0, SPRITE_VTT_NAME)
+
+        lines = vtt.read_text().splitlines()
+        assert "01:58:48.000 --> 02:00:00.000" in lines
+        assert lines[-1] == "sprite.jpg#xywh=1440,810,160,90"
+        assert "fps=1/72.0" in self._calls()[1]
+
+    def test_no_duration_only_makes_poster(self):
+        cache = self._cache()
+
+        poster = self._made(cache, "hash", None, POSTER_NAME)
+
+        assert "-ss 0.000" in self._calls()[0]
+        assert len(self._calls()) == 1
+        with pytest.raises(FileNotFoundError):
+            self._made(cache, "hash", None, SPRITE_NAME)
+        assert poster.exists()
+
+    def test_existing_thumbnails_are_reused(self):
+        cache = self._cache()
+        first = self._made(cache, "hash", 60.0, POSTER_NAME)
+
+        assert cache.submit(self.source, self.stat, "hash", 60.0) is None
+        assert self._made(cache, "hash", 60.0, POSTER_NAME) == first
+        assert len(self._calls()) == 2
+
+    def test_changed_file_gets_new_thumbnails(self):
+        cache = self._cache()
+
+        first = self._made(cache, "hash", 60.0, POSTER_NAME)
+        second = self._made(cache, "hash", 60.0, POSTER_NAME, FileStat(2000, 2))
+
+        assert first.parent != second.parent
+        assert len(self._calls()) == 4
+
+    def test_invalid_name(self):
+        cache = self._cache()
+
+        with pytest.raises(ValueError):
+            cache.get(self.source, self.stat, "hash", 60.0, "../secret.txt")
+        assert self._calls() == []
+
+    def test_ffmpeg_failure_is_not_retried(self):
+        cache = self._cache(fail=True)
+
+        with pytest.raises(Exception, match="boom"):
+            self._made(cache, "hash", 60.0, POSTER_NAME)
+        assert not cache.directory("hash", self.stat).exists()
+
+        assert cache.get(self.source, self.stat, "hash", 60.0, POSTER_NAME) is None
+        assert len(self._calls()) == 1
+
+    def test_ffmpeg_failure_is_retried_later(self, mocker):
+        cache = self._cache(fail=True, failure_ttl=60)
+        mock_monotonic = mocker.patch("cache.time.monotonic", return_value=1000)
+
+        with pytest.raises(Exception, match="boom"):
+            self._made(cache, "hash", 60.0, POSTER_NAME)
+        assert cache.submit(self.source, self.stat, "hash", 60.0) is None
+
+        mock_monotonic.return_value = 1061
+        cache.submit(self.source, self.stat, "hash", 60.0).exception()
+        assert len(self._calls()) == 2
+
+    def test_get_does_not_wait(self, mocker):
+        cache = self._cache()
+        mock_submit = mocker.patch.object(
+            cache._executor, "submit", side_effect=lambda *args: Future()
+        )
+
+        assert cache.get(self.source, self.stat, "hash", 60.0, POSTER_NAME) is None
+        assert not cache.complete("hash", self.stat)
+        mock_submit.assert_called_once()
+
+    def test_poster_before_sprite(self):
+        cache = self._cache()
+        directory = cache.directory("hash", self.stat)
+        directory.mkdir(parents=True)
+        (directory / POSTER_NAME).write_bytes(b"x")
+        (directory / POSTER_COMPLETE_NAME).touch()
+
+        poster = cache.get(self.source, self.stat, "hash", 60.0, POSTER_NAME)
+
+        assert poster == directory / POSTER_NAME
+        assert not cache.complete("hash", self.stat)
+
+    def test_pending_jobs_are_bounded(self, mocker):
+        cache = self._cache(max_pending=1)
+        mock_submit = mocker.patch.object(
+            cache._executor, "submit", side_effect=lambda *args: Future()
+        )
+
+        first = cache.submit(self.source, self.stat, "first", 60.0)
+        assert cache.submit(self.source, self.stat, "first", 60.0) is first
+        assert cache.submit(self.source, self.stat, "second", 60.0) is None
+        assert cache.submit(self.source, self.stat, "second", 60.0, force=True)
+        assert mock_submit.call_count == 2
+
+    def test_pending_job_is_reused_without_checking_disk(self, mocker):
+        cache = self._cache()
+        mocker.patch.object(
+            cache._executor, "submit", side_effect=lambda *args: Future()
+        )
+        first = cache.submit(self.source, self.stat, "hash", 60.0)
+        mock_exists = mocker.patch("thumbnails.Path.exists")
+
+        assert cache.submit(self.source, self.stat, "hash", 60.0) is first
+        assert not mock_exists.called
+
+    def test_locked_by_another_worker(self):
+        cache = self._cache()
+        directory = cache.directory("hash", self.stat)
+        directory.mkdir(parents=True)
+        fd = os.open(directory / LOCK_NAME, os.O_RDWR | os.O_CREAT)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            assert self._made(cache, "hash", 60.0, POSTER_NAME) is None
+        finally:
+            os.close(fd)
+
+        assert self._calls() == []
+
+    def test_evict_least_recently_requested(self):
+        cache = self._cache()
+        old = self._made(cache, "old", 60.0, POSTER_NAME).parent
+        new = self._made(cache, "new", 60.0, POSTER_NAME).parent
+        os.utime(old, (1, 1))
+
+        cache.max_size = 600
+        cache.evict()
+
+        assert not old.exists()
+        assert new.exists()
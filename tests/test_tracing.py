@@ -0,0 +1,117 @@
+import json
+import threading
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from tracing import Tracer
+
+
+def _events(path):
+    text = path.read_text()
+    assert text.startswith("[\n")
+    # Closing the array is left to whoever reads the trace
+    return json.loads(text.rstrip(",\n") + "]")
+
+
+class TestTracer:
+    @pytest.fixture(autouse=True)
+    def setUp(self, temp_directory, mocker):
+        self.path = temp_directory / "traces"
+        self.tracer = Tracer(self.path, enabled=True)
+        self.mock_getpid = mocker.patch("tracing.os.getpid", return_value=1234)
+        self.file = self.path / "1234.json"
+
+    def test_request_and_spans(self):
+        trace = self.tracer.start("get_file", method="GET")
+        with self.tracer.span("token"):
+            pass
+        with self.tracer.span("render", template="video.html"):
+            pass
+        self.tracer.finish(trace, status=200)
+
+        request, token, render = _events(self.file)
+        assert request["name"] == "get_file"
+        assert request["ph"] == "X"
+        assert request["args"] == {"method": "GET", "status": 200}
+        assert token["name"] == "token"
+        assert render["args"] == {"template": "video.html"}
+        assert request["ts"] <= token["ts"] <= render["ts"]
+        assert token["tid"] == request["tid"] == threading.get_native_id()
+
+    def test_appends_requests(self):
+        for _ in range(2):
+            self.tracer.finish(self.tracer.start("get_file"))
+
+        assert [event["name"] for event in _events(self.file)] == [
+            "get_file",
+            "get_file",
+        ]
+
+    def test_traced(self):
+        @self.tracer.traced("build_entries")
+        def buildEntries():
+            return "entries"
+
+        trace = self.tracer.start("get_file")
+        assert buildEntries() == "entries"
+        self.tracer.finish(trace)
+
+        assert _events(self.file)[1]["name"] == "build_entries"
+
+    def test_accumulate_and_iterate(self):
+        trace = self.tracer.start("get_dirPath")
+        for _ in self.tracer.iterate("walk", range(3)):
+            with self.tracer.accumulate("hashing"):
+                pass
+        self.tracer.finish(trace)
+
+        (request,) = _events(self.file)
+        assert request["args"]["hashing_calls"] == 3
+        assert request["args"]["walk_calls"] == 4
+        assert request["args"]["hashing_ms"] >= 0
+
+    def test_wrap_runs_in_trace(self):
+        @self.tracer.traced("genres")
+        def getMediaGenres():
+            return threading.get_native_id()
+
+        trace = self.tracer.start("get_file")
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            tid = executor.submit(self.tracer.wrap(getMediaGenres)).result()
+        self.tracer.finish(trace)
+
+        request, genres = _events(self.file)
+        assert genres["name"] == "genres"
+        assert genres["tid"] == tid != request["tid"]
+
+    def test_not_sampled(self):
+        self.tracer.sample_rate = 0
+
+        trace = self.tracer.start("get_file")
+        with self.tracer.span("token"):
+            pass
+        self.tracer.finish(trace)
+
+        assert trace is None
+        assert not self.file.exists()
+
+    def test_disabled(self):
+        self.tracer.enabled = False
+
+        assert self.tracer.start("get_file") is None
+        assert list(self.tracer.iterate("walk", [1, 2])) == [1, 2]
+
+    def test_fast_requests_are_dropped(self):
+        self.tracer.min_duration = 60
+
+        self.tracer.finish(self.tracer.start("get_file"))
+
+        assert not self.file.exists()
+
+    def test_rotates_large_files(self):
+        self.tracer.max_size = 10
+        self.tracer.finish(self.tracer.start("first"))
+
+        self.tracer.finish(self.tracer.start("second"))
+
+        assert [event["name"] for event in _events(self.file)] == ["second"]
+        assert (self.path / "1234.json.1").exists()
@@ -1,11 +1,19 @@
+import hashlib
 import pytest
 import mock
+import requests
 from utils import (
     humansize,
+    humanduration,
     checkForValidToken,
     getMediaGenres,
+    hashed_filename,
+    connection_stats,
+    session,
+    delayedRetry,
+    _upstreamEndpoint,
 )
-from settings import REQUESTS_TIMEOUT
+from settings import METADATA_REQUESTS_TIMEOUT
 
 
 class TestHumanSize:
@@ -80,6 +88,17 @@ class TestHumanSize:
         assert expected == actual
 
 
+class TestHumanDuration:
+    def test_seconds(self):
+        assert "0:07" == humanduration(7.9)
+
+    def test_minutes(self):
+        assert "42:05" == humanduration(2525)
+
+    def test_hours(self):
+        assert "1:02:05" == humanduration(3725.2)
+
+
 class TestCheckForValidToken:
     @pytest.fixture(autouse=True)
     def setUp(self):
@@ -109,7 +128,7 @@ class TestGetMediaGenres:
     def setUp(self, mocker):
         mocker.patch("utils.MEDIAVIEWER_BASE_URL", "base_url")
 
-        self.mock_get = mocker.patch("utils.requests.get")
+        self.mock_get = mocker.patch("utils.session.get")
 
         self.mock_resp = mock.MagicMock()
         self.mock_resp.json.return_value = {
@@ -144,6 +163,135 @@ class TestGetMediaGenres:
         actual = getMediaGenres(self.test_guid)
 
         self.mock_get.assert_called_once_with(
-            "base_url/ajaxgenres/test_guid/", timeout=REQUESTS_TIMEOUT
+            "base_url/ajaxgenres/test_guid/", timeout=METADATA_REQUESTS_TIMEOUT
         )
         assert expected == actual
+
+    def test_cached(self):
+        getMediaGenres(self.test_guid)
+        getMediaGenres(self.test_guid)
+
+        self.mock_get.assert_called_once_with(
+            "base_url/ajaxgenres/test_guid/", timeout=METADATA_REQUESTS_TIMEOUT
+        )
+
+
+class TestHashedFilename:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        mocker.patch("utils.SECRET_KEY", "secret")
+        hashed_filename.cache_clear()
+        yield
+        hashed_filename.cache_clear()
+
+    def test_hashed_filename(self):
+        expected = hashlib.sha256(b"some/file.mp4secret").hexdigest()
+        actual = hashed_filename("some/file.mp4")
+        assert expected == actual
+
+    def test_memoized(self, mocker):
+        mock_sha256 = mocker.patch("utils.hashlib.sha256", wraps=hashlib.sha256)
+
+        first = hashed_filename("some/file.mp4")
+        second = hashed_filename("some/file.mp4")
+
+        assert first == second
+        mock_sha256.assert_called_once_with(b"some/file.mp4secret")
+
+
+class TestConnectionStats:
+    def test_connection_stats(self, mocker):
+        mock_pool = mock.MagicMock(num_connections=2, num_requests=10)
+        mock_adapter = mock.MagicMock()
+        mock_adapter.poolmanager.pools.keys.return_value = ["mediaviewer"]
+        mock_adapter.poolmanager.pools.__getitem__.return_value = mock_pool
+        mocker.patch.object(session, "adapters", {"https://": mock_adapter})
+
+        expected = {"connections": 2, "requests": 10, "reused": 8}
+        actual = connection_stats()
+        assert expected == actual
+
+    def test_no_connections(self):
+        expected = {"connections": 0, "requests": 0, "reused": 0}
+        actual = connection_stats()
+        assert expected == actual
+
+
+class TestUpstreamMetrics:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        self.mock_inc = mocker.patch("utils.metrics.inc")
+        self.mock_observe = mocker.patch("utils.metrics.observe")
+        self.mock_request = mocker.patch("utils.requests.Session.request")
+        self.mock_request.return_value.status_code = 200
+
+    def test_endpoint_names(self, mocker):
+        mocker.patch("utils.MEDIAVIEWER_BASE_URL", "http://mv:8000/mediaviewer")
+
+        assert "api/downloadtoken" == _upstreamEndpoint(
+            "http://mv:8000/mediaviewer/api/downloadtoken/some-guid/"
+        )
+        assert "ajaxvideoprogress" == _upstreamEndpoint(
+            "http://mv:8000/mediaviewer/ajaxvideoprogress/guid/file.mp4/"
+        )
+        assert "ajaxgenres" == _upstreamEndpoint(
+            "http://mv:8000/mediaviewer/ajaxgenres/guid/"
+        )
+        assert "other" == _upstreamEndpoint("http://elsewhere/other/1/")
+
+    def test_records_latency(self):
+        session.get("http://mv/mediaviewer/ajaxgenres/guid/")
+
+        name, _ = self.mock_observe.call_args.args
+        assert name == "mediawaiter_upstream_request_duration_seconds"
+        assert self.mock_observe.call_args.kwargs["method"] == "GET"
+        assert not self.mock_inc.called
+
+    def test_counts_error_statuses(self):
+        self.mock_request.return_value.status_code = 500
+
+        session.get("http://mv/mediaviewer/ajaxgenres/guid/")
+
+        assert self.mock_inc.call_args.args == ("mediawaiter_upstream_errors_total",)
+        assert self.mock_observe.called
+
+    def test_counts_exceptions(self):
+        self.mock_request.side_effect = requests.ConnectionError("refused")
+
+        with pytest.raises(requests.ConnectionError):
+            session.get("http://mv/mediaviewer/ajaxgenres/guid/")
+
+        assert self.mock_inc.call_args.args == ("mediawaiter_upstream_errors_total",)
+        assert self.mock_observe.called
+
+
+class TestDelayedRetry:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        mocker.patch("utils.time.sleep")
+        self.mock_inc = mocker.patch("utils.metrics.inc")
+
+    def test_counts_retries(self):
+        calls = []
+
+        @delayedRetry(attempts=3, interval=0)
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise ValueError("not yet")
+            return "done"
+
+        assert flaky() == "done"
+        assert (
+            self.mock_inc.call_args_list
+            == [mock.call("mediawaiter_retries_total", function="flaky")] * 2
+        )
+
+    def test_gives_up(self):
+        @delayedRetry(attempts=2, interval=0)
+        def broken():
+            raise ValueError("never")
+
+        with pytest.raises(ValueError):
+            broken()
+        assert self.mock_inc.call_count == 1
@@ -1,16 +1,36 @@
+import json
 import pytest
+import threading
 from pathlib import Path
 from waiter import (
     isAlfredEncoding,
     getTokenByGUID,
+    invalidateToken,
+    recordProgress,
     get_dirPath,
     buildEntries,
     _buildFileDictHelper,
+    _getFileEntryFromHash,
+    _getMp4Info,
+    _prefetchNextEpisode,
     send_file_for_download,
     get_file,
+    autoplay,
+    video,
+    Subtitle,
     get_status,
+    videoOffset,
+    send_file_partial,
+    hls,
+    thumbnail,
+    app,
 )
-from settings import REQUESTS_TIMEOUT, DEFAULT_THEME
+from flask import g, render_template_string
+from profiler import ProfilerBusy
+from media_index import DirectoryEntry, FileStat
+from cache import TTLCache
+from tracing import tracer
+from settings import TOKEN_REQUESTS_TIMEOUT, DEFAULT_THEME
 import mock
 
 
@@ -38,9 +58,12 @@ class TestGetTokenByGUID:
         mocker.patch("waiter.WAITER_PASSWORD", "TEST_WAITER_PASSWORD")
         mocker.patch("waiter.VERIFY_REQUESTS", "TEST_VERIFY_REQUESTS")
 
-        self.requests_patcher = mock.patch("waiter.requests")
-        self.mock_requests = self.requests_patcher.start()
+        self.mock_requests = mocker.patch("waiter.session")
         self.mock_get_result = mock.MagicMock()
+        self.mock_get_result.json.return_value = {
+            "guid": "_url",
+            "isvalid": True,
+        }
         self.mock_requests.get.return_value = self.mock_get_result
 
     def test_getTokenByGUID(self):
@@ -52,11 +75,55 @@ class TestGetTokenByGUID:
             "TEST_GUID_URL_url",
             auth=("TEST_WAITER_USERNAME", "TEST_WAITER_PASSWORD"),
             verify="TEST_VERIFY_REQUESTS",
-            timeout=REQUESTS_TIMEOUT,
+            timeout=TOKEN_REQUESTS_TIMEOUT,
         )
         self.mock_get_result.json.assert_called_once_with()
         assert expected == actual
 
+    def test_cached(self):
+        first = getTokenByGUID("_url")
+        first["donation_site_name"] = ""
+        second = getTokenByGUID("_url")
+
+        assert self.mock_requests.get.call_count == 1
+        assert second == self.mock_get_result.json.return_value
+
+    def test_invalidateToken(self):
+        getTokenByGUID("_url")
+        invalidateToken("_url")
+        getTokenByGUID("_url")
+
+        assert self.mock_requests.get.call_count == 2
+
+    def test_recordProgress(self):
+        self.mock_get_result.json.return_value = {
+            "isvalid": True,
+            "videoprogresses": ["other"],
+        }
+        getTokenByGUID("_url")
+
+        recordProgress("_url", "hash")
+        token = getTokenByGUID("_url")
+
+        assert token["videoprogresses"] == ["other", "hash"]
+        assert self.mock_requests.get.call_count == 1
+
+    def test_recordProgress_not_cached(self):
+        recordProgress("_url", "hash")
+        token = getTokenByGUID("_url")
+
+        assert token == self.mock_get_result.json.return_value
+        assert self.mock_requests.get.call_count == 1
+
+    def test_invalid_token_uses_negative_ttl(self, mocker):
+        mocker.patch("waiter.TOKEN_CACHE_NEGATIVE_TTL", 0)
+        self.mock_get_result.json.return_value = {"isvalid": False}
+
+        getTokenByGUID("_url")
+        getTokenByGUID("_url")
+
+        assert self.mock_requests.get.call_count == 2
+
 
 class TestGetDirPath:
     @pytest.fixture(autouse=True)
@@ -86,8 +153,13 @@ class TestGetDirPath:
         self.mock_buildWaiterPath = mocker.patch("waiter.buildWaiterPath")
 
         self.mock_checkForValidToken = mocker.patch("waiter.checkForValidToken")
+        self.mock_directoryVersion = mocker.patch("waiter._directoryVersion")
+        self.mock_directoryVersion.return_value = ((Path("test/path"), 1, 1),)
         self.test_guid = "test_guid"
 
+        with app.test_request_context():
+            yield
+
     def test_getTokenByGUID_raises_exception(self):
         self.mock_getTokenByGUID.side_effect = Exception("Fake Error")
 
@@ -200,14 +272,22 @@ class TestGetDirPath:
 class TestBuildMovieEntries:
     @pytest.fixture(autouse=True)
     def setUp(self, mocker):
-        self.mock_os = mocker.patch("waiter.os")
+        self.mock_media_index = mocker.patch("waiter.media_index")
         self.mock_buildFileDictHelper = mocker.patch("waiter._buildFileDictHelper")
         mocker.patch("waiter.BASE_PATH", "/base/path")
 
-        self.mock_os.path.join.side_effect = ["path/to/movie", "/base/path/to/movie"]
-        self.mock_os.walk.return_value = [
-            ("/root/path", [], ["file1", "file2", "file3"])
-        ]
+        self.directory = DirectoryEntry(
+            mtime=1,
+            scanned=1,
+            files={
+                "file1": FileStat(1, 1),
+                "file2": FileStat(1, 1),
+                "file3": FileStat(1, 1),
+            },
+            subdirs=(),
+            subtitles=(),
+        )
+        self.mock_media_index.walk.return_value = [(Path("/root/path"), self.directory)]
 
         self.token = {
             "path": "a/movie/path",
@@ -225,15 +305,19 @@ class TestBuildMovieEntries:
         assert expected == actual
 
         self.mock_buildFileDictHelper.assert_any_call(
-            Path("/root/path"), "file1", self.token
+            Path("/root/path"), "file1", self.token, self.directory
         )
         self.mock_buildFileDictHelper.assert_any_call(
-            Path("/root/path"), "file2", self.token
+            Path("/root/path"), "file2", self.token, self.directory
         )
         self.mock_buildFileDictHelper.assert_any_call(
-            Path("/root/path"), "file3", self.token
+            Path("/root/path"), "file3", self.token, self.directory
         )
 
+    def test_walks_movie_path(self):
+        buildEntries(self.token)
+        self.mock_media_index.walk.assert_called_once_with(Path("a/movie/path"))
+
     def test_no_valid_files(self):
         self.mock_buildFileDictHelper.return_value = None
 
@@ -242,20 +326,20 @@ class TestBuildMovieEntries:
         assert expected == actual
 
         self.mock_buildFileDictHelper.assert_any_call(
-            Path("/root/path"), "file1", self.token
+            Path("/root/path"), "file1", self.token, self.directory
         )
         self.mock_buildFileDictHelper.assert_any_call(
-            Path("/root/path"), "file2", self.token
+            Path("/root/path"), "file2", self.token, self.directory
         )
         self.mock_buildFileDictHelper.assert_any_call(
-            Path("/root/path"), "file3", self.token
+            Path("/root/path"), "file3", self.token, self.directory
         )
 
 
 class TestBuildFileDictHelper:
     @pytest.fixture(autouse=True)
     def setUp(self, mocker):
-        self.mock_getsize = mocker.patch("waiter.os.path.getsize")
+        self.mock_media_index = mocker.patch("waiter.media_index")
 
         mocker.patch("waiter.MINIMUM_FILE_SIZE", 10000000)
         mocker.patch("waiter.STREAMABLE_FILE_TYPES", ".mp4")
@@ -263,6 +347,8 @@ class TestBuildFileDictHelper:
         self.mock_hashed_filename = mocker.patch("waiter.hashed_filename")
         self.mock_buildWaiterPath = mocker.patch("waiter.buildWaiterPath")
         self.mock_humansize = mocker.patch("waiter.humansize")
+        self.mock_getMp4Info = mocker.patch("waiter._getMp4Info")
+        self.mock_getMp4Info.return_value = None
 
         self.token = {
             "filename": "some.dir",
@@ -272,8 +358,23 @@ class TestBuildFileDictHelper:
             "videoprogresses": [],
         }
 
+    def _set_size(self, filename, size):
+        self.mock_media_index.get_directory.return_value = DirectoryEntry(
+            mtime=1,
+            scanned=1,
+            files={filename: FileStat(size, 1)},
+            subdirs=(),
+            subtitles=(),
+        )
+
+    def test_missing_file(self):
+        self._set_size("other.mp4", 100000000)
+
+        with pytest.raises(FileNotFoundError):
+            _buildFileDictHelper("/root", "filename.mp4", self.token)
+
     def test_file_too_small(self):
-        self.mock_getsize.return_value = 1000000
+        self._set_size("filename.mp4", 1000000)
 
         expected = None
         actual = _buildFileDictHelper("/root", "filename.mp4", self.token)
@@ -283,7 +384,7 @@ class TestBuildFileDictHelper:
         assert not self.mock_isAlfredEncoding.called
 
     def test_file_not_streamable(self):
-        self.mock_getsize.return_value = 100000000
+        self._set_size("filename.mkv", 100000000)
 
         expected = None
         actual = _buildFileDictHelper("/root", "filename.mkv", self.token)
@@ -292,6 +393,119 @@ class TestBuildFileDictHelper:
         assert not self.mock_hashed_filename.called
         assert not self.mock_isAlfredEncoding.called
 
+    def test_subtitles(self):
+        self.mock_media_index.get_directory.return_value = DirectoryEntry(
+            mtime=1,
+            scanned=1,
+            files={"Episode 1.mp4": FileStat(100000000, 1)},
+            subdirs=(),
+            subtitles=("Episode 1.en.vtt", "Episode 1.vtt", "Episode 2.vtt"),
+        )
+        self.mock_hashed_filename.side_effect = lambda name: f"hash:{name}"
+
+        actual = _buildFileDictHelper("/root", "Episode 1.mp4", self.token)
+
+        assert [subtitle.path for subtitle in actual["subtitleFiles"]] == [
+            Path("/root/Episode 1.en.vtt"),
+            Path("/root/Episode 1.vtt"),
+        ]
+        assert [subtitle.hashed_filename for subtitle in actual["subtitleFiles"]] == [
+            "hash:some.dir/Episode 1.en.vtt",
+            "hash:some.dir/Episode 1.vtt",
+        ]
+
+    def test_duration(self):
+        self._set_size("filename.mp4", 100000000)
+        self.mock_getMp4Info.return_value = {"duration": 3725.2, "faststart": False}
+
+        actual = _buildFileDictHelper("/root", "filename.mp4", self.token)
+
+        assert actual["duration"] == "1:02:05"
+        assert actual["faststart"] is False
+        self.mock_getMp4Info.assert_called_once_with(
+            Path("/root/filename.mp4"), FileStat(100000000, 1)
+        )
+
+    def test_thumbnails(self, mocker):
+        mocker.patch("waiter.USE_THUMBNAILS", True)
+        mock_thumbnail_cache = mocker.patch("waiter.thumbnail_cache")
+        mock_thumbnail_cache.complete.return_value = True
+        self._set_size("filename.mp4", 100000000)
+        self.mock_getMp4Info.return_value = {"duration": 60.0, "faststart": True}
+
+        actual = _buildFileDictHelper("/root", "filename.mp4", self.token)
+
+        assert actual["thumbnailPath"] == self.mock_buildWaiterPath.return_value
+        self.mock_buildWaiterPath.assert_any_call(
+            "thumb", "asdf1234", self.mock_hashed_filename.return_value
+        )
+        mock_thumbnail_cache.complete.assert_called_once_with(
+            self.mock_hashed_filename.return_value, FileStat(100000000, 1)
+        )
+        assert not mock_thumbnail_cache.submit.called
+
+    def test_thumbnails_pending(self, mocker):
+        mocker.patch("waiter.USE_THUMBNAILS", True)
+        mock_thumbnail_cache = mocker.patch("waiter.thumbnail_cache")
+        mock_thumbnail_cache.complete.return_value = False
+        self._set_size("filename.mp4", 100000000)
+        self.mock_getMp4Info.return_value = {"duration": 60.0, "faststart": True}
+
+        actual = _buildFileDictHelper("/root", "filename.mp4", self.token)
+
+        assert actual["thumbnailPath"] == ""
+        mock_thumbnail_cache.submit.assert_called_once_with(
+            Path("/root/filename.mp4"),
+            FileStat(100000000, 1),
+            self.mock_hashed_filename.return_value,
+            60.0,
+        )
+
+    def test_thumbnails_disabled(self, mocker):
+        mocker.patch("waiter.USE_THUMBNAILS", False)
+        mock_thumbnail_cache = mocker.patch("waiter.thumbnail_cache")
+        self._set_size("filename.mp4", 100000000)
+
+        actual = _buildFileDictHelper("/root", "filename.mp4", self.token)
+
+        assert actual["thumbnailPath"] == ""
+        assert not mock_thumbnail_cache.submit.called
+
+    def test_no_mp4_info(self):
+        self._set_size("filename.mp4", 100000000)
+
+        actual = _buildFileDictHelper("/root", "filename.mp4", self.token)
+
+        assert actual["duration"] == ""
+        assert actual["faststart"] is None
+
+
+class TestGetMp4Info:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        self.mock_probe = mocker.patch("waiter.probe")
+        self.stat = FileStat(1000, 1)
+
+    def test_cached(self):
+        expected = self.mock_probe.return_value = {"duration": 1.0}
+
+        assert expected == _getMp4Info(Path("/some/file.mp4"), self.stat)
+        assert expected == _getMp4Info(Path("/some/file.mp4"), self.stat)
+        self.mock_probe.assert_called_once_with(Path("/some/file.mp4"), 1000)
+
+    def test_changed_file(self):
+        _getMp4Info(Path("/some/file.mp4"), self.stat)
+        _getMp4Info(Path("/some/file.mp4"), FileStat(1000, 2))
+
+        assert self.mock_probe.call_count == 2
+
+    def test_invalid_file(self):
+        self.mock_probe.side_effect = ValueError("not an mp4")
+
+        assert _getMp4Info(Path("/some/file.mp4"), self.stat) is None
+        assert _getMp4Info(Path("/some/file.mp4"), self.stat) is None
+        self.mock_probe.assert_called_once()
+
 
 class TestSendFileForDownload:
     @pytest.fixture(autouse=True)
@@ -304,6 +518,8 @@ class TestSendFileForDownload:
         self.mock_buildEntries = mocker.patch("waiter.buildEntries")
         self.mock_hashed_filename = mocker.patch("waiter.hashed_filename")
         self.mock_send_file_partial = mocker.patch("waiter.send_file_partial")
+        self.mock_directoryVersion = mocker.patch("waiter._directoryVersion")
+        self.mock_directoryVersion.return_value = ((Path("unhashed"), 1, 1),)
 
         self.token = {
             "path": "test_path",
@@ -316,6 +532,13 @@ class TestSendFileForDownload:
             {
                 "hashedWaiterPath": "hashPath",
                 "unhashedPath": Path("unhashed/path/to/file"),
+                "subtitleFiles": [
+                    Subtitle(
+                        path=Path("unhashed/path/to/file.vtt"),
+                        hashed_filename="subtitleHashPath",
+                        waiter_path="waiter/path",
+                    )
+                ],
             }
         ]
         self.mock_hashed_filename.return_value = "hashPath"
@@ -390,6 +613,158 @@ class TestSendFileForDownload:
             Path("unhashed/path/to/file"), "file"
         )
 
+    def test_subtitle_file(self):
+        expected = self.mock_send_file_partial.return_value
+        actual = send_file_for_download("guid", "subtitleHashPath")
+        assert expected == actual
+        self.mock_send_file_partial.assert_called_once_with(
+            Path("unhashed/path/to/file.vtt"), "file.vtt"
+        )
+
+    def test_hash_table_is_reused(self):
+        send_file_for_download("guid", "hashPath")
+        send_file_for_download("guid", "subtitleHashPath")
+
+        self.mock_buildEntries.assert_called_once_with(self.token)
+
+    def test_hash_table_is_rebuilt_for_new_directory_version(self):
+        send_file_for_download("guid", "hashPath")
+        self.mock_directoryVersion.return_value = ((Path("unhashed"), 2, 1),)
+        send_file_for_download("guid", "hashPath")
+
+        assert self.mock_buildEntries.call_count == 2
+
+
+class TestSendFilePartial:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        self.mock_media_index = mocker.patch("waiter.media_index")
+        self.mock_send_range = mocker.patch("waiter.send_range")
+        self.mock_xsendfile = mocker.patch("waiter.xsendfile")
+        mocker.patch("waiter.RANGE_CHUNK_SIZE", 100)
+        mocker.patch("waiter.USE_SENDFILE", True)
+        mocker.patch("waiter.USE_MMAP", False)
+        self.mock_getMp4Info = mocker.patch("waiter._getMp4Info")
+        self.mock_getMp4Info.return_value = {
+            "faststart": True,
+            "moov_offset": 0,
+            "moov_size": 100,
+        }
+        self.mock_warm_moov = mocker.patch("waiter.warm_moov")
+
+        self.stat = FileStat(1000, 1)
+        self.mock_media_index.get_directory.return_value = DirectoryEntry(
+            mtime=1,
+            scanned=1,
+            files={"file.mp4": self.stat},
+            subdirs=(),
+            subtitles=(),
+        )
+
+        with app.test_request_context():
+            yield
+
+    def test_nginx(self, mocker):
+        mocker.patch("waiter.USE_NGINX", True)
+
+        expected = self.mock_xsendfile.return_value
+        actual = send_file_partial(Path("/some/file.mp4"), "file.mp4")
+        assert expected == actual
+        assert not self.mock_send_range.called
+
+    def test_flask(self, mocker):
+        mocker.patch("waiter.USE_NGINX", False)
+
+        expected = self.mock_send_range.return_value
+        actual = send_file_partial(Path("/some/file.mp4"), "file.mp4")
+        assert expected == actual
+        self.mock_media_index.get_directory.assert_called_once_with(Path("/some"))
+        self.mock_send_range.assert_called_once_with(
+            Path("/some/file.mp4"),
+            stat=self.stat,
+            chunk_size=100,
+            use_sendfile=True,
+            chunk_cache=None,
+            use_mmap=False,
+        )
+
+    def test_flask_chunk_cache(self, mocker):
+        mocker.patch("waiter.USE_NGINX", False)
+        mock_chunk_cache = mocker.patch("waiter.chunk_cache")
+
+        send_file_partial(Path("/some/file.mp4"), "file.mp4")
+
+        self.mock_send_range.assert_called_once_with(
+            Path("/some/file.mp4"),
+            stat=self.stat,
+            chunk_size=100,
+            use_sendfile=True,
+            chunk_cache=mock_chunk_cache,
+            use_mmap=False,
+        )
+
+    def test_counts_bytes_served(self, mocker):
+        mocker.patch("waiter.USE_NGINX", False)
+        mock_inc = mocker.patch("waiter.metrics.inc")
+        self.mock_send_range.return_value.headers = {"Content-Length": "600"}
+
+        send_file_partial(Path("/some/file.mp4"), "file.mp4")
+
+        mock_inc.assert_called_once_with(
+            "mediawaiter_bytes_served_total", 600, send_path="flask"
+        )
+
+    def test_counts_nginx_bytes_served(self, mocker):
+        mocker.patch("waiter.USE_NGINX", True)
+        mock_inc = mocker.patch("waiter.metrics.inc")
+        self.mock_xsendfile.return_value.headers = {"Content-Length": "1000"}
+
+        send_file_partial(Path("/some/file.mp4"), "file.mp4")
+
+        mock_inc.assert_called_once_with(
+            "mediawaiter_bytes_served_total", 1000, send_path="nginx"
+        )
+
+    def test_faststart_not_warmed(self):
+        send_file_partial(Path("/some/file.mp4"), "file.mp4")
+
+        self.mock_getMp4Info.assert_called_once_with(Path("/some/file.mp4"), self.stat)
+        assert not self.mock_warm_moov.called
+
+    def test_warm_moov(self):
+        self.mock_getMp4Info.return_value["faststart"] = False
+
+        send_file_partial(Path("/some/file.mp4"), "file.mp4")
+
+        self.mock_warm_moov.assert_called_once_with(
+            Path("/some/file.mp4"), self.mock_getMp4Info.return_value
+        )
+
+    def test_warm_moov_from_start(self):
+        self.mock_getMp4Info.return_value["faststart"] = False
+
+        with app.test_request_context(headers={"Range": "bytes=0-99"}):
+            send_file_partial(Path("/some/file.mp4"), "file.mp4")
+
+        assert self.mock_warm_moov.called
+
+    def test_seek_not_warmed(self):
+        self.mock_getMp4Info.return_value["faststart"] = False
+
+        with app.test_request_context(headers={"Range": "bytes=500-"}):
+            send_file_partial(Path("/some/file.mp4"), "file.mp4")
+
+        assert not self.mock_warm_moov.called
+
+    def test_warm_moov_error(self, mocker):
+        mocker.patch("waiter.USE_NGINX", False)
+        self.mock_getMp4Info.return_value["faststart"] = False
+        self.mock_warm_moov.side_effect = OSError("gone")
+
+        expected = self.mock_send_range.return_value
+        actual = send_file_partial(Path("/some/file.mp4"), "file.mp4")
+        assert expected == actual
+
 
 class TestGetFile:
     @pytest.fixture(autouse=True)
@@ -406,7 +781,6 @@ class TestGetFile:
         self.mock_render_template = mocker.patch("waiter.render_template")
         self.mock_buildWaiterPath = mocker.patch("waiter.buildWaiterPath")
         self.mock_hashed_filename = mocker.patch("waiter.hashed_filename")
-        self.mock_getsize = mocker.patch("waiter.os.path.getsize")
         self.mock_humansize = mocker.patch("waiter.humansize")
         self.mock_isAlfredEncoding = mocker.patch("waiter.isAlfredEncoding")
         self.mock_buildEntries = mocker.patch("waiter.buildEntries")
@@ -430,6 +804,11 @@ class TestGetFile:
         self.mock_getTokenByGUID.return_value = self.token
         self.mock_checkForValidToken.return_value = None
         self.mock_hashed_filename.return_value = "test_hash"
+        self.mock_directoryVersion = mocker.patch("waiter._directoryVersion")
+        self.mock_directoryVersion.return_value = ((Path("test/path"), 1, 1),)
+
+        with app.test_request_context():
+            yield
 
     def test_invalid_token(self):
         self.mock_checkForValidToken.return_value = "got an error"
@@ -486,6 +865,24 @@ class TestGetFile:
             theme=DEFAULT_THEME,
         )
 
+    def test_genres_and_collections_are_fetched_concurrently(self):
+        collections_started = threading.Event()
+
+        def getMediaGenres(guid):
+            assert collections_started.wait(timeout=5)
+            return ("tv_genres", "movie_genres")
+
+        def get_collections(guid):
+            collections_started.set()
+            return ((1, "Test Name"),)
+
+        self.mock_getMediaGenres.side_effect = getMediaGenres
+        self.mock_get_collections.side_effect = get_collections
+
+        expected = self.mock_render_template.return_value
+        actual = get_file("guid")
+        assert expected == actual
+
     def test_valid_with_next_and_previous(self):
         self.token["next_id"] = 123
         self.token["previous_id"] = 234
@@ -546,6 +943,94 @@ class TestGetFile:
         )
 
 
+class TestGetFileEntryFromHash:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        self.mock_getPathFromHash = mocker.patch("waiter._getPathFromHash")
+        self.mock_getPathFromHash.return_value = (Path("/base/movie.mp4"), False)
+        self.mock_buildFileDictHelper = mocker.patch("waiter._buildFileDictHelper")
+        self.token = {"filename": "movie"}
+
+    def test_entry_from_entries(self):
+        entries = [
+            {"hashedWaiterPath": "other"},
+            {"hashedWaiterPath": "hash"},
+        ]
+
+        actual = _getFileEntryFromHash(self.token, "hash", entries)
+
+        assert actual is entries[1]
+        assert not self.mock_buildFileDictHelper.called
+
+    def test_no_entries(self):
+        actual = _getFileEntryFromHash(self.token, "hash")
+
+        assert actual == self.mock_buildFileDictHelper.return_value
+        self.mock_buildFileDictHelper.assert_called_once_with(
+            Path("/base"), "movie.mp4", self.token
+        )
+
+    def test_subtitle(self):
+        self.mock_getPathFromHash.return_value = (Path("/base/movie.vtt"), True)
+
+        actual = _getFileEntryFromHash(self.token, "hash", [])
+
+        assert actual == {"unhashedPath": Path("/base/movie.vtt")}
+
+
+class TestPlayerPages:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        mocker.patch("waiter.USE_HLS", True)
+        mocker.patch("waiter.getMediaGenres", return_value=("tv", "movie"))
+        mocker.patch("waiter.get_collections", return_value=())
+        mocker.patch("waiter.get_watch_party_url", return_value="party")
+        self.mock_render_template = mocker.patch("waiter.render_template")
+        self.mock_getTokenByGUID = mocker.patch("waiter.getTokenByGUID")
+        self.mock_getTokenByGUID.return_value = {
+            "isvalid": True,
+            "ismovie": False,
+            "guid": "guid",
+            "filename": "Show.S01E01.mp4",
+            "displayname": "Show",
+            "username": "some.user",
+            "tv_id": 1,
+            "tv_name": "Show",
+            "binge_mode": True,
+        }
+        self.entry = {
+            "path": "/waiter/file/guid/hash/",
+            "hashedWaiterPath": "hash",
+            "thumbnailPath": "/waiter/thumb/guid/hash",
+            "subtitleFiles": [],
+        }
+        mocker.patch("waiter.buildEntries", return_value=[self.entry])
+        mocker.patch("waiter._getFileEntryFromHash", return_value=self.entry)
+
+    @pytest.mark.parametrize("page", ["autoplay", "video"])
+    def test_player_sources(self, page):
+        with app.test_request_context():
+            if page == "autoplay":
+                autoplay("guid")
+            else:
+                video("guid", "hash")
+
+        kwargs = self.mock_render_template.call_args.kwargs
+        assert kwargs["hls_playlist"].endswith("/stream/guid/hash/hls/index.m3u8")
+        assert kwargs["poster"] == "/waiter/thumb/guid/hash"
+        assert kwargs["thumbnails"] == "/waiter/thumb/guid/hash/sprite.vtt"
+
+    def test_no_thumbnails(self):
+        self.entry["thumbnailPath"] = ""
+
+        with app.test_request_context():
+            autoplay("guid")
+
+        kwargs = self.mock_render_template.call_args.kwargs
+        assert kwargs["poster"] == ""
+        assert kwargs["thumbnails"] == ""
+
+
 class TestGetStatus:
     @pytest.fixture(autouse=True)
     def setUp(self, mocker, temp_directory):
@@ -574,3 +1059,742 @@ class TestGetStatus:
         expected = ({"status": False}, 500)
         actual = get_status()
         assert expected == actual
+
+
+class TestVideoOffset:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        self.mock_offset_buffer = mocker.patch("waiter.offset_buffer")
+        self.mock_getVideoOffset = mocker.patch("waiter.getVideoOffset")
+        self.mock_setVideoOffset = mocker.patch("waiter.setVideoOffset")
+        self.mock_deleteVideoOffset = mocker.patch("waiter.deleteVideoOffset")
+        self.mock_invalidateToken = mocker.patch("waiter.invalidateToken")
+        self.mock_recordProgress = mocker.patch("waiter.recordProgress")
+        self.mock_prefetcher = mocker.patch("waiter.prefetcher")
+        self.mock_token_cache = mocker.patch("waiter.token_cache")
+        self.mock_token_cache.get.return_value = {"guid": "guid"}
+        self.prefetch_plans = mocker.patch(
+            "waiter.prefetch_plans", TTLCache(maxsize=10, ttl=60)
+        )
+        mocker.patch("waiter.OFFSET_FLUSH_INTERVAL", 10)
+        mocker.patch("waiter.PREFETCH_NEXT_AT", 0.8)
+
+    def test_get_buffered(self):
+        self.mock_offset_buffer.get.return_value = "123.4"
+
+        with app.test_request_context(method="GET"):
+            actual = videoOffset("guid", "hash")
+
+        assert actual.json == {"offset": "123.4", "date_edited": None}
+        assert not self.mock_getVideoOffset.called
+
+    def test_get_from_mediaviewer(self):
+        self.mock_offset_buffer.get.return_value = None
+        self.mock_getVideoOffset.return_value = {"offset": 1, "date_edited": None}
+
+        with app.test_request_context(method="GET"):
+            actual = videoOffset("guid", "hash")
+
+        assert actual.json == {"offset": 1, "date_edited": None}
+        self.mock_getVideoOffset.assert_called_once_with("hash", "guid")
+
+    def test_post_is_buffered(self):
+        with app.test_request_context(method="POST", data={"offset": "123.4"}):
+            videoOffset("guid", "hash")
+
+        self.mock_offset_buffer.set.assert_called_once_with("guid", "hash", "123.4")
+        assert not self.mock_setVideoOffset.called
+        self.mock_recordProgress.assert_called_once_with("guid", "hash")
+        assert not self.mock_invalidateToken.called
+
+    def test_post_write_through(self, mocker):
+        mocker.patch("waiter.OFFSET_FLUSH_INTERVAL", 0)
+
+        with app.test_request_context(method="POST", data={"offset": "123.4"}):
+            videoOffset("guid", "hash")
+
+        self.mock_setVideoOffset.assert_called_once_with("hash", "guid", "123.4")
+        self.mock_recordProgress.assert_called_once_with("guid", "hash")
+        assert not self.mock_invalidateToken.called
+        assert not self.mock_offset_buffer.set.called
+
+    def test_post_prefetches_next_episode(self):
+        with app.test_request_context(method="POST", data={"offset": "123.4"}):
+            videoOffset("guid", "hash")
+
+        self.mock_prefetcher.submit.assert_called_once_with(
+            ("guid", "hash"),
+            _prefetchNextEpisode,
+            "guid",
+            "hash",
+            123.4,
+            {"guid": "guid"},
+        )
+
+    def test_prefetch_not_far_enough(self):
+        self.prefetch_plans.set(("guid", "hash"), (200.0, {"guid": "guid"}))
+
+        with app.test_request_context(method="POST", data={"offset": "123.4"}):
+            videoOffset("guid", "hash")
+
+        assert not self.mock_prefetcher.submit.called
+        assert not self.mock_token_cache.get.called
+
+    def test_prefetch_not_needed(self):
+        self.prefetch_plans.set(("guid", "hash"), None)
+
+        with app.test_request_context(method="POST", data={"offset": "123.4"}):
+            videoOffset("guid", "hash")
+
+        assert not self.mock_prefetcher.submit.called
+
+    def test_prefetch_disabled(self, mocker):
+        mocker.patch("waiter.PREFETCH_NEXT_AT", 0)
+
+        with app.test_request_context(method="POST", data={"offset": "123.4"}):
+            videoOffset("guid", "hash")
+
+        assert not self.mock_prefetcher.submit.called
+
+    def test_delete(self):
+        with app.test_request_context(method="DELETE"):
+            videoOffset("guid", "hash")
+
+        self.mock_offset_buffer.discard.assert_called_once_with("guid", "hash")
+        self.mock_deleteVideoOffset.assert_called_once_with("hash", "guid")
+        self.mock_invalidateToken.assert_called_once_with("guid")
+
+
+class TestMetrics:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        self.mock_metrics = mocker.patch("waiter.metrics")
+        self.mock_metrics.render.return_value = "# metrics\n"
+        mocker.patch("waiter.METRICS_TOKEN", "secret")
+        self.client = app.test_client()
+        self.headers = {"Authorization": "Bearer secret"}
+
+    def test_metrics(self):
+        response = self.client.get("/waiter/metrics", headers=self.headers)
+
+        assert response.status_code == 200
+        assert response.mimetype == "text/plain"
+        assert response.get_data(as_text=True) == "# metrics\n"
+
+    def test_disabled(self):
+        self.mock_metrics.enabled = False
+
+        response = self.client.get("/waiter/metrics", headers=self.headers)
+
+        assert response.status_code == 404
+
+    def test_no_token_configured(self, mocker):
+        mocker.patch("waiter.METRICS_TOKEN", "")
+
+        response = self.client.get("/waiter/metrics", headers=self.headers)
+
+        assert response.status_code == 404
+        assert not self.mock_metrics.render.called
+
+    @pytest.mark.parametrize(
+        "headers", [{}, {"Authorization": "Bearer wrong"}, {"Authorization": "Basic x"}]
+    )
+    def test_unauthorized(self, headers):
+        response = self.client.get("/waiter/metrics", headers=headers)
+
+        assert response.status_code == 401
+        assert not self.mock_metrics.render.called
+
+    def test_records_requests(self):
+        self.client.get("/waiter/metrics", headers=self.headers)
+
+        name, _ = self.mock_metrics.observe.call_args.args
+        assert name == "mediawaiter_request_duration_seconds"
+        self.mock_metrics.inc.assert_called_once_with(
+            "mediawaiter_requests_total",
+            endpoint="get_metrics",
+            method="GET",
+            status=200,
+        )
+
+    def test_unmatched_route(self):
+        self.client.get("/not/a/route")
+
+        self.mock_metrics.inc.assert_called_once_with(
+            "mediawaiter_requests_total",
+            endpoint="unmatched",
+            method="GET",
+            status=404,
+        )
+
+
+class TestGetProfile:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        mocker.patch("waiter.PROFILE_TOKEN", "secret")
+        self.mock_profiler = mocker.patch("waiter.profiler")
+        self.mock_profiler.sample.return_value = {"MainThread;main (x.py:1)": 3}
+        self.client = app.test_client()
+
+    def test_disabled(self, mocker):
+        mocker.patch("waiter.PROFILE_TOKEN", "")
+
+        response = self.client.get(
+            "/waiter/admin/profile", headers={"Authorization": "Bearer "}
+        )
+
+        assert response.status_code == 404
+        self.mock_profiler.sample.assert_not_called()
+
+    def test_missing_token(self):
+        response = self.client.get("/waiter/admin/profile")
+
+        assert response.status_code == 401
+        assert response.headers["WWW-Authenticate"] == "Bearer"
+        self.mock_profiler.sample.assert_not_called()
+
+    def test_wrong_token(self):
+        response = self.client.get(
+            "/waiter/admin/profile", headers={"Authorization": "Bearer wrong"}
+        )
+
+        assert response.status_code == 401
+        self.mock_profiler.sample.assert_not_called()
+
+    def test_profile(self):
+        response = self.client.get(
+            "/waiter/admin/profile?seconds=2.5",
+            headers={"Authorization": "Bearer secret"},
+        )
+
+        assert response.status_code == 200
+        assert response.text == "MainThread;main (x.py:1) 3\n"
+        self.mock_profiler.sample.assert_called_once_with(2.5)
+
+    @pytest.mark.parametrize("seconds", ["nan", "inf", "0", "-5", "abc"])
+    def test_invalid_seconds(self, seconds):
+        response = self.client.get(
+            f"/waiter/admin/profile?seconds={seconds}",
+            headers={"Authorization": "Bearer secret"},
+        )
+
+        assert response.status_code == 400
+        self.mock_profiler.sample.assert_not_called()
+
+    def test_busy(self, mocker):
+        self.mock_profiler.sample.side_effect = ProfilerBusy("busy")
+
+        response = self.client.get(
+            "/waiter/admin/profile", headers={"Authorization": "Bearer secret"}
+        )
+
+        assert response.status_code == 409
+
+
+class TestTracing:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_directory):
+        mocker.patch.object(tracer, "enabled", True)
+        mocker.patch.object(tracer, "path", temp_directory)
+        mocker.patch("tracing.os.getpid", return_value=1234)
+        self.mock_metrics = mocker.patch("waiter.metrics")
+        self.mock_metrics.render.return_value = ""
+        mocker.patch("waiter.METRICS_TOKEN", "secret")
+        self.file = temp_directory / "1234.json"
+
+    def _events(self):
+        return json.loads(self.file.read_text().rstrip(",\n") + "]")
+
+    def test_request_is_traced(self):
+        response = app.test_client().get(
+            "/waiter/metrics", headers={"Authorization": "Bearer secret"}
+        )
+        # Servers close the response once the body has been sent
+        response.close()
+
+        (request,) = self._events()
+        assert request["name"] == "get_metrics"
+        assert request["args"] == {"method": "GET", "status": 200}
+
+    def test_file_send_is_traced(self, mocker, temp_directory):
+        path = temp_directory / "video.mp4"
+        path.write_bytes(b"x" * 1000)
+        mocker.patch("waiter.USE_NGINX", False)
+        mocker.patch("waiter.getTokenByGUID", return_value={"isvalid": True})
+        mocker.patch("waiter._getPathFromHash", return_value=(path, None))
+
+        response = app.test_client().get(
+            "/waiter/file/guid/hash", headers={"Range": "bytes=0-99"}
+        )
+        assert response.status_code == 206
+        assert not self.file.exists()
+        response.close()
+
+        events = self._events()
+        request = next(
+            event for event in events if event["name"] == "send_file_for_download"
+        )
+        assert request["args"]["status"] == 206
+        assert "send_file" in [event["name"] for event in events]
+
+    def test_render_span(self):
+        with app.test_request_context():
+            app.preprocess_request()
+            render_template_string("{{ 1 + 1 }}")
+            tracer.finish(g.trace)
+
+        request, render = self._events()
+        assert render["name"] == "render"
+
+    def test_disabled(self, mocker):
+        mocker.patch.object(tracer, "enabled", False)
+
+        app.test_client().get("/waiter/metrics").close()
+
+        assert not self.file.exists()
+
+
+class TestPrefetchNextEpisode:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        mocker.patch("waiter.BASE_PATH", "/base")
+        mocker.patch("waiter.PREFETCH_NEXT_AT", 0.8)
+        mocker.patch("waiter.PREFETCH_NEXT_BYTES", 1000)
+        mocker.patch("waiter.USE_NGINX", False)
+        mocker.patch("waiter.MINIMUM_FILE_SIZE", 100)
+        mocker.patch("waiter.MEDIAVIEWER_SUFFIX", "mv")
+        mocker.patch("waiter.chunk_cache", None)
+        self.prefetch_plans = mocker.patch(
+            "waiter.prefetch_plans", TTLCache(maxsize=10, ttl=60)
+        )
+        self.mock_getTokenByGUID = mocker.patch("waiter.getTokenByGUID")
+        self.mock_getMp4Info = mocker.patch("waiter._getMp4Info")
+        self.mock_getMp4Info.return_value = {"duration": 100.0, "faststart": True}
+        self.mock_getHashTable = mocker.patch("waiter._getHashTable")
+        self.mock_warm_range = mocker.patch("waiter.warm_range")
+        self.mock_warm_moov = mocker.patch("waiter.warm_moov")
+        self.mock_media_index = mocker.patch("waiter.media_index")
+        self.directory = DirectoryEntry(
+            mtime=1,
+            scanned=1,
+            files={
+                "Show.S01E01.mv.mp4": FileStat(5000, 1),
+                "Show.S01E02.mv.mp4": FileStat(5000, 1),
+                "Show.S01E02.mv.srt": FileStat(10, 1),
+                "Show.S01E03.mv.mp4": FileStat(50, 1),
+            },
+            subdirs=(),
+            subtitles=("Show.S01E02.mv.vtt",),
+        )
+        self.mock_media_index.get_directory.return_value = self.directory
+
+        self.token = {
+            "isvalid": True,
+            "ismovie": False,
+            "binge_mode": True,
+            "next_id": 2,
+            "guid": "guid",
+            "path": "/mv/tv/Show",
+            "filename": "Show.S01E01.mv.mp4",
+            "displayname": "Show",
+            "videoprogresses": ["hash"],
+        }
+        self.mock_getTokenByGUID.return_value = self.token
+
+    def test_prefetches_next_episode(self):
+        assert _prefetchNextEpisode("guid", "hash", "85.0") is True
+
+        next_path = Path("/base/tv/Show/Show.S01E02.mv.mp4")
+        next_token, (entry,) = self.mock_getHashTable.call_args.args
+        assert next_token["filename"] == "Show.S01E02.mv.mp4"
+        assert next_token["videoprogresses"] == []
+        assert entry["unhashedPath"] == next_path
+        assert [subtitle.path for subtitle in entry["subtitleFiles"]] == [
+            Path("/base/tv/Show/Show.S01E02.mv.vtt")
+        ]
+        self.mock_warm_range.assert_called_once_with(next_path, 0, 1000)
+        assert not self.mock_warm_moov.called
+
+    def test_not_far_enough(self):
+        assert _prefetchNextEpisode("guid", "hash", "79.9") is False
+
+        assert not self.mock_getHashTable.called
+        assert not self.mock_warm_range.called
+        assert self.prefetch_plans.get(("guid", "hash")) == (80.0, self.token)
+
+    def test_plan_reused(self):
+        _prefetchNextEpisode("guid", "hash", "10.0")
+        self.mock_getTokenByGUID.return_value = None
+
+        assert _prefetchNextEpisode("guid", "hash", "85.0") is True
+        self.mock_getTokenByGUID.assert_called_once_with("guid")
+        self.mock_warm_range.assert_called_once()
+        assert self.prefetch_plans.get(("guid", "hash"), "missing") is None
+
+    def test_uses_token_given(self):
+        assert _prefetchNextEpisode("guid", "hash", "85.0", self.token) is True
+
+        assert not self.mock_getTokenByGUID.called
+        self.mock_warm_range.assert_called_once()
+
+    def test_done(self):
+        self.prefetch_plans.set(("guid", "hash"), None)
+
+        assert _prefetchNextEpisode("guid", "hash", "85.0") is True
+        assert not self.mock_getTokenByGUID.called
+        assert not self.mock_warm_range.called
+
+    def test_not_binge_watching(self):
+        self.token["binge_mode"] = False
+
+        assert _prefetchNextEpisode("guid", "hash", "85.0") is True
+        assert not self.mock_warm_range.called
+        assert self.prefetch_plans.get(("guid", "hash"), "missing") is None
+
+    def test_last_episode(self):
+        self.token["next_id"] = None
+
+        assert _prefetchNextEpisode("guid", "hash", "85.0") is True
+        assert not self.mock_warm_range.called
+
+    def test_no_next_file(self):
+        self.token["filename"] = "Show.S01E03.mv.mp4"
+
+        assert _prefetchNextEpisode("guid", "hash", "85.0") is True
+        assert not self.mock_warm_range.called
+
+    def test_next_file_not_streamable(self):
+        self.token["filename"] = "Show.S01E02.mv.mp4"
+
+        assert _prefetchNextEpisode("guid", "hash", "85.0") is True
+        assert not self.mock_getHashTable.called
+
+    def test_warms_moov(self):
+        self.mock_getMp4Info.return_value = {
+            "duration": 100.0,
+            "faststart": False,
+            "moov_offset": 4000,
+            "moov_size": 1000,
+        }
+
+        _prefetchNextEpisode("guid", "hash", "85.0")
+
+        self.mock_warm_moov.assert_called_once_with(
+            Path("/base/tv/Show/Show.S01E02.mv.mp4"),
+            self.mock_getMp4Info.return_value,
+        )
+
+    def test_chunk_cache(self, mocker):
+        mock_chunk_cache = mocker.patch("waiter.chunk_cache")
+        mock_chunk_cache.iter_range.return_value = iter([b"x"])
+
+        _prefetchNextEpisode("guid", "hash", "85.0")
+
+        mock_chunk_cache.iter_range.assert_called_once_with(
+            Path("/base/tv/Show/Show.S01E02.mv.mp4"), FileStat(5000, 1), 0, 1000
+        )
+        assert not self.mock_warm_range.called
+
+
+class TestConditionalPages:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        mocker.patch.dict(
+            app.view_functions,
+            {"get_file": lambda guid: "<html>page</html>"},
+        )
+        self.client = app.test_client()
+
+    def test_etag(self):
+        resp = self.client.get("/waiter/file/guid/")
+
+        assert resp.status_code == 200
+        assert resp.headers["ETag"]
+        assert resp.headers["Cache-Control"] == "private, no-cache"
+
+    def test_not_modified(self):
+        etag = self.client.get("/waiter/file/guid/").headers["ETag"]
+
+        resp = self.client.get("/waiter/file/guid/", headers={"If-None-Match": etag})
+
+        assert resp.status_code == 304
+        assert resp.data == b""
+
+    def test_other_endpoints_are_not_conditional(self, mocker):
+        mocker.patch.dict(
+            app.view_functions, {"get_status": lambda: "<html>status</html>"}
+        )
+
+        resp = self.client.get("/waiter/status")
+
+        assert "ETag" not in resp.headers
+        assert resp.headers["Cache-Control"] == "no-store"
+
+    def test_watch_party_is_not_conditional(self, mocker):
+        mocker.patch.dict(
+            app.view_functions,
+            {"watch_party": lambda guid, hashPath: "<html>party</html>"},
+        )
+
+        resp = self.client.get("/waiter/watch-party/guid/hash")
+
+        assert "ETag" not in resp.headers
+        assert resp.headers["Cache-Control"] == "no-store"
+
+
+class TestConditionalGet:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        self.token = {
+            "isvalid": True,
+            "ismovie": False,
+            "guid": "guid",
+            "filename": "test_filename.mp4",
+            "path": "test/path",
+            "displayname": "test_displayname",
+            "tv_id": 123,
+            "tv_name": "test_pathname",
+            "username": "some.user",
+            "binge_mode": True,
+            "videoprogresses": [],
+        }
+        mocker.patch("waiter.getTokenByGUID", side_effect=lambda guid: dict(self.token))
+        mocker.patch("waiter.checkForValidToken", return_value=None)
+        mocker.patch("waiter.getMediaGenres", return_value=([], []))
+        mocker.patch("waiter.get_collections", return_value=[])
+        self.mock_directoryVersion = mocker.patch("waiter._directoryVersion")
+        self.mock_directoryVersion.return_value = ((Path("test/path"), 1, 1),)
+        self.mock_render_template = mocker.patch(
+            "waiter.render_template", return_value="<html>page</html>"
+        )
+        self.mock_buildEntries = mocker.patch("waiter.buildEntries")
+        self.mock_buildEntries.return_value = [
+            {
+                "path": "/waiter/file/guid/hash/",
+                "subtitleFiles": [
+                    Subtitle(
+                        path=Path("test/path/file.vtt"),
+                        hashed_filename="subtitleHash",
+                        waiter_path="/waiter/file/guid/subtitleHash",
+                    )
+                ],
+            }
+        ]
+        self.client = app.test_client()
+
+    def test_page_not_modified(self):
+        etag = self.client.get("/waiter/file/guid/").headers["ETag"]
+        self.mock_buildEntries.reset_mock()
+        self.mock_render_template.reset_mock()
+
+        resp = self.client.get("/waiter/file/guid/", headers={"If-None-Match": etag})
+
+        assert resp.status_code == 304
+        assert resp.headers["ETag"] == etag
+        assert resp.headers["Cache-Control"] == "private, no-cache"
+        assert not self.mock_buildEntries.called
+        assert not self.mock_render_template.called
+
+    def test_entries_built_before_navigation_wait(self, mocker):
+        mock_navigation = mocker.patch("waiter._Navigation")
+        mock_navigation.return_value.result.side_effect = lambda: (
+            self.mock_buildEntries.called,
+            [],
+            [],
+        )
+
+        resp = self.client.get("/waiter/file/guid/")
+
+        assert resp.status_code == 200
+        self.mock_buildEntries.assert_called_once()
+        assert self.mock_render_template.call_args.kwargs["tv_genres"] is True
+
+    def test_stale_etag_builds_entries(self):
+        resp = self.client.get("/waiter/file/guid/", headers={"If-None-Match": "old"})
+
+        assert resp.status_code == 200
+        self.mock_buildEntries.assert_called_once()
+
+    def test_page_changes_with_directory(self):
+        etag = self.client.get("/waiter/file/guid/").headers["ETag"]
+        self.mock_directoryVersion.return_value = ((Path("test/path"), 2, 1),)
+
+        resp = self.client.get("/waiter/file/guid/", headers={"If-None-Match": etag})
+
+        assert resp.status_code == 200
+        assert resp.headers["ETag"] != etag
+
+    def test_page_changes_with_token(self):
+        etag = self.client.get("/waiter/file/guid/").headers["ETag"]
+        self.token["videoprogresses"] = ["hash"]
+
+        resp = self.client.get("/waiter/file/guid/", headers={"If-None-Match": etag})
+
+        assert resp.status_code == 200
+
+    def test_cli_links(self):
+        resp = self.client.get("/waiter/file/guid/cli/")
+
+        assert resp.status_code == 200
+        assert resp.json == {
+            "video_link": "/waiter/file/guid/hash/",
+            "subtitle_link": "/waiter/file/guid/subtitleHash",
+        }
+        assert resp.headers["ETag"]
+
+    def test_cli_links_not_modified(self):
+        etag = self.client.get("/waiter/dir/guid/cli/").headers["ETag"]
+        self.mock_buildEntries.reset_mock()
+
+        resp = self.client.get("/waiter/dir/guid/cli/", headers={"If-None-Match": etag})
+
+        assert resp.status_code == 304
+        assert not self.mock_buildEntries.called
+
+
+class TestHLS:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        mocker.patch("waiter.USE_HLS", True)
+        mocker.patch("waiter.EXTERNAL_MEDIAVIEWER_BASE_URL", "BASE_URL")
+        self.mock_getTokenByGUID = mocker.patch("waiter.getTokenByGUID")
+        self.mock_checkForValidToken = mocker.patch("waiter.checkForValidToken")
+        self.mock_checkForValidToken.return_value = None
+        self.mock_render_template = mocker.patch("waiter.render_template")
+        self.mock_getPathFromHash = mocker.patch("waiter._getPathFromHash")
+        self.mock_getPathFromHash.return_value = (Path("/base/movie.mp4"), False)
+        self.stat = FileStat(100, 1)
+        self.mock_media_index = mocker.patch("waiter.media_index")
+        self.mock_media_index.get_directory.return_value = DirectoryEntry(
+            mtime=1,
+            scanned=1,
+            files={"movie.mp4": self.stat},
+            subdirs=(),
+            subtitles=(),
+        )
+        self.mock_segment_cache = mocker.patch("waiter.segment_cache")
+        self.mock_send_range = mocker.patch("waiter.send_range")
+
+    def test_playlist(self):
+        actual = hls("guid", "hash", "index.m3u8")
+
+        assert actual == self.mock_send_range.return_value
+        self.mock_segment_cache.get_playlist.assert_called_once_with(
+            Path("/base/movie.mp4"), self.stat
+        )
+        self.mock_send_range.assert_called_once_with(
+            self.mock_segment_cache.get_playlist.return_value,
+            chunk_size=mock.ANY,
+            mimetype="application/vnd.apple.mpegurl",
+        )
+
+    def test_segment(self):
+        actual = hls("guid", "hash", "seg00001.ts")
+
+        assert actual == self.mock_send_range.return_value
+        self.mock_segment_cache.get_segment.assert_called_once_with(
+            Path("/base/movie.mp4"), self.stat, "seg00001.ts"
+        )
+        self.mock_send_range.assert_called_once_with(
+            self.mock_segment_cache.get_segment.return_value,
+            chunk_size=mock.ANY,
+            use_sendfile=mock.ANY,
+            mimetype="video/mp2t",
+        )
+
+    def test_disabled(self, mocker):
+        mocker.patch("waiter.USE_HLS", False)
+
+        actual = hls("guid", "hash", "index.m3u8")
+
+        assert actual == self.mock_render_template.return_value
+        assert not self.mock_segment_cache.get_playlist.called
+
+    def test_subtitle(self):
+        self.mock_getPathFromHash.return_value = (Path("/base/movie.vtt"), True)
+
+        actual = hls("guid", "hash", "index.m3u8")
+
+        assert actual == (self.mock_render_template.return_value, 400)
+        assert not self.mock_segment_cache.get_playlist.called
+
+
+class TestThumbnail:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        mocker.patch("waiter.USE_THUMBNAILS", True)
+        mocker.patch("waiter.EXTERNAL_MEDIAVIEWER_BASE_URL", "BASE_URL")
+        self.mock_getTokenByGUID = mocker.patch("waiter.getTokenByGUID")
+        self.mock_checkForValidToken = mocker.patch("waiter.checkForValidToken")
+        self.mock_checkForValidToken.return_value = None
+        self.mock_render_template = mocker.patch("waiter.render_template")
+        self.mock_getPathFromHash = mocker.patch("waiter._getPathFromHash")
+        self.mock_getPathFromHash.return_value = (Path("/base/movie.mp4"), False)
+        self.stat = FileStat(100, 1)
+        self.mock_media_index = mocker.patch("waiter.media_index")
+        self.mock_media_index.get_directory.return_value = DirectoryEntry(
+            mtime=1,
+            scanned=1,
+            files={"movie.mp4": self.stat},
+            subdirs=(),
+            subtitles=(),
+        )
+        self.mock_getMp4Info = mocker.patch("waiter._getMp4Info")
+        self.mock_getMp4Info.return_value = {"duration": 60.0}
+        self.mock_thumbnail_cache = mocker.patch("waiter.thumbnail_cache")
+        self.mock_send_range = mocker.patch("waiter.send_range")
+
+    def test_poster(self):
+        actual = thumbnail("guid", "hash", "poster.jpg")
+
+        assert actual == self.mock_send_range.return_value
+        self.mock_thumbnail_cache.get.assert_called_once_with(
+            Path("/base/movie.mp4"), self.stat, "hash", 60.0, "poster.jpg"
+        )
+        self.mock_send_range.assert_called_once_with(
+            self.mock_thumbnail_cache.get.return_value,
+            chunk_size=mock.ANY,
+            mimetype="image/jpeg",
+        )
+
+    def test_sprite_vtt(self):
+        thumbnail("guid", "hash", "sprite.vtt")
+
+        self.mock_send_range.assert_called_once_with(
+            self.mock_thumbnail_cache.get.return_value,
+            chunk_size=mock.ANY,
+            mimetype="text/vtt",
+        )
+
+    def test_pending(self):
+        self.mock_thumbnail_cache.get.return_value = None
+
+        actual = thumbnail("guid", "hash", "poster.jpg")
+
+        assert actual == ("", 404)
+        assert not self.mock_send_range.called
+
+    def test_poster_route(self):
+        client = app.test_client()
+
+        client.get("/waiter/thumb/guid/hash")
+
+        self.mock_thumbnail_cache.get.assert_called_once_with(
+            Path("/base/movie.mp4"), self.stat, "hash", 60.0, "poster.jpg"
+        )
+
+    def test_disabled(self, mocker):
+        mocker.patch("waiter.USE_THUMBNAILS", False)
+
+        actual = thumbnail("guid", "hash", "poster.jpg")
+
+        assert actual == self.mock_render_template.return_value
+        assert not self.mock_thumbnail_cache.get.called
+
+    def test_subtitle(self):
+        self.mock_getPathFromHash.return_value = (Path("/base/movie.vtt"), True)
+
+        actual = thumbnail("guid", "hash", "poster.jpg")
+
+        assert actual == (self.mock_render_template.return_value, 400)
+        assert not self.mock_thumbnail_cache.get.called
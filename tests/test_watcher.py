@@ -0,0 +1,156 @@
+import os
+import sys
+import pytest
+from media_index import MediaIndex
+from watcher import InotifyWatcher, PollingWatcher, start_watcher
+
+linux_only = pytest.mark.skipif(
+    not sys.platform.startswith("linux"), reason="inotify is Linux only"
+)
+
+
+@pytest.fixture(autouse=True)
+def patch_watcher_logger(mocker):
+    mocker.patch("watcher.logger")
+
+
+class TestPollingWatcher:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_directory):
+        self.dir = temp_directory
+        (self.dir / "Show").mkdir()
+        (self.dir / "Show" / "episode1.mp4").write_bytes(b"x")
+
+        self.index = MediaIndex(max_age=300)
+        self.watcher = PollingWatcher(self.index, [self.dir], interval=60)
+        mocker.patch.object(self.watcher, "_run")
+
+    def test_start_indexes_roots(self):
+        self.watcher.start()
+
+        assert self.index.directories() == [self.dir, self.dir / "Show"]
+
+    def test_watched_directories_are_not_stated(self, mocker):
+        self.watcher.start()
+        mock_stat = mocker.patch("media_index.os.stat")
+
+        entry = self.index.get_directory(self.dir / "Show")
+
+        assert "episode1.mp4" in entry.files
+        assert not mock_stat.called
+
+    def test_poll_picks_up_new_files(self):
+        self.watcher.start()
+
+        show = self.dir / "Show"
+        (show / "episode2.mp4").write_bytes(b"x")
+        stat = os.stat(show)
+        os.utime(show, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+        self.watcher.poll()
+
+        assert "episode2.mp4" in self.index.get_directory(show).files
+
+    def test_poll_drops_deleted_directories(self):
+        self.watcher.start()
+
+        (self.dir / "Show" / "episode1.mp4").unlink()
+        (self.dir / "Show").rmdir()
+        self.watcher.poll()
+
+        assert self.dir / "Show" not in self.index.directories()
+
+    def test_stop(self):
+        self.watcher.start()
+        self.watcher.stop()
+
+        assert not self.index._isWatched(self.dir)
+
+
+@linux_only
+class TestInotifyWatcher:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_directory):
+        self.dir = temp_directory
+        (self.dir / "Show").mkdir()
+
+        self.index = MediaIndex(max_age=300)
+        self.watcher = InotifyWatcher(self.index, [self.dir], delay=0.05)
+        mocker.patch.object(self.watcher, "_run")
+        self.watcher.start()
+        yield
+        os.close(self.watcher._fd)
+
+    def test_new_file(self):
+        (self.dir / "Show" / "episode1.mp4").write_bytes(b"x" * 10)
+        self.watcher.run_once(timeout=1)
+
+        entry = self.index.get_directory(self.dir / "Show")
+        assert entry.files["episode1.mp4"].size == 10
+
+    def test_file_grows(self):
+        path = self.dir / "Show" / "episode1.mp4"
+        path.write_bytes(b"x")
+        self.watcher.run_once(timeout=1)
+
+        with open(path, "ab") as f:
+            f.write(b"x" * 9)
+        self.watcher.run_once(timeout=1)
+
+        entry = self.index.get_directory(self.dir / "Show")
+        assert entry.files["episode1.mp4"].size == 10
+
+    def test_deleted_file(self):
+        path = self.dir / "Show" / "episode1.mp4"
+        path.write_bytes(b"x")
+        self.watcher.run_once(timeout=1)
+
+        path.unlink()
+        self.watcher.run_once(timeout=1)
+
+        assert "episode1.mp4" not in self.index.get_directory(self.dir / "Show").files
+
+    def test_renamed_file(self):
+        path = self.dir / "Show" / "episode1.mp4"
+        path.write_bytes(b"x")
+        self.watcher.run_once(timeout=1)
+
+        path.rename(self.dir / "Show" / "renamed.mp4")
+        self.watcher.run_once(timeout=1)
+
+        entry = self.index.get_directory(self.dir / "Show")
+        assert sorted(entry.files) == ["renamed.mp4"]
+
+    def test_new_directory(self):
+        season = self.dir / "Show" / "Season 1"
+        season.mkdir()
+        self.watcher.run_once(timeout=1)
+
+        (season / "episode1.mp4").write_bytes(b"x")
+        self.watcher.run_once(timeout=1)
+
+        assert "Season 1" in self.index.get_directory(self.dir / "Show").subdirs
+        assert "episode1.mp4" in self.index.get_directory(season).files
+
+
+class TestStartWatcher:
+    def test_none(self, temp_directory):
+        assert start_watcher(MediaIndex(), [temp_directory], mode="none") is None
+
+    def test_unknown(self, temp_directory):
+        with pytest.raises(ValueError):
+            start_watcher(MediaIndex(), [temp_directory], mode="fanotify")
+
+    def test_auto_falls_back_to_polling(self, mocker, temp_directory):
+        mocker.patch("watcher._loadLibc", side_effect=OSError("no inotify"))
+        mocker.patch.object(PollingWatcher, "_run")
+
+        watcher = start_watcher(MediaIndex(), [temp_directory], mode="auto")
+
+        assert isinstance(watcher, PollingWatcher)
+        watcher.stop()
+
+    def test_inotify_does_not_fall_back(self, mocker, temp_directory):
+        mocker.patch("watcher._loadLibc", side_effect=OSError("no inotify"))
+
+        with pytest.raises(OSError):
+            start_watcher(MediaIndex(), [temp_directory], mode="inotify")
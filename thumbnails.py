@@ -0,0 +1,302 @@
+import fcntl
+import math
+import os
+import shutil
+import subprocess
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from cache import TTLCache
+from log import logger
+from ranges import make_etag
+
+POSTER_NAME = "poster.jpg"
+SPRITE_NAME = "sprite.jpg"
+SPRITE_VTT_NAME = "sprite.vtt"
+THUMBNAIL_MIMETYPES = {
+    POSTER_NAME: "image/jpeg",
+    SPRITE_NAME: "image/jpeg",
+    SPRITE_VTT_NAME: "text/vtt",
+}
+
+LOCK_NAME = ".lock"
+POSTER_COMPLETE_NAME = ".poster"
+COMPLETE_NAME = ".complete"
+
+POSTER_WIDTH = 320
+TILE_WIDTH = 160
+TILE_HEIGHT = 90
+SPRITE_COLUMNS = 10
+MAX_TILES = 100
+
+
+class ThumbnailCache:
+    """Posters and seek preview sprites of media files, made by ffmpeg
+
+    Every source file gets a directory named after its hashed filename and
+    the size and mtime of the file, holding a poster, a sprite sheet of up
+    to MAX_TILES frames and a WebVTT file mapping times to tiles of the
+    sprite. Only keyframes are decoded for the sprite.
+
+    Jobs run on `workers` threads that each wait on one ffmpeg process, so
+    a worker never runs more than `workers` ffmpeg processes. The flock on
+    a directory's lock file keeps gunicorn workers from making the same
+    thumbnails twice. Once the cache is larger than max_size the thumbnails
+    requested least recently are removed.
+
+    The poster is made first and can be served as soon as it is done, while
+    the sprite is still being made.
+
+    At most max_pending jobs are queued in the background, and files that
+    ffmpeg failed on are not tried again for failure_ttl seconds.
+    """
+
+    def __init__(
+        self,
+        path,
+        max_size,
+        ffmpeg="ffmpeg",
+        workers=2,
+        interval=10,
+        timeout=600,
+        max_pending=64,
+        failure_ttl=3600,
+    ):
+        self.path = Path(path)
+        self.max_size = max_size
+        self.ffmpeg = ffmpeg
+        self.interval = interval
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self._pending = {}
+        self._failed = TTLCache(maxsize=1024, ttl=failure_ttl)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="thumbnails"
+        )
+
+    def directory(self, hashed_filename, stat):
+        return self.path / f"{hashed_filename}-{make_etag(stat.size, stat.mtime)}"
+
+    def submit(self, source, stat, hashed_filename, duration, force=False):
+        """Queue making the thumbnails of source
+
+        Returns the job's future, or None if the thumbnails already exist,
+        failed recently or max_pending jobs are already queued. Jobs are
+        queued past max_pending when force is set.
+        """
+        directory = self.directory(hashed_filename, stat)
+        with self._lock:
+            future = self._pending.get(directory)
+            if future is not None:
+                return future
+            if self._failed.get(directory):
+                return None
+        if (directory / COMPLETE_NAME).exists():
+            return None
+
+        with self._lock:
+            future = self._pending.get(directory)
+            if future is not None:
+                return future
+            if not force and len(self._pending) >= self.max_pending:
+                return None
+            future = self._executor.submit(self._generate, source, directory, duration)
+            self._pending[directory] = future
+        future.add_done_callback(lambda _: self._done(directory))
+        return future
+
+    def _done(self, directory):
+        with self._lock:
+            self._pending.pop(directory, None)
+
+    def complete(self, hashed_filename, stat):
+        """Whether every thumbnail of the file has been made"""
+        return (self.directory(hashed_filename, stat) / COMPLETE_NAME).exists()
+
+    def get(self, source, stat, hashed_filename, duration, name):
+        """Return the path of thumbnail name, or None if it is not made yet
+
+        Never waits for ffmpeg. Thumbnails that are not made yet are queued,
+        unless making them failed recently.
+        """
+        if name not in THUMBNAIL_MIMETYPES:
+            raise ValueError(f"Invalid thumbnail name: {name}")
+
+        directory = self.directory(hashed_filename, stat)
+        markers = [COMPLETE_NAME]
+        if name == POSTER_NAME:
+            markers.append(POSTER_COMPLETE_NAME)
+        if not any((directory / marker).exists() for marker in markers):
+            self.submit(source, stat, hashed_filename, duration, force=True)
+            return None
+        self.touch(directory)
+
+        thumbnail = directory / name
+        if not thumbnail.exists():
+            raise FileNotFoundError(f"{thumbnail} does not exist")
+        return thumbnail
+
+    def touch(self, directory):
+        # The directory mtime records when thumbnails were last requested
+        try:
+            os.utime(directory)
+        except FileNotFoundError:
+            pass
+
+    def _generate(self, source, directory, duration):
+        directory.mkdir(parents=True, exist_ok=True)
+        fd = os.open(directory / LOCK_NAME, os.O_RDWR | os.O_CREAT)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another worker is already making them
+                return
+
+            if (directory / COMPLETE_NAME).exists():
+                return
+
+            try:
+                self._run(self._posterCommand(source, directory, duration))
+                (directory / POSTER_COMPLETE_NAME).touch()
+                if duration:
+                    self._sprite(source, directory, duration)
+            except Exception:
+                self._failed.set(directory, True)
+                shutil.rmtree(directory, ignore_errors=True)
+                raise
+            (directory / COMPLETE_NAME).touch()
+        finally:
+            os.close(fd)
+
+        self.evict()
+
+    def _run(self, command):
+        process = subprocess.run(
+            command,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            timeout=self.timeout,
+        )
+        if process.returncode != 0:
+            raise Exception(
+                f"ffmpeg exited with {process.returncode}: "
+                f"{process.stderr.decode('utf-8', errors='replace')[-1000:]}"
+            )
+
+    def _posterCommand(self, source, directory, duration):
+        # Skip past opening logos and black frames
+        offset = duration / 10 if duration else 0
+        return [
+            self.ffmpeg,
+            "-nostdin",
+            "-loglevel",
+            "error",
+            "-ss",
+            f"{offset:.3f}",
+            "-i",
+            str(source),
+            "-frames:v",
+            "1",
+            "-vf",
+            f"scale={POSTER_WIDTH}:-2",
+            "-y",
+            str(directory / POSTER_NAME),
+        ]
+
+    def _tiles(self, duration):
+        """Return (seconds per tile, number of tiles) for a video"""
+        interval = max(self.interval, duration / MAX_TILES)
+        return interval, min(MAX_TILES, math.ceil(duration / interval))
+
+    def _spriteCommand(self, source, directory, duration):
+        interval, tiles = self._tiles(duration)
+        rows = math.ceil(tiles / SPRITE_COLUMNS)
+        filters = [
+            f"fps=1/{interval}",
+            f"scale={TILE_WIDTH}:{TILE_HEIGHT}:force_original_aspect_ratio=decrease",
+            f"pad={TILE_WIDTH}:{TILE_HEIGHT}:(ow-iw)/2:(oh-ih)/2",
+            f"tile={SPRITE_COLUMNS}x{rows}",
+        ]
+        return [
+            self.ffmpeg,
+            "-nostdin",
+            "-loglevel",
+            "error",
+            "-skip_frame",
+            "nokey",
+            "-i",
+            str(source),
+            "-vf",
+            ",".join(filters),
+            "-frames:v",
+            "1",
+            "-y",
+            str(directory / SPRITE_NAME),
+        ]
+
+    def _sprite(self, source, directory, duration):
+        self._run(self._spriteCommand(source, directory, duration))
+        (directory / SPRITE_VTT_NAME).write_text(self._spriteVtt(duration))
+
+    def _spriteVtt(self, duration):
+        interval, tiles = self._tiles(duration)
+        cues = ["WEBVTT", ""]
+        for i in range(tiles):
+            start = i * interval
+            stop = min(start + interval, duration)
+            x = i % SPRITE_COLUMNS * TILE_WIDTH
+            y = i // SPRITE_COLUMNS * TILE_HEIGHT
+            cues.append(f"{_timestamp(start)} --> {_timestamp(stop)}")
+            cues.append(f"{SPRITE_NAME}#xywh={x},{y},{TILE_WIDTH},{TILE_HEIGHT}")
+            cues.append("")
+        return "\n".join(cues)
+
+    def _isBusy(self, directory):
+        try:
+            fd = os.open(directory / LOCK_NAME, os.O_RDWR)
+        except FileNotFoundError:
+            return False
+
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(fd)
+        return False
+
+    def evict(self):
+        """Remove the least recently requested thumbnails until under max_size"""
+        entries = []
+        total = 0
+        try:
+            for directory in self.path.iterdir():
+                try:
+                    mtime = directory.stat().st_mtime
+                    size = sum(child.stat().st_size for child in directory.iterdir())
+                except (FileNotFoundError, NotADirectoryError):
+                    continue
+                entries.append((mtime, directory, size))
+                total += size
+        except FileNotFoundError:
+            return
+
+        for _, directory, size in sorted(entries):
+            if total <= self.max_size:
+                break
+            if self._isBusy(directory):
+                continue
+
+            logger().info(f"Evicting {directory} from the thumbnail cache")
+            shutil.rmtree(directory, ignore_errors=True)
+            total -= size
+
+
+def _timestamp(seconds):
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(int(minutes), 60)
+    return f"{hours:02d}:{minutes:02d}:{seconds:06.3f}"
@@ -0,0 +1,213 @@
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+from log import logger
+from settings import (
+    TRACING,
+    TRACE_PATH,
+    TRACE_SAMPLE_RATE,
+    TRACE_MIN_DURATION,
+    TRACE_MAX_SIZE,
+)
+
+_current = contextvars.ContextVar("trace", default=None)
+
+
+class Trace:
+    """Spans recorded while handling one request"""
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.tid = threading.get_native_id()
+        self.start = time.perf_counter_ns()
+        self.events = []
+        self.totals = {}
+
+
+class Tracer:
+    """Opt-in spans around the stages of each request
+
+    Sampled requests record a span per stage. When the response is closed
+    the request and its spans are appended to <pid>.json under path as
+    Chrome trace events, which Perfetto and chrome://tracing open directly.
+    Requests faster than min_duration seconds are dropped so that only the
+    slow ones are kept.
+
+    Stages run once per file, like hashing, are summed into the request's
+    args rather than getting a span per call. Nothing is recorded for
+    requests that are not sampled.
+    """
+
+    def __init__(
+        self,
+        path,
+        enabled=False,
+        sample_rate=1.0,
+        min_duration=0,
+        max_size=100 * 1024 * 1024,
+    ):
+        self.path = Path(path)
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.min_duration = min_duration
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # Timestamps come from perf_counter but are shifted to wall clock
+        # time so traces written by different workers line up
+        self._offset = time.time_ns() - time.perf_counter_ns()
+
+    def start(self, name, **args):
+        """Start tracing the current request if it is sampled"""
+        trace = None
+        if self.enabled and random.random() < self.sample_rate:
+            trace = Trace(name, args)
+        _current.set(trace)
+        return trace
+
+    def finish(self, trace, **args):
+        if trace is None:
+            return
+
+        duration = time.perf_counter_ns() - trace.start
+        if duration < self.min_duration * 1_000_000_000:
+            return
+
+        args = dict(trace.args, **args)
+        for name, (total, calls) in sorted(trace.totals.items()):
+            args[f"{name}_ms"] = round(total / 1_000_000, 3)
+            args[f"{name}_calls"] = calls
+        events = [self._event(trace.name, trace.start, duration, trace.tid, args)]
+        try:
+            self._write(events + trace.events)
+        except OSError as e:
+            logger().error(e)
+
+    def start_span(self, name, **args):
+        trace = _current.get()
+        if trace is None:
+            return None
+        return (trace, name, args, time.perf_counter_ns())
+
+    def end_span(self, span):
+        if span is None:
+            return
+        trace, name, args, start = span
+        trace.events.append(
+            self._event(
+                name,
+                start,
+                time.perf_counter_ns() - start,
+                threading.get_native_id(),
+                args,
+            )
+        )
+
+    @contextmanager
+    def span(self, name, **args):
+        span = self.start_span(name, **args)
+        try:
+            yield
+        finally:
+            self.end_span(span)
+
+    def traced(self, name):
+        """Decorate a function to run in a span"""
+
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                span = self.start_span(name)
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.end_span(span)
+
+            return wrapper
+
+        return decorator
+
+    @contextmanager
+    def accumulate(self, name):
+        """Add the time spent in the block to the request's total for name"""
+        trace = _current.get()
+        if trace is None:
+            yield
+            return
+
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            total = trace.totals.setdefault(name, [0, 0])
+            total[0] += time.perf_counter_ns() - start
+            total[1] += 1
+
+    def iterate(self, name, iterable):
+        """Yield from iterable, accumulating the time spent producing items"""
+        iterator = iter(iterable)
+        while True:
+            with self.accumulate(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def wrap(self, func):
+        """Return func bound to the current trace, for running in other threads"""
+        context = contextvars.copy_context()
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            return context.run(func, *args, **kwargs)
+
+        return wrapper
+
+    def _event(self, name, start, duration, tid, args):
+        return {
+            "name": name,
+            "cat": "waiter",
+            "ph": "X",
+            "ts": (self._offset + start) // 1000,
+            "dur": duration // 1000,
+            "pid": os.getpid(),
+            "tid": tid,
+            "args": args,
+        }
+
+    def _write(self, events):
+        # The JSON array format allows leaving out the closing bracket so
+        # events can be appended as they come
+        data = "".join(json.dumps(event, default=str) + ",\n" for event in events)
+        path = self.path / f"{os.getpid()}.json"
+        with self._lock:
+            self.path.mkdir(parents=True, exist_ok=True)
+            try:
+                size = path.stat().st_size
+            except FileNotFoundError:
+                size = 0
+            if size > self.max_size:
+                os.replace(path, path.with_suffix(".json.1"))
+                size = 0
+
+            with open(path, "a") as f:
+                if size == 0:
+                    f.write("[\n")
+                f.write(data)
+
+
+tracer = Tracer(
+    TRACE_PATH,
+    enabled=TRACING,
+    sample_rate=TRACE_SAMPLE_RATE,
+    min_duration=TRACE_MIN_DURATION,
+    max_size=TRACE_MAX_SIZE,
+)
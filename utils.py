@@ -1,7 +1,14 @@
 import time
 import requests
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+
 from log import logger
+from tracing import tracer
+from metrics import metrics, CACHE_REQUESTS, RETRIES, UPSTREAM_DURATION, UPSTREAM_ERRORS
 from settings import (
     APP_NAME,
     MEDIAVIEWER_BASE_URL,
@@ -13,8 +20,16 @@ from settings import (
     MEDIAWAITER_PROTOCOL,
     HOST,
     PORT,
-    REQUESTS_TIMEOUT,
+    OFFSET_REQUESTS_TIMEOUT,
+    METADATA_REQUESTS_TIMEOUT,
+    REQUESTS_POOL_SIZE,
+    REQUESTS_KEEP_ALIVE,
+    METADATA_CACHE_TTL,
+    METADATA_CACHE_SIZE,
+    HASH_CACHE_SIZE,
+    UPSTREAM_WORKERS,
 )
+from cache import get_cache, MISSING
 import hashlib
 
 
@@ -23,6 +38,80 @@ ONE_MB = 1000000
 suffixes = ["B", "KB", "MB", "GB", "TB", "PB"]
 
 
+class _InstrumentedSession(requests.Session):
+    """Session recording the latency and failures of every call in metrics"""
+
+    def request(self, method, url, *args, **kwargs):
+        endpoint = _upstreamEndpoint(url)
+        start = time.perf_counter()
+        try:
+            response = super().request(method, url, *args, **kwargs)
+        except Exception:
+            metrics.inc(UPSTREAM_ERRORS, endpoint=endpoint, method=method)
+            raise
+        finally:
+            metrics.observe(
+                UPSTREAM_DURATION,
+                time.perf_counter() - start,
+                endpoint=endpoint,
+                method=method,
+            )
+
+        if response.status_code >= 400:
+            metrics.inc(UPSTREAM_ERRORS, endpoint=endpoint, method=method)
+        return response
+
+
+def _upstreamEndpoint(url):
+    """Name a MediaViewer URL by its path without GUIDs, ids or filenames"""
+    if url.startswith(MEDIAVIEWER_BASE_URL):
+        path = url[len(MEDIAVIEWER_BASE_URL) :]
+    else:
+        path = urlsplit(url).path
+    parts = [part for part in path.split("/") if part]
+    if not parts:
+        return "/"
+    return "/".join(parts[:2] if parts[0] == "api" else parts[:1])
+
+
+def _buildSession():
+    session = _InstrumentedSession()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=REQUESTS_POOL_SIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if not REQUESTS_KEEP_ALIVE:
+        session.headers["Connection"] = "close"
+    return session
+
+
+# Every MediaViewer call goes through this session so connections are reused
+session = _buildSession()
+
+
+def connection_stats():
+    """Summarize connection reuse across the session's connection pools"""
+    stats = {"connections": 0, "requests": 0}
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            stats["connections"] += pool.num_connections
+            stats["requests"] += pool.num_requests
+
+    stats["reused"] = max(stats["requests"] - stats["connections"], 0)
+    return stats
+
+
+# Independent MediaViewer lookups are issued concurrently from this pool
+upstream_executor = ThreadPoolExecutor(
+    max_workers=UPSTREAM_WORKERS, thread_name_prefix="mediaviewer"
+)
+
+metadata_cache = get_cache(
+    "metadata", maxsize=METADATA_CACHE_SIZE, ttl=METADATA_CACHE_TTL
+)
+
+
 def humansize(nbytes):
     if nbytes == 0:
         return "0 B"
@@ -34,6 +123,14 @@ def humansize(nbytes):
     return f"{val} {suffixes[i]}"
 
 
+def humanduration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
+
 class delayedRetry:
     def __init__(self, attempts=5, interval=1):
         self.attempts = attempts
@@ -52,6 +149,8 @@ class delayedRetry:
                 except Exception as e:
                     logger().error(e)
                     last_exc = e
+                if i < self.attempts - 1:
+                    metrics.inc(RETRIES, function=func.__name__)
                 time.sleep(self.interval)
             else:
                 logger().error(f"Failure after {self.attempts} attempts")
@@ -60,6 +159,7 @@ class delayedRetry:
         return wrap
 
 
+@tracer.traced("check_token")
 def checkForValidToken(token, guid):
     if not token:
         logger().warn(f"Token is invalid GUID: {guid}")
@@ -86,11 +186,11 @@ def buildWaiterPath(place, guid, filePath, includeLastSlash=True):
 def getVideoOffset(filename, guid):
     data = {"offset": 0, "date_edited": None}
     try:
-        resp = requests.get(
+        resp = session.get(
             MEDIAVIEWER_GUID_OFFSET_URL % {"guid": guid, "filename": filename},
             auth=(WAITER_USERNAME, WAITER_PASSWORD),
             verify=VERIFY_REQUESTS,
-            timeout=REQUESTS_TIMEOUT,
+            timeout=OFFSET_REQUESTS_TIMEOUT,
         )
         resp.raise_for_status()
         resp = resp.json()
@@ -106,12 +206,12 @@ def getVideoOffset(filename, guid):
 def setVideoOffset(filename, guid, offset):
     data = {"offset": offset}
     try:
-        resp = requests.post(
+        resp = session.post(
             MEDIAVIEWER_GUID_OFFSET_URL % {"guid": guid, "filename": filename},
             auth=(WAITER_USERNAME, WAITER_PASSWORD),
             verify=VERIFY_REQUESTS,
             data=data,
-            timeout=REQUESTS_TIMEOUT,
+            timeout=OFFSET_REQUESTS_TIMEOUT,
         )
         resp.raise_for_status()
     except Exception as e:
@@ -121,11 +221,11 @@ def setVideoOffset(filename, guid, offset):
 
 def deleteVideoOffset(filename, guid):
     try:
-        resp = requests.delete(
+        resp = session.delete(
             MEDIAVIEWER_GUID_OFFSET_URL % {"guid": guid, "filename": filename},
             auth=(WAITER_USERNAME, WAITER_PASSWORD),
             verify=VERIFY_REQUESTS,
-            timeout=REQUESTS_TIMEOUT,
+            timeout=OFFSET_REQUESTS_TIMEOUT,
         )
         resp.raise_for_status()
     except Exception as e:
@@ -133,17 +233,28 @@ def deleteVideoOffset(filename, guid):
         raise
 
 
-def getMediaGenres(guid):
-    genre_url = MEDIAVIEWER_BASE_URL + f"/ajaxgenres/{guid}/"
+def _getCachedJSON(url):
+    data = metadata_cache.get(url, MISSING)
+    if data is not MISSING:
+        logger().debug(f"Using cached response for {url}")
+        return data
 
     try:
-        resp = requests.get(genre_url, timeout=REQUESTS_TIMEOUT)
+        resp = session.get(url, timeout=METADATA_REQUESTS_TIMEOUT)
         resp.raise_for_status()
     except Exception as e:
         logger().error(e)
         raise
 
     data = resp.json()
+    metadata_cache.set(url, data)
+    return data
+
+
+@tracer.traced("genres")
+def getMediaGenres(guid):
+    genre_url = MEDIAVIEWER_BASE_URL + f"/ajaxgenres/{guid}/"
+    data = _getCachedJSON(genre_url)
     tv_genres = [
         (mg[1], MEDIAVIEWER_BASE_URL + f"/tvshows/genre/{mg[0]}/")
         for mg in data["tv_genres"]
@@ -155,16 +266,10 @@ def getMediaGenres(guid):
     return tv_genres, movie_genres
 
 
+@tracer.traced("collections")
 def get_collections(guid):
-    genre_url = MEDIAVIEWER_BASE_URL + f"/ajaxcollections/{guid}/"
-    try:
-        resp = requests.get(genre_url, timeout=REQUESTS_TIMEOUT)
-        resp.raise_for_status()
-    except Exception as e:
-        logger().error(e)
-        raise
-
-    data = resp.json()
+    collection_url = MEDIAVIEWER_BASE_URL + f"/ajaxcollections/{guid}/"
+    data = _getCachedJSON(collection_url)
     collections = [
         (collection[1], MEDIAVIEWER_BASE_URL + f"/collections/{collection[0]}/")
         for collection in data["collections"]
@@ -172,6 +277,16 @@ def get_collections(guid):
     return collections
 
 
+@lru_cache(maxsize=HASH_CACHE_SIZE)
 def hashed_filename(filename):
     peppered_string = filename + SECRET_KEY
     return hashlib.sha256(peppered_string.encode("utf-8")).hexdigest()
+
+
+@metrics.collector
+def _hashedFilenameStats():
+    info = hashed_filename.cache_info()
+    return [
+        (CACHE_REQUESTS, {"cache": "hashed_filename", "result": "hit"}, info.hits),
+        (CACHE_REQUESTS, {"cache": "hashed_filename", "result": "miss"}, info.misses),
+    ]
@@ -1,13 +1,28 @@
-import os
 import secure
 import jwt
+import hashlib
+import hmac
+import math
+import json
 import random
 import string
+import time
 
+from bisect import bisect_right
 from collections import namedtuple
 from pathlib import Path
 from functools import wraps
-from flask import Flask, request, send_file, render_template, jsonify
+from flask import (
+    Flask,
+    Response,
+    before_render_template,
+    g,
+    jsonify,
+    render_template,
+    request,
+    send_file,
+    template_rendered,
+)
 from werkzeug.middleware.proxy_fix import ProxyFix
 from settings import (
     BASE_PATH,
@@ -16,6 +31,28 @@ from settings import (
     MEDIAVIEWER_GUID_URL,
     MEDIAVIEWER_VIEWED_URL,
     USE_NGINX,
+    USE_MMAP,
+    USE_SENDFILE,
+    RANGE_CHUNK_SIZE,
+    CHUNK_CACHE,
+    CHUNK_CACHE_SIZE,
+    CHUNK_CACHE_CHUNK_SIZE,
+    CHUNK_CACHE_READAHEAD,
+    CHUNK_CACHE_EVICT_INTERVAL,
+    CHUNK_CACHE_PATH,
+    USE_HLS,
+    FFMPEG_PATH,
+    HLS_SEGMENT_DURATION,
+    HLS_CACHE_SIZE,
+    HLS_CACHE_PATH,
+    USE_THUMBNAILS,
+    THUMBNAIL_WORKERS,
+    THUMBNAIL_INTERVAL,
+    THUMBNAIL_CACHE_SIZE,
+    THUMBNAIL_CACHE_PATH,
+    CACHE_PATH,
+    THUMBNAIL_QUEUE_SIZE,
+    THUMBNAIL_FAILURE_TTL,
     WAITER_USERNAME,
     WAITER_PASSWORD,
     MEDIAVIEWER_SUFFIX,
@@ -25,14 +62,33 @@ from settings import (
     MINIMUM_FILE_SIZE,
     EXTERNAL_MEDIAVIEWER_BASE_URL,
     GOOGLE_CAST_APP_ID,
-    REQUESTS_TIMEOUT,
+    TOKEN_REQUESTS_TIMEOUT,
+    VIEWED_REQUESTS_TIMEOUT,
     DEFAULT_THEME,
     JITSI_JWT_APP_ID,
     JITSI_JWT_APP_SECRET,
     JITSI_JWT_SUB,
+    TOKEN_CACHE_TTL,
+    TOKEN_CACHE_NEGATIVE_TTL,
+    TOKEN_CACHE_SIZE,
+    MEDIA_INDEX_MAX_AGE,
+    HASH_TABLE_CACHE_SIZE,
+    MP4_INFO_CACHE_SIZE,
+    MP4_INFO_CACHE_TTL,
+    OFFSET_FLUSH_INTERVAL,
+    PREFETCH_NEXT_AT,
+    PREFETCH_NEXT_BYTES,
+    PROFILE_TOKEN,
+    METRICS_TOKEN,
+    MEDIA_WATCHER,
+    MEDIA_WATCH_INTERVAL,
 )
 from utils import (
+    session,
+    connection_stats,
+    upstream_executor,
     humansize,
+    humanduration,
     delayedRetry,
     checkForValidToken,
     buildWaiterPath,
@@ -43,8 +99,21 @@ from utils import (
     getMediaGenres,
     get_collections,
 )
+from cache import TTLCache, SQLiteCache, get_cache, MISSING
+from media_index import MediaIndex
+from mp4 import probe, warm_moov
+from offset_buffer import OffsetBuffer
+from prefetch import Prefetcher, warm_range
+from fragments import render_navigation, render_file_rows
+from chunk_cache import ChunkCache
+from hls import SegmentCache, PLAYLIST_NAME, PLAYLIST_MIMETYPE, SEGMENT_MIMETYPE
+from ranges import send_range, call_on_close
+from thumbnails import ThumbnailCache, POSTER_NAME, THUMBNAIL_MIMETYPES
+from watcher import start_watcher
 from log import logger
-import requests
+from metrics import metrics, BYTES_SERVED, REQUEST_DURATION, REQUESTS
+from tracing import tracer
+from profiler import profiler, render as render_profile, ProfilerBusy
 
 rand = random.SystemRandom()
 
@@ -54,18 +123,124 @@ ROOM_NAME_LENGTH = 20
 Subtitle = namedtuple("Subtitle", "path,hashed_filename,waiter_path")
 STREAMABLE_FILE_TYPES = (".mp4",)
 
+media_index = MediaIndex(max_age=MEDIA_INDEX_MAX_AGE)
+hash_tables = TTLCache(
+    maxsize=HASH_TABLE_CACHE_SIZE, ttl=MEDIA_INDEX_MAX_AGE, name="hash_tables"
+)
+mp4_info_cache = get_cache("mp4", maxsize=MP4_INFO_CACHE_SIZE, ttl=MP4_INFO_CACHE_TTL)
+token_cache = get_cache("token", maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL)
+chunk_cache = (
+    ChunkCache(
+        CHUNK_CACHE_PATH,
+        CHUNK_CACHE_SIZE,
+        chunk_size=CHUNK_CACHE_CHUNK_SIZE,
+        readahead=CHUNK_CACHE_READAHEAD,
+        evict_interval=CHUNK_CACHE_EVICT_INTERVAL,
+    )
+    if CHUNK_CACHE
+    else None
+)
+segment_cache = SegmentCache(
+    HLS_CACHE_PATH,
+    HLS_CACHE_SIZE,
+    ffmpeg=FFMPEG_PATH,
+    segment_duration=HLS_SEGMENT_DURATION,
+)
+thumbnail_cache = ThumbnailCache(
+    THUMBNAIL_CACHE_PATH,
+    THUMBNAIL_CACHE_SIZE,
+    ffmpeg=FFMPEG_PATH,
+    workers=THUMBNAIL_WORKERS,
+    interval=THUMBNAIL_INTERVAL,
+    max_pending=THUMBNAIL_QUEUE_SIZE,
+    failure_ttl=THUMBNAIL_FAILURE_TTL,
+)
+
+offset_buffer = OffsetBuffer(
+    setVideoOffset,
+    flush_interval=OFFSET_FLUSH_INTERVAL,
+    deleter=deleteVideoOffset,
+    # Shared by every worker whatever MW_CACHE_BACKEND is, since any of them
+    # may hold an offset another one is asked to delete
+    tombstones=SQLiteCache(
+        CACHE_PATH, "offset_tombstones", ttl=max(OFFSET_FLUSH_INTERVAL * 6, 60)
+    ),
+)
+prefetcher = Prefetcher()
+# When the next episode of (guid, hashed filename) should be prefetched,
+# as (offset in seconds, token), or None once it never needs to be
+prefetch_plans = TTLCache(maxsize=1024, ttl=3600)
+
 app = Flask(__name__, static_url_path="/static", static_folder="/var/static")
+app.add_template_global(render_navigation)
+app.add_template_global(render_file_rows)
 
 
 secure_headers = secure.Secure()
 
+# Endpoints whose responses get an ETag and can be answered with a 304
+conditional_endpoints = set()
+
+
+def conditionalResponse(func):
+    conditional_endpoints.add(func.__name__)
+    return func
+
 
 @app.after_request
 def set_secure_headers(response):
     secure_headers.framework.flask(response)
+    if request.endpoint in conditional_endpoints:
+        _makeConditional(response)
     return response
 
 
+def _makeConditional(response):
+    if request.method != "GET" or response.status_code not in (200, 304):
+        return
+
+    # Responses are per user so only the client may keep them, and it must
+    # revalidate before reusing one
+    response.headers["Cache-Control"] = "private, no-cache"
+    if (
+        response.status_code != 200
+        or response.mimetype not in ("text/html", "application/json")
+        or response.is_streamed
+    ):
+        return
+
+    if "etag" in g:
+        response.set_etag(g.etag)
+    else:
+        response.add_etag()
+    response.make_conditional(request)
+
+
+def _templatesVersion():
+    digest = hashlib.sha256()
+    for path in sorted(Path(app.root_path, app.template_folder).glob("*.html")):
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+TEMPLATES_VERSION = _templatesVersion()
+
+
+def _notModified(*state):
+    """Return a 304 if the client already has the response built from state
+
+    The ETag is a hash of state and the templates so it can be checked
+    before anything is rendered. It is also used for the full response.
+    """
+    data = json.dumps([TEMPLATES_VERSION, *state], sort_keys=True, default=str)
+    g.etag = hashlib.sha256(data.encode("utf-8")).hexdigest()
+    if request.if_none_match.contains(g.etag):
+        response = Response(status=304)
+        response.set_etag(g.etag)
+        return response
+    return None
+
+
 def _extract_donation_info(token):
     donation_site = token.get("donation_site")
     if donation_site:
@@ -114,14 +289,51 @@ def isAlfredEncoding(filename):
     return MEDIAVIEWER_SUFFIX.lower() in filename.lower()
 
 
-@delayedRetry(attempts=5, interval=1)
+@tracer.traced("token")
 def getTokenByGUID(guid):
+    token = token_cache.get(guid, MISSING)
+    if token is MISSING:
+        token = _fetchTokenByGUID(guid)
+        token_cache.set(
+            guid,
+            token,
+            ttl=(
+                TOKEN_CACHE_TTL
+                if token and token.get("isvalid")
+                else TOKEN_CACHE_NEGATIVE_TTL
+            ),
+        )
+    else:
+        logger().debug(f"Using cached token for GUID: {guid}")
+
+    # Callers decorate the token in place so never hand out the cached dict
+    return dict(token) if token else token
+
+
+def invalidateToken(guid):
+    token_cache.delete(guid)
+
+
+def recordProgress(guid, hashedFilename):
+    """Mark hashedFilename as having progress in the cached token
+
+    The player posts its position every few seconds, so the cached token is
+    updated rather than evicted and fetched again.
+    """
+    token = token_cache.get(guid)
+    if token and hashedFilename not in token.get("videoprogresses", []):
+        videoprogresses = [*token.get("videoprogresses", []), hashedFilename]
+        token_cache.set(guid, dict(token, videoprogresses=videoprogresses))
+
+
+@delayedRetry(attempts=5, interval=1)
+def _fetchTokenByGUID(guid):
     try:
-        data = requests.get(
+        data = session.get(
             MEDIAVIEWER_GUID_URL % {"guid": guid},
             auth=(WAITER_USERNAME, WAITER_PASSWORD),
             verify=VERIFY_REQUESTS,
-            timeout=REQUESTS_TIMEOUT,
+            timeout=TOKEN_REQUESTS_TIMEOUT,
         )
         return data.json()
     except Exception as e:
@@ -129,7 +341,21 @@ def getTokenByGUID(guid):
         raise
 
 
+class _Navigation:
+    """Genre and collection lookups running in the background"""
+
+    def __init__(self, guid):
+        self.genres = upstream_executor.submit(tracer.wrap(getMediaGenres), guid)
+        self.collections = upstream_executor.submit(tracer.wrap(get_collections), guid)
+
+    def result(self):
+        with tracer.span("navigation_wait"):
+            tv_genres, movie_genres = self.genres.result()
+            return tv_genres, movie_genres, self.collections.result()
+
+
 @app.route(APP_NAME + "/dir/<guid>/")
+@conditionalResponse
 @logErrorsAndContinue
 def get_dirPath(guid):
     """Display a page that lists all media files in a given directory"""
@@ -144,18 +370,25 @@ def get_dirPath(guid):
             theme=token.get("theme", DEFAULT_THEME),
         )
 
-    files = []
-    if token["ismovie"]:
-        files.extend(buildEntries(token))
-    else:
+    if not token["ismovie"]:
         raise ValueError(
             f"Only movies are allowed to display contents of directories. "
             f"GUID = {guid}"
         )
+
+    navigation = _Navigation(guid)
+    version = _directoryVersion(token)
+    # Walk while the navigation is fetched unless the page may be a 304
+    files = None if request.if_none_match else buildEntries(token)
+    tv_genres, movie_genres, collections = navigation.result()
+    not_modified = _notModified(token, version, tv_genres, movie_genres, collections)
+    if not_modified:
+        return not_modified
+
+    if files is None:
+        files = buildEntries(token)
     files.sort(key=lambda x: x["filename"])
 
-    tv_genres, movie_genres = getMediaGenres(guid)
-    collections = get_collections(guid)
     token = _extract_donation_info(token)
     return render_template(
         "display.html",
@@ -180,21 +413,19 @@ def get_dirPath(guid):
     )
 
 
+@tracer.traced("build_entries")
 def buildEntries(token):
     files = []
     if token["ismovie"]:
         fullMoviePath = Path(token["path"])
 
-        for root, subFolders, filenames in os.walk(fullMoviePath):
-            for filename in filenames:
-                filesDict = _buildFileDictHelper(Path(root), filename, token)
+        for root, directory in tracer.iterate("walk", media_index.walk(fullMoviePath)):
+            for filename in directory.files:
+                filesDict = _buildFileDictHelper(root, filename, token, directory)
                 if filesDict:
                     files.append(filesDict)
     else:
-        fullMoviePath = (
-            Path(BASE_PATH).joinpath(*Path(token["path"]).parts[-2:])
-            / token["filename"]
-        )
+        fullMoviePath = _getTVFilePath(token)
         files.append(
             _buildFileDictHelper(fullMoviePath.parent, fullMoviePath.parts[-1], token)
         )
@@ -202,9 +433,41 @@ def buildEntries(token):
     return files
 
 
-def _buildFileDictHelper(root, filename, token):
+def start_media_watcher():
+    """Start keeping the media index current. Call once per worker process"""
+    roots = [Path(BASE_PATH) / media_dir for media_dir in MEDIA_DIRS] or [
+        Path(BASE_PATH)
+    ]
+    return start_watcher(
+        media_index, roots, mode=MEDIA_WATCHER, poll_interval=MEDIA_WATCH_INTERVAL
+    )
+
+
+def _getTVFilePath(token):
+    return Path(BASE_PATH).joinpath(*Path(token["path"]).parts[-2:]) / token["filename"]
+
+
+def _directoryVersion(token):
+    """Identify the current listing of every directory a token can serve from"""
+    if token["ismovie"]:
+        directories = media_index.walk(Path(token["path"]))
+    else:
+        parent = _getTVFilePath(token).parent
+        directories = [(parent, media_index.get_directory(parent))]
+
+    return tuple((path, entry.mtime, entry.scanned) for path, entry in directories)
+
+
+def _buildFileDictHelper(root, filename, token, directory=None):
     path = Path(root) / filename
-    size = os.path.getsize(path)
+    if directory is None:
+        directory = media_index.get_directory(path.parent)
+
+    stat = directory.files.get(filename)
+    if stat is None:
+        raise FileNotFoundError(f"{path} does not exist")
+
+    size = stat.size
     ext = path.suffix.lower()
 
     # Files smaller than 10MB probably aren't video files
@@ -216,24 +479,39 @@ def _buildFileDictHelper(root, filename, token):
         return None
 
     waiterPath = Path(token["filename"]) / filename
-    hashedWaiterPath = hashed_filename(str(waiterPath))
+    with tracer.accumulate("hashing"):
+        hashedWaiterPath = hashed_filename(str(waiterPath))
 
     streamingPath = buildWaiterPath(
         "stream", token["guid"], hashedWaiterPath, includeLastSlash=True
     )
 
     subtitle_files = []
-    for subtitle_file in path.parent.glob("*.vtt"):
-        if str(Path(filename).stem) in str(subtitle_file):
+    with tracer.accumulate("subtitles"):
+        subtitle_names = directory.subtitles_for(path.stem)
+    for subtitle_name in subtitle_names:
+        with tracer.accumulate("hashing"):
             hashedSubtitleFile = hashed_filename(
-                str(Path(token["filename"]) / subtitle_file.name)
-            )
-            subtitle = Subtitle(
-                path=subtitle_file,
-                hashed_filename=hashedSubtitleFile,
-                waiter_path=buildWaiterPath("file", token["guid"], hashedSubtitleFile),
+                str(Path(token["filename"]) / subtitle_name)
             )
-            subtitle_files.append(subtitle)
+        subtitle = Subtitle(
+            path=path.parent / subtitle_name,
+            hashed_filename=hashedSubtitleFile,
+            waiter_path=buildWaiterPath("file", token["guid"], hashedSubtitleFile),
+        )
+        subtitle_files.append(subtitle)
+
+    with tracer.accumulate("mp4_info"):
+        info = _getMp4Info(path, stat)
+    duration = info["duration"] if info else None
+
+    # Rows only link thumbnails once they are all made, so pages never wait
+    thumbnailPath = ""
+    if USE_THUMBNAILS:
+        if thumbnail_cache.complete(hashedWaiterPath, stat):
+            thumbnailPath = buildWaiterPath("thumb", token["guid"], hashedWaiterPath)
+        else:
+            thumbnail_cache.submit(path, stat, hashedWaiterPath, duration)
 
     fileDict = {
         "path": buildWaiterPath(
@@ -250,23 +528,51 @@ def _buildFileDictHelper(root, filename, token):
         "ismovie": token["ismovie"],
         "displayName": token["displayname"],
         "hasProgress": hashedWaiterPath in token["videoprogresses"],
+        "duration": humanduration(duration) if duration else "",
+        "faststart": info["faststart"] if info else None,
+        "thumbnailPath": thumbnailPath,
     }
     return fileDict
 
 
-def _getFileEntryFromHash(token, hashPath):
-    entries = buildEntries(token)
-    for entry in entries:
-        if entry["hashedWaiterPath"] == hashPath:
-            return entry
+def _getHashTable(token, entries=None):
+    """Map every hashed waiter path of a token to (real path, is_subtitle)
 
-        for subtitle in entry["subtitleFiles"]:
-            if subtitle.hashed_filename == hashPath:
-                return {"unhashedPath": subtitle.path}
-    else:
+    Tables only depend on the token's filename and the directory listings so
+    they are shared by every GUID and route until a directory changes.
+    """
+    key = (token["filename"], _directoryVersion(token))
+    table = hash_tables.get(key)
+    if table is None:
+        if entries is None:
+            entries = buildEntries(token)
+
+        table = {}
+        for entry in entries:
+            table[entry["hashedWaiterPath"]] = (entry["unhashedPath"], False)
+            for subtitle in entry["subtitleFiles"]:
+                table[subtitle.hashed_filename] = (subtitle.path, True)
+        hash_tables.set(key, table)
+    return table
+
+
+def _getPathFromHash(token, hashPath, entries=None):
+    try:
+        return _getHashTable(token, entries)[hashPath]
+    except KeyError:
         raise Exception("Unable to find matching path")
 
 
+def _getFileEntryFromHash(token, hashPath, entries=None):
+    path, is_subtitle = _getPathFromHash(token, hashPath, entries)
+    if is_subtitle:
+        return {"unhashedPath": path}
+    for entry in entries or ():
+        if entry["hashedWaiterPath"] == hashPath:
+            return entry
+    return _buildFileDictHelper(path.parent, path.name, token)
+
+
 @app.route(APP_NAME + "/file/<guid>/<path:hashPath>")
 @logErrorsAndContinue
 def send_file_for_download(guid, hashPath):
@@ -283,11 +589,12 @@ def send_file_for_download(guid, hashPath):
             theme=token.get("theme", DEFAULT_THEME),
         )
 
-    fullPath = _getFileEntryFromHash(token, hashPath)["unhashedPath"]
+    fullPath, _ = _getPathFromHash(token, hashPath)
     return send_file_partial(fullPath, fullPath.name)
 
 
 @app.route(APP_NAME + "/file/<guid>/")
+@conditionalResponse
 @logErrorsAndContinue
 def get_file(guid):
     """Display a page that lists a single file"""
@@ -303,9 +610,17 @@ def get_file(guid):
             theme=token.get("theme", DEFAULT_THEME),
         )
 
-    files = buildEntries(token)
-    tv_genres, movie_genres = getMediaGenres(guid)
-    collections = get_collections(guid)
+    navigation = _Navigation(guid)
+    version = _directoryVersion(token)
+    # Walk while the navigation is fetched unless the page may be a 304
+    files = None if request.if_none_match else buildEntries(token)
+    tv_genres, movie_genres, collections = navigation.result()
+    not_modified = _notModified(token, version, tv_genres, movie_genres, collections)
+    if not_modified:
+        return not_modified
+
+    if files is None:
+        files = buildEntries(token)
     token = _extract_donation_info(token)
     return render_template(
         "display.html",
@@ -339,6 +654,7 @@ def get_file(guid):
 
 
 @app.route(APP_NAME + "/file/<guid>/autoplay")
+@conditionalResponse
 @logErrorsAndContinue
 def autoplay(guid):
     """Autoplay a single file"""
@@ -354,10 +670,10 @@ def autoplay(guid):
             theme=token.get("theme", DEFAULT_THEME),
         )
 
+    navigation = _Navigation(guid)
     files = buildEntries(token)
     file_entry = files[0]
-    tv_genres, movie_genres = getMediaGenres(guid)
-    collections = get_collections(guid)
+    tv_genres, movie_genres, collections = navigation.result()
     token = _extract_donation_info(token)
 
     watch_party_url = get_watch_party_url(
@@ -369,6 +685,7 @@ def autoplay(guid):
         title=token["displayname"],
         filename=token["filename"],
         hashPath=file_entry["hashedWaiterPath"],
+        **_playerSources(guid, file_entry),
         video_file=file_entry["path"],
         subtitle_files=[
             subtitle.waiter_path for subtitle in file_entry["subtitleFiles"]
@@ -421,24 +738,37 @@ def _cli_links(guid):
     if errorStr:
         return jsonify({"error": errorStr})
 
+    not_modified = _notModified(
+        guid,
+        token["filename"],
+        token["path"],
+        token["ismovie"],
+        _directoryVersion(token),
+    )
+    if not_modified:
+        return not_modified
+
     files = buildEntries(token)
     file_entry = files[0]
+    subtitle_files = file_entry["subtitleFiles"]
 
     return jsonify(
         {
             "video_link": file_entry["path"],
-            "subtitle_link": file_entry["subtitleWaiterPath"],
+            "subtitle_link": subtitle_files[0].waiter_path if subtitle_files else None,
         }
     )
 
 
 @app.route(APP_NAME + "/file/<guid>/cli/")
+@conditionalResponse
 @logErrorsAndContinue
 def tv_cli_links(guid):
     return _cli_links(guid)
 
 
 @app.route(APP_NAME + "/dir/<guid>/cli/")
+@conditionalResponse
 @logErrorsAndContinue
 def movie_cli_links(guid):
     return _cli_links(guid)
@@ -472,9 +802,103 @@ def get_status():
     return res, 200 if res["status"] else 500
 
 
+@app.route(APP_NAME + "/status/connections/", methods=["GET"])
+@app.route(APP_NAME + "/status/connections", methods=["GET"])
+def get_connection_status():
+    return connection_stats(), 200
+
+
+def _bearerAuthorized(token):
+    auth = request.authorization
+    return (
+        auth is not None
+        and auth.type == "bearer"
+        and hmac.compare_digest(auth.token or "", token)
+    )
+
+
+@app.route(APP_NAME + "/metrics/", methods=["GET"])
+@app.route(APP_NAME + "/metrics", methods=["GET"])
+def get_metrics():
+    """Metrics of every worker in the Prometheus text format
+
+    Only requests sending METRICS_TOKEN as a bearer token are served.
+    """
+    if not metrics.enabled or not METRICS_TOKEN:
+        return "Metrics are disabled", 404
+    if not _bearerAuthorized(METRICS_TOKEN):
+        return "Unauthorized", 401, {"WWW-Authenticate": "Bearer"}
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route(APP_NAME + "/admin/profile/", methods=["GET"])
+@app.route(APP_NAME + "/admin/profile", methods=["GET"])
+def get_profile():
+    """Collapsed stacks of this worker's other threads over ?seconds=N
+
+    Only requests sending PROFILE_TOKEN as a bearer token are served. Sync
+    workers run nothing else while serving this, so send them SIGUSR2
+    instead.
+    """
+    if not PROFILE_TOKEN:
+        return "Profiling is disabled", 404
+
+    if not _bearerAuthorized(PROFILE_TOKEN):
+        return "Unauthorized", 401, {"WWW-Authenticate": "Bearer"}
+
+    try:
+        seconds = float(request.args.get("seconds", 10))
+    except ValueError:
+        seconds = math.nan
+    if not math.isfinite(seconds) or seconds <= 0:
+        return "seconds must be a positive number", 400
+
+    try:
+        stacks = profiler.sample(seconds)
+    except ProfilerBusy as e:
+        return str(e), 409
+    return Response(render_profile(stacks), mimetype="text/plain")
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.trace = tracer.start(request.endpoint or "unmatched", method=request.method)
+
+
+@before_render_template.connect_via(app)
+def start_render_span(sender, template, context, **extra):
+    g.render_span = tracer.start_span("render", template=template.name)
+
+
+@template_rendered.connect_via(app)
+def end_render_span(sender, template, context, **extra):
+    tracer.end_span(g.pop("render_span", None))
+
+
 @app.after_request
 def after_request(response):
     response.headers.add("Accept-Ranges", "bytes")
+    trace = g.get("trace")
+    if trace is not None:
+        # Finished once the body has been sent so file sends are included
+        call_on_close(
+            response, lambda: tracer.finish(trace, status=response.status_code)
+        )
+    if "request_start" in g:
+        endpoint = request.endpoint or "unmatched"
+        metrics.observe(
+            REQUEST_DURATION,
+            time.perf_counter() - g.request_start,
+            endpoint=endpoint,
+            method=request.method,
+        )
+        metrics.inc(
+            REQUESTS,
+            endpoint=endpoint,
+            method=request.method,
+            status=response.status_code,
+        )
     return response
 
 
@@ -494,16 +918,78 @@ def xsendfile(path, filename):
     return resp
 
 
+def _getMp4Info(path, stat):
+    """Cached mp4.probe() of path. None for files that cannot be parsed"""
+    key = f"{path}:{stat.size}:{stat.mtime}"
+    info = mp4_info_cache.get(key, MISSING)
+    if info is MISSING:
+        try:
+            info = probe(path, stat.size)
+        except (OSError, ValueError) as e:
+            logger().error(e)
+            info = None
+        mp4_info_cache.set(key, info)
+    return info
+
+
+def _warmMoov(path, stat):
+    """Read the moov box ahead when a player starts on a non-faststart mp4"""
+    if stat is None or path.suffix.lower() not in STREAMABLE_FILE_TYPES:
+        return
+
+    byte_range = request.range
+    if byte_range is not None and byte_range.ranges[0][0] != 0:
+        return
+
+    info = _getMp4Info(path, stat)
+    if info and not info["faststart"]:
+        try:
+            warm_moov(path, info)
+        except OSError as e:
+            logger().error(e)
+
+
+@tracer.traced("send_file")
 def send_file_partial(path, filename):
+    path = Path(path)
+    stat = media_index.get_directory(path.parent).files.get(path.name)
+    _warmMoov(path, stat)
+
     if USE_NGINX:
         logger().debug(f"Using NGINX to send {filename}")
-        return xsendfile(path, filename)
+        return _countBytesServed("nginx", xsendfile(path, filename))
     else:
         logger().debug(f"Using Flask to send {filename}")
-        return send_file(path, conditional=True)
+        response = send_range(
+            path,
+            stat=stat,
+            chunk_size=RANGE_CHUNK_SIZE,
+            use_sendfile=USE_SENDFILE,
+            chunk_cache=chunk_cache,
+            use_mmap=USE_MMAP,
+        )
+        if chunk_cache is not None:
+            send_path = "chunk_cache"
+        elif USE_MMAP:
+            send_path = "mmap"
+        else:
+            send_path = "flask"
+        return _countBytesServed(send_path, response)
+
+
+def _countBytesServed(send_path, response):
+    # Counted when the response is built. Clients that hang up early
+    # receive less
+    metrics.inc(
+        BYTES_SERVED,
+        int(response.headers.get("Content-Length", 0)),
+        send_path=send_path,
+    )
+    return response
 
 
 @app.route(APP_NAME + "/stream/<guid>/<path:hashPath>")
+@conditionalResponse
 @logErrorsAndContinue
 def video(guid, hashPath):
     """Display streaming page"""
@@ -519,10 +1005,10 @@ def video(guid, hashPath):
             theme=token.get("theme", DEFAULT_THEME),
         )
 
-    file_entry = _getFileEntryFromHash(token, hashPath)
+    navigation = _Navigation(guid)
     files = buildEntries(token)
-    tv_genres, movie_genres = getMediaGenres(guid)
-    collections = get_collections(guid)
+    file_entry = _getFileEntryFromHash(token, hashPath, files)
+    tv_genres, movie_genres, collections = navigation.result()
 
     token = _extract_donation_info(token)
 
@@ -533,6 +1019,7 @@ def video(guid, hashPath):
         title=token["displayname"],
         filename=token["filename"],
         hashPath=hashPath,
+        **_playerSources(guid, file_entry),
         video_file=file_entry["path"],
         subtitle_files=[
             subtitle.waiter_path for subtitle in file_entry["subtitleFiles"]
@@ -570,11 +1057,111 @@ def video(guid, hashPath):
     )
 
 
+def _playerSources(guid, file_entry):
+    """The HLS playlist, poster and seek previews video.html plays a file with"""
+    thumbnailPath = file_entry["thumbnailPath"]
+    return {
+        "hls_playlist": get_hls_playlist_url(guid, file_entry["hashedWaiterPath"]),
+        "poster": thumbnailPath,
+        "thumbnails": f"{thumbnailPath}/sprite.vtt" if thumbnailPath else "",
+    }
+
+
+def get_hls_playlist_url(guid, hashPath):
+    return (
+        buildWaiterPath("stream", guid, f"{hashPath}/hls/{PLAYLIST_NAME}")
+        if USE_HLS
+        else ""
+    )
+
+
+@app.route(APP_NAME + "/stream/<guid>/<hashPath>/hls/<name>")
+@logErrorsAndContinue
+def hls(guid, hashPath, name):
+    """Send the HLS playlist or a segment remuxed from a video file"""
+    token = getTokenByGUID(guid)
+
+    errorStr = checkForValidToken(token, guid)
+    if errorStr or not USE_HLS:
+        return render_template(
+            "error.html",
+            title="Error",
+            errorText=errorStr or "HLS streaming is disabled",
+            mediaviewer_base_url=EXTERNAL_MEDIAVIEWER_BASE_URL,
+            theme=token.get("theme", DEFAULT_THEME),
+        )
+
+    path, is_subtitle = _getPathFromHash(token, hashPath)
+    if is_subtitle:
+        raise ValueError(f"Subtitles cannot be streamed. GUID = {guid}")
+
+    stat = media_index.get_directory(path.parent).files.get(path.name)
+    if stat is None:
+        raise FileNotFoundError(f"{path} does not exist")
+
+    if name == PLAYLIST_NAME:
+        with tracer.span("hls_playlist"):
+            playlist = segment_cache.get_playlist(path, stat)
+        return send_range(
+            playlist, chunk_size=RANGE_CHUNK_SIZE, mimetype=PLAYLIST_MIMETYPE
+        )
+
+    segment = segment_cache.get_segment(path, stat, name)
+    response = send_range(
+        segment,
+        chunk_size=RANGE_CHUNK_SIZE,
+        use_sendfile=USE_SENDFILE,
+        mimetype=SEGMENT_MIMETYPE,
+    )
+    return _countBytesServed("hls", response)
+
+
+@app.route(APP_NAME + "/thumb/<guid>/<hashPath>", defaults={"name": POSTER_NAME})
+@app.route(APP_NAME + "/thumb/<guid>/<hashPath>/<name>")
+@conditionalResponse
+@logErrorsAndContinue
+def thumbnail(guid, hashPath, name):
+    """Send the poster, seek preview sprite or its WebVTT file of a video"""
+    token = getTokenByGUID(guid)
+
+    errorStr = checkForValidToken(token, guid)
+    if errorStr or not USE_THUMBNAILS:
+        return render_template(
+            "error.html",
+            title="Error",
+            errorText=errorStr or "Thumbnails are disabled",
+            mediaviewer_base_url=EXTERNAL_MEDIAVIEWER_BASE_URL,
+            theme=token.get("theme", DEFAULT_THEME),
+        )
+
+    path, is_subtitle = _getPathFromHash(token, hashPath)
+    if is_subtitle:
+        raise ValueError(f"Subtitles do not have thumbnails. GUID = {guid}")
+
+    stat = media_index.get_directory(path.parent).files.get(path.name)
+    if stat is None:
+        raise FileNotFoundError(f"{path} does not exist")
+
+    info = _getMp4Info(path, stat)
+    with tracer.span("thumbnail"):
+        thumbnail = thumbnail_cache.get(
+            path, stat, hashPath, info["duration"] if info else None, name
+        )
+    if thumbnail is None:
+        # Still being made, or ffmpeg failed on it
+        return "", 404
+    return send_range(
+        thumbnail, chunk_size=RANGE_CHUNK_SIZE, mimetype=THUMBNAIL_MIMETYPES[name]
+    )
+
+
 def get_jitsi_room_name():
     chars = [rand.choice(ROOM_NAME_CHARS) for x in range(ROOM_NAME_LENGTH)]
     return "".join(chars)
 
 
+# Not conditional since every render signs a new Jitsi JWT and room name,
+# so the page must stay no-store
 @app.route(APP_NAME + "/watch-party/<guid>/<path:hashPath>")
 @logErrorsAndContinue
 def watch_party(guid, hashPath):
@@ -590,10 +1177,10 @@ def watch_party(guid, hashPath):
             theme=token.get("theme", DEFAULT_THEME),
         )
 
-    file_entry = _getFileEntryFromHash(token, hashPath)
+    navigation = _Navigation(guid)
     files = buildEntries(token)
-    tv_genres, movie_genres = getMediaGenres(guid)
-    collections = get_collections(guid)
+    file_entry = _getFileEntryFromHash(token, hashPath, files)
+    tv_genres, movie_genres, collections = navigation.result()
 
     token = _extract_donation_info(token)
 
@@ -665,22 +1252,136 @@ def ajaxviewed(guid):
         "guid": guid,
     }
     try:
-        req = requests.post(
+        req = session.post(
             MEDIAVIEWER_VIEWED_URL,
             data=values,
             auth=(WAITER_USERNAME, WAITER_PASSWORD),
             verify=VERIFY_REQUESTS,
-            timeout=REQUESTS_TIMEOUT,
+            timeout=VIEWED_REQUESTS_TIMEOUT,
         )
 
         req.raise_for_status()
     except Exception as e:
         logger().error(e)
         raise
+    finally:
+        invalidateToken(guid)
 
     return jsonify({"msg": "Viewed set successfully"})
 
 
+def _nextEpisodeName(directory, filename):
+    """Name of the streamable file sorting after filename in directory"""
+    names = sorted(
+        name
+        for name in directory.files
+        if Path(name).suffix.lower() in STREAMABLE_FILE_TYPES and isAlfredEncoding(name)
+    )
+    index = bisect_right(names, filename)
+    return names[index] if index < len(names) else None
+
+
+def _schedulePrefetch(guid, hashedFilename, offset):
+    """Queue prefetching the next episode once offset is far enough along
+
+    Only the first offset posted for a file, and any past its plan's
+    offset, queue a job. The token cached for the page load is passed on
+    so the job does not have to fetch it again.
+    """
+    try:
+        offset = float(offset)
+    except ValueError:
+        return None
+
+    key = (guid, hashedFilename)
+    plan = prefetch_plans.get(key, MISSING)
+    if plan is None or (plan is not MISSING and offset < plan[0]):
+        return None
+
+    token = token_cache.get(guid)
+    return prefetcher.submit(
+        key, _prefetchNextEpisode, guid, hashedFilename, offset, token
+    )
+
+
+def _prefetchNextEpisode(guid, hashedFilename, offset, token=None):
+    """Warm what autoplaying the episode after the token's file will need
+
+    Returns True once the next episode has been warmed, or there is nothing
+    to warm. MediaViewer only creates the next episode's token when the
+    next link is followed, so the next episode is taken to be the file
+    sorting after the current one in its directory.
+
+    Whether and when to prefetch is decided once per guid and file and
+    kept in prefetch_plans, so later offsets need no MediaViewer calls.
+    """
+    key = (guid, hashedFilename)
+    plan = prefetch_plans.get(key, MISSING)
+    if plan is None:
+        return True
+    if plan is MISSING:
+        plan = _prefetchPlan(guid, token or getTokenByGUID(guid))
+        if plan is None:
+            prefetch_plans.set(key, None)
+            return True
+    threshold, token = plan
+
+    if float(offset) < threshold:
+        prefetch_plans.set(key, (threshold, token))
+        return False
+    prefetch_plans.set(key, None)
+
+    path = _getTVFilePath(token)
+    directory = media_index.get_directory(path.parent)
+    next_name = _nextEpisodeName(directory, path.name)
+    if next_name is None:
+        return True
+
+    # Builds the next token's file entry and hash table the way autoplay
+    # will, which hashes its paths, finds its subtitles and probes the mp4
+    next_token = dict(token, filename=next_name, videoprogresses=[])
+    entry = _buildFileDictHelper(path.parent, next_name, next_token, directory)
+    if entry is None:
+        return True
+    _getHashTable(next_token, [entry])
+
+    logger().info(f"Prefetching {entry['unhashedPath']} for {guid}")
+    _warmHead(entry["unhashedPath"], directory.files[next_name])
+    return True
+
+
+def _prefetchPlan(guid, token):
+    """(offset to prefetch at, token), or None if there is no next episode"""
+    if (
+        checkForValidToken(token, guid)
+        or token["ismovie"]
+        or not token.get("binge_mode")
+        or not token.get("next_id")
+    ):
+        return None
+
+    path = _getTVFilePath(token)
+    stat = media_index.get_directory(path.parent).files.get(path.name)
+    info = _getMp4Info(path, stat) if stat else None
+    if info is None:
+        return None
+    return info["duration"] * PREFETCH_NEXT_AT, token
+
+
+def _warmHead(path, stat):
+    """Read the start of a video, and its moov box, ahead of playback"""
+    length = min(PREFETCH_NEXT_BYTES, stat.size)
+    if chunk_cache is not None and not USE_NGINX:
+        for _ in chunk_cache.iter_range(path, stat, 0, length):
+            pass
+    else:
+        warm_range(path, 0, length)
+
+    info = _getMp4Info(path, stat)
+    if info and not info["faststart"]:
+        warm_moov(path, info)
+
+
 @app.route(
     APP_NAME + "/offset/<guid>/<path:hashedFilename>/",
     methods=["GET", "POST", "DELETE"],
@@ -688,16 +1389,28 @@ def ajaxviewed(guid):
 def videoOffset(guid, hashedFilename):
     if request.method == "GET":
         print("GET-ing video offset")
+        offset = offset_buffer.get(guid, hashedFilename)
+        if offset is not None:
+            return jsonify({"offset": offset, "date_edited": None})
+
         data = getVideoOffset(hashedFilename, guid)
         return jsonify(data)
     elif request.method == "POST":
         print("POST-ing video offset:")
         print(f'offset: {request.form["offset"]}')
-        setVideoOffset(hashedFilename, guid, request.form["offset"])
+        if PREFETCH_NEXT_AT:
+            _schedulePrefetch(guid, hashedFilename, request.form["offset"])
+        if OFFSET_FLUSH_INTERVAL:
+            offset_buffer.set(guid, hashedFilename, request.form["offset"])
+        else:
+            setVideoOffset(hashedFilename, guid, request.form["offset"])
+        recordProgress(guid, hashedFilename)
         return jsonify({"msg": "success"})
     elif request.method == "DELETE":
         print("DELETE-ing video offset:")
+        offset_buffer.discard(guid, hashedFilename)
         deleteVideoOffset(hashedFilename, guid)
+        invalidateToken(guid)
         return jsonify({"msg": "deleted"})
     else:
         raise Exception("Method not supported")
@@ -708,6 +1421,7 @@ if __name__ == "__main__":
     from settings import DEBUG, PORT, HOST
 
     app.debug = DEBUG
+    start_media_watcher()
     if not DEBUG:
         app.run(host=HOST, port=PORT)
     else:
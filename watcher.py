@@ -0,0 +1,273 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+
+from pathlib import Path
+from log import logger
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+)
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class PollingWatcher:
+    """Revalidate every indexed directory under roots on a fixed interval
+
+    Works on any filesystem, including network mounts where inotify never
+    sees changes made by other hosts.
+    """
+
+    def __init__(self, index, roots, interval=30):
+        self.index = index
+        self.roots = [Path(root) for root in roots]
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.poll()
+        self.index.watch(self.roots)
+        self._thread = threading.Thread(
+            target=self._run, name="media-watcher", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.index.unwatch()
+
+    def poll(self):
+        seen = set()
+        for root in self.roots:
+            seen.update(
+                path for path, _ in _walk(self.index, root, self.index.revalidate)
+            )
+
+        # Directories removed since the last poll are no longer reachable
+        for path in self.index.directories():
+            if path not in seen and any(
+                path == root or root in path.parents for root in self.roots
+            ):
+                self.index.invalidate(path)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as e:
+                logger().error(e, exc_info=True)
+
+
+class InotifyWatcher:
+    """Apply inotify events for everything under roots to the media index
+
+    Events are coalesced per directory and the affected listings are rescanned
+    once things have been quiet for `delay` seconds, so copying a large file
+    in produces a single rescan when it finishes rather than one per write.
+    """
+
+    def __init__(self, index, roots, delay=1):
+        self.index = index
+        self.roots = [Path(root) for root in roots]
+        self.delay = delay
+        self._libc = _loadLibc()
+        self._fd = None
+        self._watches = {}
+        self._dirty = set()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        try:
+            for root in self.roots:
+                self._addTree(root)
+        except OSError:
+            os.close(self._fd)
+            raise
+        self.index.watch(self.roots)
+
+        self._thread = threading.Thread(
+            target=self._run, name="media-watcher", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.index.unwatch()
+
+    def _addWatch(self, path):
+        wd = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(path), ctypes.c_uint32(WATCH_MASK)
+        )
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"Unable to watch {path}")
+        self._watches[wd] = Path(path)
+
+    def _addTree(self, root):
+        # Watch first, then scan, so nothing created in between is missed
+        for _ in _walk(self.index, root, self._watchAndRefresh):
+            pass
+
+    def _watchAndRefresh(self, path):
+        self._addWatch(path)
+        entry = self.index.refresh(path)
+        if entry is None:
+            raise FileNotFoundError(path)
+        return entry
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                self.run_once(timeout=1)
+        except Exception as e:
+            # Fall back to revalidating on every request
+            logger().error(e, exc_info=True)
+            self.index.unwatch()
+        finally:
+            os.close(self._fd)
+
+    def run_once(self, timeout=None):
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if readable:
+            self._read()
+            # Keep collecting until the directory has been quiet for a while
+            while select.select([self._fd], [], [], self.delay)[0]:
+                self._read()
+        self._applyDirty()
+
+    def _read(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            self._handle(wd, mask, os.fsdecode(name))
+
+    def _handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            logger().warning("inotify queue overflowed. Rescanning everything")
+            self._dirty.update(self._watches.values())
+            return
+
+        directory = self._watches.get(wd)
+        if directory is None:
+            return
+
+        if mask & IN_IGNORED:
+            del self._watches[wd]
+            self.index.invalidate(directory)
+            return
+
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            self.index.invalidate(directory)
+            return
+
+        self._dirty.add(directory)
+        if mask & IN_ISDIR:
+            path = directory / name
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._addTree(path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.index.invalidate(path)
+
+    def _applyDirty(self):
+        dirty, self._dirty = self._dirty, set()
+        for directory in dirty:
+            self.index.refresh(directory)
+
+
+def _walk(index, root, get_directory):
+    stack = [Path(root)]
+    while stack:
+        current = stack.pop()
+        try:
+            entry = get_directory(current)
+        except (FileNotFoundError, NotADirectoryError, PermissionError) as e:
+            # Other errors, like running out of inotify watches, propagate
+            logger().error(e)
+            index.invalidate(current)
+            continue
+
+        yield current, entry
+        stack.extend(current / subdir for subdir in reversed(entry.subdirs))
+
+
+def _loadLibc():
+    if not sys.platform.startswith("linux"):
+        raise OSError("inotify is only available on Linux")
+
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+def start_watcher(index, roots, mode="auto", poll_interval=30):
+    """Start the watcher selected by mode and return it
+
+    mode is one of "none", "poll", "inotify" or "auto". "auto" uses inotify
+    and falls back to polling if inotify cannot be set up, e.g. because the
+    watch limit has been reached.
+    """
+    if mode == "none":
+        return None
+
+    if mode in ("inotify", "auto"):
+        try:
+            watcher = InotifyWatcher(index, roots)
+            watcher.start()
+            logger().info(f"Watching {roots} with inotify")
+            return watcher
+        except OSError as e:
+            if mode == "inotify":
+                raise
+            logger().warning(f"inotify unavailable ({e}). Falling back to polling")
+            index.unwatch()
+    elif mode != "poll":
+        raise ValueError(f"Unknown media watcher: {mode}")
+
+    watcher = PollingWatcher(index, roots, interval=poll_interval)
+    watcher.start()
+    logger().info(f"Polling {roots} every {poll_interval} seconds")
+    return watcher